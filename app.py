@@ -1,18 +1,44 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, session
+from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, session, g, has_request_context, has_app_context
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
 import os
-from datetime import datetime, date
+import base64
+import json
+import hashlib
+import urllib.parse
+from datetime import datetime, date, timedelta
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import MemoryHandler
+import numpy as np
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
 
 # Google Calendar同期モジュール
 from calendar_sync import add_to_calendar, delete_from_calendar, update_in_calendar
+# 読み取りキャッシュ
+from read_cache import ReadCache
+from ingest import apply_reservations_partial, normalize_item, validate_item
+# 接続プール（スレッドセーフ、一定時間使われていなかった接続のみ生存確認）
+from db_pool import ConnectionPool
+# よく使うクエリの登録（接続ごとに PREPARE して EXECUTE で実行）
+import query_registry
+from query_registry import register_query, execute_query
+# 空き状況計算モジュール
+from availability import (
+    time_to_minutes, minutes_to_time, generate_slots, clip_to_store_hours,
+    fetch_day_reservations, fetch_date_reservations, fetch_range_reservations,
+    fetch_reservations_for_keys,
+    slot_occupancy, peak_occupancy, free_ranges, hourly_min_remaining,
+    room_slot_occupancy, build_occupancy_matrix, free_ranges_remaining_matrix,
+    saturated_intervals, feasible_starts
+)
 
 # --- App Initialization ---
 app = Flask(__name__)
@@ -44,6 +70,9 @@ LOCKOUT_DURATION_MINUTES = 15  # How long to lock account after max attempts
 WEBHOOK_API_KEY = os.environ.get('WEBHOOK_API_KEY')  # Vercelの環境変数で設定
 if not WEBHOOK_API_KEY:
     print("⚠️  WARNING: WEBHOOK_API_KEY not set. Webhook endpoint is unprotected!")
+# Webhookの既定の取り込みモード（sync: リクエスト内で反映 / async: 取り込みキューに追加して202を返す）
+# リクエストごとに ?mode=sync / ?mode=async で切り替え可能
+WEBHOOK_INGEST_MODE = os.environ.get('WEBHOOK_INGEST_MODE', 'sync')
 
 # --- Store Configuration ---
 STORE_CONFIG = {
@@ -97,55 +126,292 @@ ROOM_OPTIONS = {
     'hanzomon': ['STUDIO A', 'STUDIO B']
 }
 
+# --- Read Cache ---
+# 予約一覧・空き状況APIの結果をキャッシュ（書き込み時に (店舗, 日付) 単位で無効化）
+read_cache = ReadCache(
+    max_entries=int(os.environ.get('READ_CACHE_MAX_ENTRIES', 512)),
+    ttl_seconds=float(os.environ.get('READ_CACHE_TTL_SECONDS', 60))
+)
+
 # --- Database Connection Pool ---
+# 接続モード（環境変数 DB_POOL_MODE、未設定の場合は Vercel 上なら serverless、それ以外は server）
+# - server: 常駐サーバー向け。起動時に1本接続し、最大20本まで。返却した接続は閉じずに保持する
+#   （同時に使った本数分を保持しないと、返却のたびに閉じて次の取得で接続し直すことになる）
+# - serverless: Vercel などのサーバーレス向け。インスタンスが増えても接続数が膨らまないよう上限を小さくし、
+#   最初に必要になるまで接続しない。返却した1本は開いたまま保持し、同じインスタンスの次の呼び出しで再利用する。
+#   PgBouncer などのトランザクションモードのプーラー越しに接続することを前提に、
+#   トランザクションをまたぐセッション状態（SET、WITH HOLD カーソル、ON COMMIT DROP でない一時テーブルなど）に
+#   依存するコードは書かないこと。
+#   サーバー側のプリペアドステートメントは query_registry（register_query / execute_query）経由でのみ使う。
+#   使うのは server モードで接続先がプーラーに見えない場合だけで（use_prepared_statements()）、
+#   実行時にプーラー越しと分かれば自動で通常の実行に戻る。PREPARE を直接実行するコードは書かないこと
+DB_POOL_SETTINGS = {
+    'server': {'minconn': 1, 'maxconn': 20, 'max_idle': 20},
+    'serverless': {'minconn': 0, 'maxconn': 2, 'max_idle': 1, 'connect_timeout': 5},
+}
+DB_POOL_MODE = os.environ.get('DB_POOL_MODE') or ('serverless' if os.environ.get('VERCEL') else 'server')
+if DB_POOL_MODE not in DB_POOL_SETTINGS:
+    print(f"⚠️  WARNING: Unknown DB_POOL_MODE '{DB_POOL_MODE}', using 'server'")
+    DB_POOL_MODE = 'server'
+# 1インスタンスあたりの最大接続数（環境変数 DB_POOL_MAX_CONNECTIONS で上書き）
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX_CONNECTIONS') or
+                              DB_POOL_SETTINGS[DB_POOL_MODE]['maxconn'])
+# 返却後も開いたまま保持する接続数（環境変数 DB_POOL_MAX_IDLE で上書き、server モードの既定は最大接続数と同じ）。
+# 最大接続数より少ないとプリペアドステートメントは使わない（db_pool.ConnectionPool）
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE') or
+                       (DB_POOL_MAX_CONNECTIONS if DB_POOL_MODE == 'server'
+                        else DB_POOL_SETTINGS[DB_POOL_MODE]['max_idle']))
+
+def use_prepared_statements(setting, mode, database_url):
+    """
+    登録したクエリ（query_registry）をプリペアドステートメントで実行するか
+
+    Args:
+        setting (str): 環境変数 DB_PREPARED_STATEMENTS（on / off / auto、既定は auto）
+        mode (str): DB_POOL_MODE
+        database_url (str): 接続先URL
+
+    auto の場合は server モードで、接続先がプーラーに見えない
+    （ホスト名に pooler / pgbouncer を含まず、ポートが 6432 / 6543 でない）ときだけ使う。
+    プーラー越しと分からずに有効にしても、プリペアドステートメントが消えていれば自動で通常の実行に戻る。
+    """
+    setting = (setting or 'auto').lower()
+    if setting in ('on', 'true', '1'):
+        return True
+    if setting in ('off', 'false', '0') or mode != 'server' or not database_url:
+        return False
+    parsed = urllib.parse.urlparse(database_url)
+    host = (parsed.hostname or '').lower()
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    return 'pooler' not in host and 'pgbouncer' not in host and port not in (6432, 6543)
+
+# --- Read Replica ---
+# POSTGRES_READ_URL（省略可）を設定すると、公開の読み取りAPI（/api/reservations、/api/availability*）は
+# リードレプリカの接続プールを使う。次の場合はプライマリ（POSTGRES_URL）で読む。
+# - レプリカの遅延が DB_READ_MAX_LAG_SECONDS 秒を超えている（遅延は DB_READ_LAG_CHECK_SECONDS 秒ごとに確認）
+# - レプリカがプライマリからWALを受信していない（WAL受信プロセスが streaming でない。受信済みのWALを
+#   すべて適用していても、プライマリとの接続が切れていれば内容がいつまで古いかわからない）
+# - このプロセスで書き込んだ後、レプリカがまだその時点に追いついたことを確認できていない
+# - 管理者のセッションが書き込んでから DB_READ_STICKY_SECONDS 秒以内（別のインスタンスでも自分の書き込みが見える。
+#   その間はプロセス内の読み取りキャッシュも、プライマリの変更カウンタと一致する場合しか使わない）
+# - レプリカに接続できない
+# 書き込み・管理画面・webhook・変更フィード（/api/reservations/changes）は常にプライマリを使う。
+DB_READ_MAX_LAG_SECONDS = float(os.environ.get('DB_READ_MAX_LAG_SECONDS', 5))
+DB_READ_STICKY_SECONDS = float(os.environ.get('DB_READ_STICKY_SECONDS', 30))
+DB_READ_LAG_CHECK_SECONDS = 1
+# レプリカに接続できなかった後、この秒数はプライマリで読む（毎回接続を試して待たないため）
+DB_READ_RETRY_SECONDS = 30
+# 管理者が最後に書き込んだ時刻 + DB_READ_STICKY_SECONDS（UNIX時刻）を保存するセッションのキー
+DB_READ_PRIMARY_UNTIL_KEY = 'db_read_primary_until'
+# レプリカの状態（checked_at は遅延の確認を始めた time.monotonic()、lag_seconds は不明ならNone、
+# receiving はWALを受信中か（不明ならNone）、
+# unavailable_until は接続に失敗した後にプライマリで読む期限の time.monotonic()）
+replica_state = {'checked_at': None, 'lag_seconds': None, 'receiving': None, 'unavailable_until': None}
+# 読み取りの振り分け先の件数（/api/admin/db-pool-stats）
+read_routing = {'replica': 0, 'primary_sticky': 0, 'primary_recent_write': 0, 'primary_lag': 0,
+                'primary_not_receiving': 0, 'primary_unavailable': 0}
+read_routing_lock = threading.Lock()
+
 db_pool = None
+read_db_pool = None
+db_pool_lock = threading.Lock()
 
 def init_db_pool():
-    """Initialize database connection pool"""
+    """Initialize database connection pool (thread-safe)"""
     global db_pool
     if db_pool is None:
-        DATABASE_URL = os.environ.get('POSTGRES_URL')
-        if not DATABASE_URL:
-            raise Exception("POSTGRES_URL environment variable not set")
-        db_pool = SimpleConnectionPool(1, 20, DATABASE_URL)
+        with db_pool_lock:
+            if db_pool is None:
+                DATABASE_URL = os.environ.get('POSTGRES_URL')
+                if not DATABASE_URL:
+                    raise Exception("POSTGRES_URL environment variable not set")
+                db_pool = ConnectionPool(dsn=DATABASE_URL, **db_pool_settings(DATABASE_URL))
+                print(f"[DEBUG] DB pool initialized (mode={DB_POOL_MODE}, maxconn={DB_POOL_MAX_CONNECTIONS})")
     return db_pool
 
-def get_db_conn():
-    """Get database connection from pool with liveness check"""
-    global db_pool
-    pool = init_db_pool()
+def db_pool_settings(database_url):
+    """DB_POOL_MODE の設定に、接続先URLで決まるプリペアドステートメントの設定を加えたもの"""
+    settings = dict(DB_POOL_SETTINGS[DB_POOL_MODE], maxconn=DB_POOL_MAX_CONNECTIONS)
+    settings['minconn'] = min(settings['minconn'], DB_POOL_MAX_CONNECTIONS)
+    settings['max_idle'] = min(DB_POOL_MAX_IDLE, DB_POOL_MAX_CONNECTIONS)
+    settings['prepare_statements'] = use_prepared_statements(
+        os.environ.get('DB_PREPARED_STATEMENTS'), DB_POOL_MODE, database_url)
+    return settings
+
+def init_read_db_pool():
+    """Initialize read replica connection pool (POSTGRES_READ_URL 未設定の場合はNone)"""
+    global read_db_pool
+    if read_db_pool is None:
+        READ_URL = os.environ.get('POSTGRES_READ_URL')
+        if not READ_URL:
+            return None
+        with db_pool_lock:
+            if read_db_pool is None:
+                read_db_pool = ConnectionPool(dsn=READ_URL, **db_pool_settings(READ_URL))
+                print(f"[DEBUG] Read replica pool initialized (mode={DB_POOL_MODE}, maxconn={DB_POOL_MAX_CONNECTIONS})")
+    return read_db_pool
+
+def get_db_conn(label=None):
+    """
+    Get database connection from pool
+
+    生存確認（SELECT 1）は一定時間使われていなかった接続だけに行い、壊れた接続はその接続だけ入れ替える。
+    返却漏れを防ぐため、新しいコードでは db_connection() を使う。
+    待ち時間・保持時間・クエリ数はエンドポイントごとに集計し（/api/admin/db-pool-stats）、
+    リクエスト内の合計は Server-Timing ヘッダーで返す。
+
+    Args:
+        label (str): 集計に使う名前（省略時はリクエスト中のエンドポイント名）
+    """
+    return init_db_pool().getconn(db_conn_label(label))
+
+def db_conn_label(label=None):
+    """接続の集計に使う名前（省略時はリクエスト中のエンドポイント名、リクエスト外は 'background'）"""
+    if label is not None:
+        return label
+    if has_request_context():
+        # リクエスト終了後（teardown）の監査ログの書き込みも同じエンドポイントに集計する
+        label = g.db_label = request.endpoint or request.path
+        return label
+    return g.get('db_label', 'background') if has_app_context() else 'background'
+
+def get_read_db_conn(label=None, primary=None):
+    """
+    Get read-only database connection（公開の読み取りAPI用）
+
+    POSTGRES_READ_URL が設定されていればリードレプリカの接続を返す。
+    レプリカが遅れている・このプロセスの書き込みにまだ追いついていない・管理者が書き込んだ直後・
+    接続できない場合はプライマリの接続を返す（返却はどちらも return_db_conn()）。
+    1つのリクエストで一度プライマリを選んだら、以降の読み取りもプライマリで行う
+    （変更カウンタとデータで読み取り先が入れ替わり、新しいETagに古いデータを保存しないため）。
+
+    Args:
+        label (str): 集計に使う名前（省略時はリクエスト中のエンドポイント名）
+        primary (bool): Trueならプライマリで読む（Noneの場合はセッションから判定。
+                        リクエストのコンテキスト外で読むストリーミングなどは呼び出し側で判定して渡す）
+    """
+    label = db_conn_label(label)
+    if not os.environ.get('POSTGRES_READ_URL'):
+        return get_db_conn(label)
+    if primary is None:
+        primary = read_from_primary()
+    if primary or (has_request_context() and g.get('db_read_target') == 'primary'):
+        return primary_read_conn(label, 'primary_sticky')
+    unavailable_until = replica_state['unavailable_until']
+    if unavailable_until is not None and time.monotonic() < unavailable_until:
+        return primary_read_conn(label, 'primary_unavailable')
+
+    try:
+        conn = init_read_db_pool().getconn(label)
+    except PoolError as e:
+        # レプリカのプールが使用中の接続で埋まっている（一時的なもの）
+        print(f"⚠️  Read replica pool busy, reading from primary: {e}")
+        return primary_read_conn(label, 'primary_unavailable')
+    except psycopg2.OperationalError as e:
+        print(f"⚠️  Read replica unavailable, reading from primary for {DB_READ_RETRY_SECONDS}s: {e}")
+        replica_state['unavailable_until'] = time.monotonic() + DB_READ_RETRY_SECONDS
+        return primary_read_conn(label, 'primary_unavailable')
+
+    reason = replica_unusable_reason(conn)
+    if reason:
+        return_db_conn(conn)
+        return primary_read_conn(label, reason)
+    count_read_routing('replica')
+    if has_request_context():
+        g.db_read_target = 'replica'
+    return conn
+
+def read_from_primary():
+    """このセッションの管理者が書き込んでから DB_READ_STICKY_SECONDS 秒以内か（read-your-writes）"""
+    if not has_request_context():
+        return False
+    until = session.get(DB_READ_PRIMARY_UNTIL_KEY)
+    return until is not None and until > time.time()
+
+def primary_read_conn(label, reason):
+    """読み取りをプライマリで行う（理由を集計）"""
+    count_read_routing(reason)
+    if has_request_context():
+        g.db_read_target = 'primary'
+    return get_db_conn(label)
+
+def count_read_routing(key):
+    with read_routing_lock:
+        read_routing[key] += 1
+
+def replica_unusable_reason(conn):
+    """
+    レプリカの接続を使えない理由（使える場合はNone）
+
+    遅延は DB_READ_LAG_CHECK_SECONDS 秒ごとに、渡された接続で確認する。
+
+    Returns:
+        str: 'primary_not_receiving'（WALを受信していない）/ 'primary_lag'（遅延が許容範囲外・不明）/
+             'primary_recent_write'（このプロセスの書き込みに追いついたことを確認できていない）/ None
+    """
+    now = time.monotonic()
+    checked_at = replica_state['checked_at']
+    if checked_at is None or now - checked_at >= DB_READ_LAG_CHECK_SECONDS:
+        seconds, receiving = replica_status(conn)
+        replica_state.update(checked_at=now, lag_seconds=seconds, receiving=receiving)
+        checked_at = now
+    else:
+        seconds, receiving = replica_state['lag_seconds'], replica_state['receiving']
+    if receiving is False:
+        return 'primary_not_receiving'
+    if seconds is None or seconds > DB_READ_MAX_LAG_SECONDS:
+        return 'primary_lag'
+    # レプリカの内容は「確認した時刻 - 遅延」時点のもの。それより後にこのプロセスで書き込んでいればプライマリで読む
+    written_at = read_cache.invalidated_at
+    if written_at is not None and checked_at - seconds < written_at:
+        return 'primary_recent_write'
+    return None
+
+def replica_status(conn):
+    """
+    レプリカの遅延（秒）と、プライマリからWALを受信中か
+
+    受信済みのWALをすべて適用済みなら0、それ以外は最後に適用したトランザクションからの経過時間。
+    WAL受信プロセスが切断されると受信・適用位置が同じ値のまま止まり遅延が0に見えるため、
+    pg_stat_wal_receiver の status が streaming かも確認する（権限がなく status が見えない場合は
+    受信プロセスがあれば受信中とみなす）。
+    レプリカでない（リカバリ中でない）接続先は (0, True)。確認できない場合は (None, None)。
+    """
     try:
-        conn = pool.getconn()
-        # Test connection
         with conn.cursor() as cur:
-            cur.execute('SELECT 1')
-        return conn
-    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
-        # Connection is dead
-        print(f"⚠️  Connection dead, resetting pool: {e}")
-        try:
-            if conn:
-                pool.putconn(conn, close=True)
-        except:
-            pass
-        
-        # Reset pool
+            cur.execute("""
+                SELECT pg_is_in_recovery(),
+                    EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'),
+                    CASE
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                    END
+            """)
+            in_recovery, receiving, seconds = cur.fetchone()
+        conn.rollback()
+        if not in_recovery:
+            return 0.0, True
+        return (None if seconds is None else max(float(seconds), 0.0)), receiving
+    except psycopg2.Error as e:
+        print(f"⚠️  Could not check replica lag: {e}")
         try:
-            if db_pool:
-                db_pool.closeall()
-        except:
+            conn.rollback()
+        except psycopg2.Error:
             pass
-        db_pool = None
-        
-        # Retry with new pool
-        pool = init_db_pool()
-        return pool.getconn()
+        return None, None
 
 def return_db_conn(conn):
-    """Return database connection to pool"""
+    """Return database connection to pool（リードレプリカの接続はレプリカのプールへ）"""
     try:
-        pool = init_db_pool()
-        pool.putconn(conn)
+        pool = read_db_pool if read_db_pool is not None and read_db_pool.owns(conn) else init_db_pool()
+        timing = pool.putconn(conn)
+        if timing and has_request_context():
+            request_timing = g.setdefault('db_timing', {'wait': 0.0, 'hold': 0.0, 'queries': 0, 'query_seconds': 0.0})
+            for key, value in timing.items():
+                request_timing[key] += value
     except Exception as e:
         print(f"⚠️  Error returning connection to pool: {e}")
         # If return fails, try to close connection to be safe
@@ -154,40 +420,125 @@ def return_db_conn(conn):
         except:
             pass
 
+@contextmanager
+def db_connection():
+    """
+    with db_connection() as conn: の形で使う接続
+
+    途中で return・例外があっても必ずプールに返却する（例外時は rollback してから返却）
+    """
+    conn = get_db_conn()
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        return_db_conn(conn)
+
 # --- Logging Setup ---
 # Legacy file logging (deprecated)
-logging.basicConfig(filename='activity.log', level=logging.INFO,
-                    format='%(asctime)s - %(message)s')
+# ファイルへの書き込みはメモリに溜めて、リクエスト終了時（または件数上限・ERROR以上）にまとめて書き込む
+ACTIVITY_FILE_BUFFER_CAPACITY = 1000
+_activity_file_handler = logging.FileHandler('activity.log')
+_activity_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+activity_file_buffer = MemoryHandler(ACTIVITY_FILE_BUFFER_CAPACITY, flushLevel=logging.ERROR,
+                                     target=_activity_file_handler)
+logging.basicConfig(level=logging.INFO, handlers=[activity_file_buffer])
+
+# 監査ログ（activity_logs）はリクエスト（アプリケーションコンテキスト）ごとにメモリ（flask.g）に溜め、
+# 1回の複数行INSERTで書き込む。
+# - 通常のリクエスト: teardown_appcontext で1本の接続を借りて書き込む
+# - gas_webhook・取り込みキューのワーカー: 取り込みと同じ接続・トランザクションで commit 前に書き込む（取り込みと同時に確定）
+# 書き込み前にプロセスが落ちた場合（クラッシュ・タイムアウトによる強制終了）、
+# そのリクエストの監査ログ（と activity.log の未書き込み分）は失われる。
+# 書き込みに失敗した場合も、リクエストは失敗させずに件数を出力して破棄する。
+ACTIVITY_LOG_PAGE_SIZE = 1000
+
 
 def log_activity(action, user_id=None, username=None):
-    """Log activity to database and legacy file"""
+    """
+    Log activity to database and legacy file
+
+    リクエスト中（アプリケーションコンテキスト内）は監査ログをバッファに追加するだけで、
+    DBへの書き込みは flush_activity_logs で行う。コンテキスト外から呼ばれた場合はその場で書き込む。
+    """
     # Legacy file logging
     logging.info(f"Action: {action}")
 
-    # Database logging
+    # Get request context if available
+    ip_address = None
+    user_agent = None
+    if has_request_context():
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+
+        # If username not provided, try to get from session
+        if not username and 'username' in session:
+            username = session['username']
+
+    entry = (user_id, username, action, ip_address, user_agent)
+    if has_app_context():
+        g.setdefault('activity_log_entries', []).append(entry)
+    else:
+        write_activity_logs([entry])
+
+
+def insert_activity_logs(cur, entries):
+    """監査ログを複数行INSERTで書き込む（commit は呼び出し側）"""
+    execute_values(cur, """
+        INSERT INTO activity_logs (user_id, username, action, ip_address, user_agent)
+        VALUES %s
+    """, entries, page_size=ACTIVITY_LOG_PAGE_SIZE)
+
+
+def write_activity_logs(entries):
+    """監査ログを専用の接続で書き込んで commit する（失敗しても例外は投げない）"""
+    conn = None
     try:
         conn = get_db_conn()
         with conn.cursor() as cur:
-            # Get request context if available
-            ip_address = None
-            user_agent = None
-            if request:
-                ip_address = request.remote_addr
-                user_agent = request.headers.get('User-Agent')
-
-            # If username not provided, try to get from session
-            if not username and 'username' in session:
-                username = session['username']
-
-            cur.execute("""
-                INSERT INTO activity_logs (user_id, username, action, ip_address, user_agent)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (user_id, username, action, ip_address, user_agent))
+            insert_activity_logs(cur, entries)
         conn.commit()
-        return_db_conn(conn)
     except Exception as e:
-        print(f"Failed to log to database: {e}")
+        print(f"Failed to log to database ({len(entries)} entries dropped): {e}")
         # Continue even if database logging fails
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+    finally:
+        if conn:
+            return_db_conn(conn)
+
+
+def flush_activity_logs(cur=None):
+    """
+    リクエスト中に溜めた監査ログを書き込む
+
+    Args:
+        cur: 書き込みに使うカーソル。指定した場合は呼び出し側のトランザクションに含まれ、
+            commit は呼び出し側が行う（rollback すると監査ログも破棄される）。
+            省略した場合は専用の接続で書き込んで commit する。
+    """
+    entries = g.pop('activity_log_entries', None)
+    if not entries:
+        return
+    if cur is None:
+        write_activity_logs(entries)
+    else:
+        insert_activity_logs(cur, entries)
+
+
+@app.teardown_appcontext
+def flush_activity_logs_on_teardown(exc):
+    """リクエスト（アプリケーションコンテキスト）終了時に未書き込みの監査ログと activity.log をまとめて書き込む"""
+    flush_activity_logs()
+    activity_file_buffer.flush()
 
 # --- Password Management ---
 def validate_password_strength(password):
@@ -222,18 +573,19 @@ def set_initial_password():
         with open(PASSWORD_FILE, 'w') as f:
             f.write(hashed_password)
 
+USER_BY_USERNAME_QUERY = register_query('admin_user_by_username', """
+    SELECT id, username, password_hash, is_active, failed_login_attempts, locked_until
+    FROM admin_users
+    WHERE username = %s
+""")
+
 def get_user_by_username(username):
     """Get user from database by username"""
     try:
-        conn = get_db_conn()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT id, username, password_hash, is_active, failed_login_attempts, locked_until
-                FROM admin_users
-                WHERE username = %s
-            """, (username,))
-            user = cur.fetchone()
-        return_db_conn(conn)
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                execute_query(cur, USER_BY_USERNAME_QUERY, (username,))
+                user = cur.fetchone()
         return dict(user) if user else None
     except Exception as e:
         print(f"Error getting user: {e}")
@@ -257,47 +609,46 @@ def check_account_locked(user):
 def record_login_attempt(username, success, ip_address=None):
     """Record login attempt in database"""
     try:
-        conn = get_db_conn()
-        with conn.cursor() as cur:
-            # Record attempt
-            cur.execute("""
-                INSERT INTO login_attempts (username, ip_address, success)
-                VALUES (%s, %s, %s)
-            """, (username, ip_address or request.remote_addr if request else None, success))
-
-            # Update user's failed attempt counter
-            if success:
-                # Reset failed attempts on successful login
-                cur.execute("""
-                    UPDATE admin_users
-                    SET failed_login_attempts = 0,
-                        locked_until = NULL,
-                        last_login = CURRENT_TIMESTAMP
-                    WHERE username = %s
-                """, (username,))
-            else:
-                # Increment failed attempts
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                # Record attempt
                 cur.execute("""
-                    UPDATE admin_users
-                    SET failed_login_attempts = failed_login_attempts + 1
-                    WHERE username = %s
-                """, (username,))
+                    INSERT INTO login_attempts (username, ip_address, success)
+                    VALUES (%s, %s, %s)
+                """, (username, ip_address or request.remote_addr if request else None, success))
 
-                # Check if we need to lock the account
-                cur.execute("""
-                    SELECT failed_login_attempts FROM admin_users WHERE username = %s
-                """, (username,))
-                result = cur.fetchone()
-                if result and result[0] >= MAX_LOGIN_ATTEMPTS:
-                    # Lock account
+                # Update user's failed attempt counter
+                if success:
+                    # Reset failed attempts on successful login
+                    cur.execute("""
+                        UPDATE admin_users
+                        SET failed_login_attempts = 0,
+                            locked_until = NULL,
+                            last_login = CURRENT_TIMESTAMP
+                        WHERE username = %s
+                    """, (username,))
+                else:
+                    # Increment failed attempts
                     cur.execute("""
                         UPDATE admin_users
-                        SET locked_until = CURRENT_TIMESTAMP + INTERVAL '%s minutes'
+                        SET failed_login_attempts = failed_login_attempts + 1
                         WHERE username = %s
-                    """, (LOCKOUT_DURATION_MINUTES, username))
+                    """, (username,))
 
-        conn.commit()
-        return_db_conn(conn)
+                    # Check if we need to lock the account
+                    cur.execute("""
+                        SELECT failed_login_attempts FROM admin_users WHERE username = %s
+                    """, (username,))
+                    result = cur.fetchone()
+                    if result and result[0] >= MAX_LOGIN_ATTEMPTS:
+                        # Lock account
+                        cur.execute("""
+                            UPDATE admin_users
+                            SET locked_until = CURRENT_TIMESTAMP + INTERVAL '%s minutes'
+                            WHERE username = %s
+                        """, (LOCKOUT_DURATION_MINUTES, username))
+
+            conn.commit()
     except Exception as e:
         print(f"Error recording login attempt: {e}")
 
@@ -327,6 +678,10 @@ def store_select():
     ]
     return render_template('store-select.html', stores=stores)
 
+# 店舗ページ（booking-status.html）が一度に取得する期間（表示日の前後）
+STORE_PAGE_DAYS_BEFORE = 7
+STORE_PAGE_DAYS_AFTER = 30
+
 @app.route('/<store>')
 def store_page(store):
     """各店舗の予約状況ページ"""
@@ -348,7 +703,51 @@ def store_page(store):
                          store_name=store_info['name_jp'],
                          max_slots=store_info['max_slots'],
                          rooms=store_info.get('rooms'),
-                         hours=store_info.get('hours', {'start': 0, 'end': 24}))
+                         hours=store_info.get('hours', {'start': 0, 'end': 24}),
+                         window_days_before=STORE_PAGE_DAYS_BEFORE,
+                         window_days_after=STORE_PAGE_DAYS_AFTER,
+                         bootstrap=store_page_bootstrap(store))
+
+def store_page_bootstrap(store):
+    """
+    店舗ページに埋め込む初期表示用の予約データ（今日の前後）
+
+    ページのJSが今日を表示するときに取得するのと同じ期間・同じキャッシュエントリ
+    （/api/reservations?format=columnar）を使うため、初回表示でAPIを呼ばずに済みます。
+    キャッシュに保存するときは conditional_json() と同じ ETag・Last-Modified を付ける
+    （同じエントリを返すAPIのレスポンスで条件付きGETが使えなくならないように）。
+
+    Returns:
+        dict: {"date_from", "date_to", "reservations": 列形式の予約}。取得できない場合はNone
+    """
+    today = today_jst()
+    date_from = (today - timedelta(days=STORE_PAGE_DAYS_BEFORE)).strftime('%Y-%m-%d')
+    date_to = (today + timedelta(days=STORE_PAGE_DAYS_AFTER)).strftime('%Y-%m-%d')
+
+    cache_key = reservations_cache_key(store, date_from, date_to, columnar=True)
+    sticky = read_from_primary()
+    cached = read_cache.get(cache_key)
+    if cached is not None and not sticky:
+        return {'date_from': date_from, 'date_to': date_to, 'reservations': cached[2]}
+
+    # 管理者が書き込んだ直後は、キャッシュが変更カウンタ（プライマリ）と一致する場合だけ使う
+    # （別のインスタンスでの書き込みでは、このインスタンスのキャッシュは無効化されていない）
+    generation = read_cache.generation
+    try:
+        # データより先に変更カウンタを読む（ETag がデータより新しくならないように）
+        versions = fetch_store_versions([store])
+        etag, last_modified = versions_etag(cache_key, versions) if versions is not None else (None, None)
+        if cached is not None and etag is not None and cached[0] == etag:
+            return {'date_from': date_from, 'date_to': date_to, 'reservations': cached[2]}
+        payload = load_columnar_reservations(store, date_from, date_to)
+    except Exception as e:
+        # 埋め込みに失敗してもページはAPIから取得して表示できる
+        print(f"⚠️  Could not load bootstrap reservations for {store}: {e}")
+        return None
+    read_cache.set(cache_key, (etag, last_modified, payload), date_window_scopes(store, date_from, date_to),
+                   generation)
+
+    return {'date_from': date_from, 'date_to': date_to, 'reservations': payload}
 
 @app.route('/search')
 def integrated_search():
@@ -460,35 +859,33 @@ def admin_page():
     # Get logs from database
     logs = []
     try:
-        conn = get_db_conn()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT username, action, ip_address, created_at
-                FROM activity_logs
-                ORDER BY created_at DESC
-                LIMIT 100
-            """)
-            db_logs = cur.fetchall()
-
-            # Format logs for display (convert to JST)
-            from datetime import timezone, timedelta
-            jst = timezone(timedelta(hours=9))
-
-            for log in db_logs:
-                # Convert UTC to JST
-                created_at_utc = log['created_at']
-                if created_at_utc.tzinfo is None:
-                    # If timezone-naive, assume UTC
-                    created_at_utc = created_at_utc.replace(tzinfo=timezone.utc)
-                created_at_jst = created_at_utc.astimezone(jst)
-
-                timestamp = created_at_jst.strftime('%Y-%m-%d %H:%M:%S JST')
-                username = log['username'] or 'Unknown'
-                action = log['action']
-                ip = log['ip_address'] or 'N/A'
-                logs.append(f"{timestamp} - User: {username} - Action: {action} - IP: {ip}")
-
-        return_db_conn(conn)
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT username, action, ip_address, created_at
+                    FROM activity_logs
+                    ORDER BY created_at DESC
+                    LIMIT 100
+                """)
+                db_logs = cur.fetchall()
+
+                # Format logs for display (convert to JST)
+                from datetime import timezone, timedelta
+                jst = timezone(timedelta(hours=9))
+
+                for log in db_logs:
+                    # Convert UTC to JST
+                    created_at_utc = log['created_at']
+                    if created_at_utc.tzinfo is None:
+                        # If timezone-naive, assume UTC
+                        created_at_utc = created_at_utc.replace(tzinfo=timezone.utc)
+                    created_at_jst = created_at_utc.astimezone(jst)
+
+                    timestamp = created_at_jst.strftime('%Y-%m-%d %H:%M:%S JST')
+                    username = log['username'] or 'Unknown'
+                    action = log['action']
+                    ip = log['ip_address'] or 'N/A'
+                    logs.append(f"{timestamp} - User: {username} - Action: {action} - IP: {ip}")
     except Exception as e:
         print(f"Error loading logs from database: {e}")
         # Fallback to file logs
@@ -550,15 +947,14 @@ def change_password():
     # Update password in database
     try:
         username = session.get('username', 'admin')
-        conn = get_db_conn()
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE admin_users
-                SET password_hash = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE username = %s
-            """, (hashed_password, username))
-        conn.commit()
-        return_db_conn(conn)
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE admin_users
+                    SET password_hash = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE username = %s
+                """, (hashed_password, username))
+            conn.commit()
 
         log_activity('Password changed', username=username)
         flash('パスワードが正常に変更されました。', 'success')
@@ -583,50 +979,48 @@ def run_migration_endpoint():
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = get_db_conn()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Check if tables already exist
-            cur.execute("""
-                SELECT table_name
-                FROM information_schema.tables
-                WHERE table_schema = 'public'
-                AND table_name IN ('admin_users', 'activity_logs', 'login_attempts')
-            """)
-            existing_tables = [row['table_name'] for row in cur.fetchall()]
-
-            if len(existing_tables) == 3:
-                return jsonify({
-                    'status': 'warning',
-                    'message': 'マイグレーションは既に実行されています。',
-                    'tables': existing_tables
-                })
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Check if tables already exist
+                cur.execute("""
+                    SELECT table_name
+                    FROM information_schema.tables
+                    WHERE table_schema = 'public'
+                    AND table_name IN ('admin_users', 'activity_logs', 'login_attempts')
+                """)
+                existing_tables = [row['table_name'] for row in cur.fetchall()]
 
-            # Read migration file
-            migration_file = 'migrations/001_add_security_tables.sql'
-            with open(migration_file, 'r') as f:
-                sql = f.read()
+                if len(existing_tables) == 3:
+                    return jsonify({
+                        'status': 'warning',
+                        'message': 'マイグレーションは既に実行されています。',
+                        'tables': existing_tables
+                    })
 
-            # Execute migration
-            cur.execute(sql)
+                # Read migration file
+                migration_file = 'migrations/001_add_security_tables.sql'
+                with open(migration_file, 'r') as f:
+                    sql = f.read()
 
-        conn.commit()
+                # Execute migration
+                cur.execute(sql)
 
-        # Verify tables were created
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT table_name
-                FROM information_schema.tables
-                WHERE table_schema = 'public'
-                AND table_name IN ('admin_users', 'activity_logs', 'login_attempts')
-                ORDER BY table_name
-            """)
-            tables = [row['table_name'] for row in cur.fetchall()]
+            conn.commit()
 
-            # Check default admin user
-            cur.execute("SELECT username, created_at FROM admin_users WHERE username = 'admin'")
-            admin = cur.fetchone()
+            # Verify tables were created
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT table_name
+                    FROM information_schema.tables
+                    WHERE table_schema = 'public'
+                    AND table_name IN ('admin_users', 'activity_logs', 'login_attempts')
+                    ORDER BY table_name
+                """)
+                tables = [row['table_name'] for row in cur.fetchall()]
 
-        return_db_conn(conn)
+                # Check default admin user
+                cur.execute("SELECT username, created_at FROM admin_users WHERE username = 'admin'")
+                admin = cur.fetchone()
 
         log_activity('Database migration completed', username=session.get('username'))
 
@@ -638,10 +1032,6 @@ def run_migration_endpoint():
         })
 
     except Exception as e:
-        if 'conn' in locals():
-            conn.rollback()
-            return_db_conn(conn)
-
         log_activity(f'Migration failed: {str(e)}', username=session.get('username'))
 
         return jsonify({
@@ -649,131 +1039,786 @@ def run_migration_endpoint():
             'message': f'マイグレーションに失敗しました: {str(e)}'
         }), 500
 
-# --- API Endpoints ---
-@app.route('/api/reservations')
-def get_reservations():
-    """予約データを取得（日付でグループ化）"""
-    debug_mode = request.args.get('debug') == '1'
-    store_filter = request.args.get('store')  # 店舗パラメータ（オプション）
+# --- Conditional GET (ETag / Last-Modified) ---
+def fetch_store_versions(stores=None):
+    """
+    店舗ごとの変更カウンタを取得（reservation_versions テーブル、予約への書き込みでトリガーが更新）
 
-    # 店舗バリデーション（指定されている場合のみ）
-    if store_filter and store_filter not in STORE_CONFIG:
-        return jsonify({'error': f'Invalid store: {store_filter}'}), 400
+    Args:
+        stores (list): 店舗IDのリスト（Noneの場合は全店舗）
 
-    conn = get_db_conn()
+    Returns:
+        dict: {店舗ID: (version, updated_at)}。テーブル未作成などで取得できない場合はNone
+    """
+    conn = get_read_db_conn()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # デバッグモード：総件数を取得
-            if debug_mode:
-                if store_filter:
-                    cur.execute("SELECT COUNT(*) as total FROM reservations WHERE store = %s", (store_filter,))
-                else:
-                    cur.execute("SELECT COUNT(*) as total FROM reservations")
-                total_count = cur.fetchone()['total']
-
-            # クエリ：店舗フィルタがあれば特定店舗、なければ全店舗
-            if store_filter:
+        with conn.cursor() as cur:
+            if stores:
                 cur.execute("""
-                    SELECT id, date, start_time, end_time, customer_name, type, is_cancellation, store, room_name
-                    FROM reservations
-                    WHERE store = %s
-                    ORDER BY date, start_time
-                """, (store_filter,))
+                    SELECT store, version, updated_at FROM reservation_versions
+                    WHERE store = ANY(%s)
+                """, (list(stores),))
             else:
-                cur.execute("""
-                    SELECT id, date, start_time, end_time, customer_name, type, is_cancellation, store, room_name
-                    FROM reservations
-                    ORDER BY date, start_time
-                """)
-            rows = cur.fetchall()
+                cur.execute("SELECT store, version, updated_at FROM reservation_versions")
+            return {store: (version, updated_at) for store, version, updated_at in cur.fetchall()}
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"⚠️  Could not read reservation versions: {e}")
+        return None
+    finally:
+        return_db_conn(conn)
 
-        # 日付でグループ化
-        reservations_db = {}
-        for row in rows:
-            date_str = row['date'].strftime('%Y-%m-%d')
-            if date_str not in reservations_db:
-                reservations_db[date_str] = []
+def make_json_response(etag, last_modified, payload):
+    """
+    ETag / Last-Modified 付きのJSONレスポンス（ブラウザには毎回再検証させる）
 
-            # 店舗情報を含める
-            store_id = row['store']
-            store_name = STORE_CONFIG.get(store_id, {}).get('name_jp', store_id)
+    payload が文字列の場合は組み立て済みのJSONとしてそのまま返す
+    """
+    if isinstance(payload, str):
+        response = app.response_class(payload, mimetype='application/json')
+    else:
+        response = jsonify(payload)
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-            reservations_db[date_str].append({
-                'id': row['id'],
-                'type': row['type'],
-                'start': row['start_time'].strftime('%H:%M'),
-                'end': row['end_time'].strftime('%H:%M'),
-                'customer_name': row['customer_name'],
-                'store_id': store_id,
-                'store_name': store_name,
-                'room_name': row.get('room_name', '個室B')
-            })
+def versions_etag(cache_key, versions):
+    """
+    キャッシュキーと店舗の変更カウンタから ETag・Last-Modified を計算
 
-        # デバッグ情報を追加
-        if debug_mode:
-            return jsonify({
-                'debug': {
-                    'postgres_url_exists': bool(os.environ.get('POSTGRES_URL')),
-                    'total_reservations': total_count,
-                    'filtered_reservations': len(rows),
-                    'store_filter': store_filter or 'all',
-                    'code_version': 'v5_multi_store_support'
-                },
-                'reservations': reservations_db
-            })
+    Args:
+        cache_key (tuple): キャッシュキー
+        versions (dict): fetch_store_versions() の結果
 
-        return jsonify(reservations_db)
-    finally:
-        return_db_conn(conn)
+    Returns:
+        tuple: (etag, last_modified)
+    """
+    version_key = sorted((store, version) for store, (version, _) in versions.items())
+    etag = hashlib.sha1(repr((cache_key, version_key)).encode()).hexdigest()[:32]
+    last_modified = max((updated_at for _, updated_at in versions.values()), default=None)
+    return etag, last_modified
 
-@app.route('/api/reservations', methods=['POST'])
-def add_reservation():
-    """手動で予約を追加"""
-    if not is_logged_in():
-        return jsonify({'error': 'Unauthorized'}), 401
+def conditional_json(cache_key, scopes, stores, compute):
+    """
+    読み取りAPIのレスポンスをキャッシュ・条件付きGET付きで返す
+
+    - 条件なしのリクエスト: キャッシュがあればDBに触れずに返す
+    - If-None-Match / If-Modified-Since 付き: 店舗の変更カウンタだけを取得し、
+      変更がなければ本体のクエリもシリアライズもせずに304を返す
+    - 管理者が書き込んだ直後（read_from_primary()）: キャッシュは変更カウンタ（プライマリ）と一致する場合だけ使う。
+      別のインスタンスで書き込んだ場合、このインスタンスのキャッシュは無効化されていないため
+
+    Args:
+        cache_key (tuple): キャッシュキー
+        scopes (list): キャッシュの無効化スコープ (店舗, 日付) のリスト
+        stores (list): レスポンスが依存する店舗ID（Noneの場合は全店舗）
+        compute (callable): レスポンス本体（dict、または組み立て済みのJSON文字列）を計算する関数
+    """
+    conditional = bool(request.if_none_match) or request.if_modified_since is not None
+    sticky = read_from_primary()
+    cached = read_cache.get(cache_key)
+    if cached is not None and not conditional and not sticky:
+        return make_json_response(*cached)
+
+    generation = read_cache.generation
+    versions = fetch_store_versions(stores)
+    if versions is None:
+        # 変更カウンタが使えない場合は従来どおり返す
+        if cached is not None and not sticky:
+            return make_json_response(*cached)
+        payload = compute()
+        read_cache.set(cache_key, (None, None, payload), scopes, generation)
+        return make_json_response(None, None, payload)
+
+    etag, last_modified = versions_etag(cache_key, versions)
+
+    if conditional:
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = (last_modified is not None and
+                            request.if_modified_since >= last_modified.replace(microsecond=0))
+        if not_modified:
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+    if cached is not None and cached[0] == etag:
+        return make_json_response(*cached)
+
+    payload = compute()
+    read_cache.set(cache_key, (etag, last_modified, payload), scopes, generation)
+    return make_json_response(etag, last_modified, payload)
 
-    data = request.json
-    store = data.get('store', 'shibuya')  # 店舗パラメータ取得
+# --- API Endpoints ---
+# /api/reservations の既定の取得期間（今日の前後）
+RESERVATIONS_DAYS_BEFORE = 7
+RESERVATIONS_DAYS_AFTER = 60
+# 期間検索で指定できる最大日数
+MAX_RANGE_DAYS = 62
+# /api/reservations のページング時の最大件数
+MAX_RESERVATIONS_PAGE_SIZE = 1000
+
+def today_jst():
+    """日本時間の今日の日付"""
+    from datetime import timezone
+    return datetime.now(timezone(timedelta(hours=9))).date()
+
+def parse_date_window(date_from, date_to):
+    """
+    取得期間パラメータを検証して (開始日, 終了日) の文字列を返す
 
-    # 店舗バリデーション
-    if store not in STORE_CONFIG:
-        return jsonify({'error': f'Invalid store: {store}'}), 400
+    省略時は今日の RESERVATIONS_DAYS_BEFORE 日前から RESERVATIONS_DAYS_AFTER 日後まで。
 
-    conn = get_db_conn()
+    Raises:
+        ValueError: 日付形式が不正、または終了日が開始日より前の場合
+    """
+    today = today_jst()
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (
-                data.get('date'),
-                data.get('start'),
-                data.get('end'),
-                data.get('customer_name', 'N/A'),
-                data.get('room_name', '個室B'),  # room_nameを追加
-                store,
-                data.get('type', 'manual')
-            ))
-        conn.commit()
+        first_day = (datetime.strptime(date_from, '%Y-%m-%d').date() if date_from
+                     else today - timedelta(days=RESERVATIONS_DAYS_BEFORE))
+        last_day = (datetime.strptime(date_to, '%Y-%m-%d').date() if date_to
+                    else max(today + timedelta(days=RESERVATIONS_DAYS_AFTER), first_day))
+    except ValueError:
+        raise ValueError('Invalid date format (YYYY-MM-DD)')
+    if last_day < first_day:
+        raise ValueError('date_to must be on or after date_from')
+    return first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')
+
+def date_window_scopes(store, date_from, date_to, max_days=MAX_RANGE_DAYS):
+    """期間に含まれる (店舗, 日付) のキャッシュスコープ（長い期間は店舗全体）"""
+    first_day = datetime.strptime(date_from, '%Y-%m-%d').date()
+    num_days = (datetime.strptime(date_to, '%Y-%m-%d').date() - first_day).days + 1
+    if num_days > max_days:
+        return [(store, None)]
+    return [(store, (first_day + timedelta(days=i)).strftime('%Y-%m-%d')) for i in range(num_days)]
+
+def encode_reservation_cursor(res_date, start_time, reservation_id):
+    """ページング用カーソル（最後の行の 日付|開始時刻|ID）を作成"""
+    raw = f"{res_date.strftime('%Y-%m-%d')}|{start_time.strftime('%H:%M:%S')}|{reservation_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_reservation_cursor(cursor):
+    """
+    ページング用カーソルを (日付, 開始時刻, ID) に戻す
 
-        # Google Calendar同期（GAS側で実行しているため、Vercel側からは不要）
-        # GASが ebisu@topform.jp のカレンダーに直接書き込み
-        # if store in ['ebisu', 'hanzomon']:
-        #     add_to_calendar(
-        #         store=store,
-        #         date=data.get('date'),
-        #         start_time=data.get('start'),
-        #         end_time=data.get('end'),
-        #         customer_name=data.get('customer_name', 'N/A')
-        #     )
+    Raises:
+        ValueError: カーソルが不正な場合
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        res_date, start_time, reservation_id = raw.split('|')
+        datetime.strptime(res_date, '%Y-%m-%d')
+        datetime.strptime(start_time, '%H:%M:%S')
+        return res_date, start_time, int(reservation_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def reservation_rows_query(date_from, date_to, store=None, after=None, limit=None):
+    """
+    期間内の予約行を日付・開始時刻・ID順に取得するクエリを作成
 
-        log_activity(f"Manual reservation added: {data}")
-        return jsonify({'message': 'Reservation added'})
-    except Exception as e:
-        conn.rollback()
-        return jsonify({'error': str(e)}), 500
-    finally:
-        return_db_conn(conn)
+    Args:
+        date_from (str): 開始日 (YYYY-MM-DD)
+        date_to (str): 終了日 (YYYY-MM-DD、この日を含む)
+        store (str): 店舗ID（Noneの場合は全店舗）
+        after (tuple): この (日付, 開始時刻, ID) より後の行だけを取得（キーセットページング）
+        limit (int): 最大件数
+
+    Returns:
+        tuple: (クエリ, パラメータ)
+    """
+    conditions = ['date BETWEEN %s AND %s']
+    params = [date_from, date_to]
+    if store:
+        conditions.append('store = %s')
+        params.append(store)
+    if after:
+        conditions.append('(date, start_time, id) > (%s, %s, %s)')
+        params.extend(after)
+    query = f"""
+        SELECT id, date, start_time, end_time, customer_name, type, is_cancellation, store, room_name
+        FROM reservations
+        WHERE {' AND '.join(conditions)}
+        ORDER BY date, start_time, id
+    """
+    if limit:
+        query += ' LIMIT %s'
+        params.append(limit)
+    return query, params
+
+def fetch_reservation_rows(cur, date_from, date_to, store=None, after=None, limit=None):
+    """期間内の予約行を日付・開始時刻・ID順に取得（引数は reservation_rows_query と同じ）"""
+    query, params = reservation_rows_query(date_from, date_to, store, after, limit)
+    # 条件の組み合わせごとに別の名前で登録（プリペアドステートメント）
+    name = 'reservation_rows' + ''.join(suffix for suffix, used in
+                                        (('_store', store), ('_after', after), ('_limit', limit)) if used)
+    execute_query(cur, register_query(name, query), params)
+    return cur.fetchall()
+
+def reservation_to_dict(row):
+    """予約行をAPIの予約オブジェクトに変換"""
+    store_id = row['store']
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'start': row['start_time'].strftime('%H:%M'),
+        'end': row['end_time'].strftime('%H:%M'),
+        'customer_name': row['customer_name'],
+        'store_id': store_id,
+        'store_name': STORE_CONFIG.get(store_id, {}).get('name_jp', store_id),
+        'room_name': row.get('room_name', '個室B')
+    }
+
+def group_reservation_rows(rows):
+    """予約行を日付でグループ化し、APIの予約オブジェクトに変換"""
+    reservations_db = {}
+    for row in rows:
+        date_str = row['date'].strftime('%Y-%m-%d')
+        if date_str not in reservations_db:
+            reservations_db[date_str] = []
+        reservations_db[date_str].append(reservation_to_dict(row))
+    return reservations_db
+
+def columnar_reservation_rows(rows):
+    """
+    予約行を日付ごとの列形式（?format=columnar）に変換
+
+    店舗ID・種別・部屋名は1つの辞書テーブル strings へのインデックス（部屋なしはnull）、
+    開始・終了は0時からの分で表し、キーの繰り返しをなくしてレスポンスを小さくします。
+
+    Returns:
+        dict: {
+            "format": "columnar",
+            "strings": ["shibuya", "gmail", "STUDIO ①", ...],
+            "stores": {"shibuya": "渋谷店"},
+            "dates": {"2025-12-01": {"id": [...], "start": [600, ...], "end": [...],
+                                     "store": [0, ...], "type": [1, ...], "room": [2, null, ...],
+                                     "customer_name": [...]}}
+        }
+    """
+    strings = []
+    codes = {}
+
+    def code(value):
+        if value is None:
+            return None
+        if value not in codes:
+            codes[value] = len(strings)
+            strings.append(value)
+        return codes[value]
+
+    dates = {}
+    stores = {}
+    for row in rows:
+        date_str = row['date'].strftime('%Y-%m-%d')
+        columns = dates.get(date_str)
+        if columns is None:
+            columns = dates[date_str] = {
+                'id': [], 'start': [], 'end': [], 'store': [], 'type': [], 'room': [], 'customer_name': []
+            }
+        store_id = row['store']
+        if store_id not in stores:
+            stores[store_id] = STORE_CONFIG.get(store_id, {}).get('name_jp', store_id)
+        columns['id'].append(row['id'])
+        columns['start'].append(row['start_time'].hour * 60 + row['start_time'].minute)
+        columns['end'].append(row['end_time'].hour * 60 + row['end_time'].minute)
+        columns['store'].append(code(store_id))
+        columns['type'].append(code(row['type']))
+        columns['room'].append(code(row['room_name']))
+        columns['customer_name'].append(row['customer_name'])
+
+    return {'format': 'columnar', 'strings': strings, 'stores': stores, 'dates': dates}
+
+def reservations_cache_key(store, date_from, date_to, limit=None, cursor=None, columnar=False):
+    """/api/reservations のキャッシュキー（店舗ページの埋め込みデータと共有）"""
+    return ('reservations', store, None, (date_from, date_to, limit, cursor, columnar))
+
+def load_columnar_reservations(store, date_from, date_to):
+    """期間内の予約を列形式で取得"""
+    conn = get_read_db_conn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            return columnar_reservation_rows(fetch_reservation_rows(cur, date_from, date_to, store))
+    finally:
+        return_db_conn(conn)
+
+# ストリーミング出力でサーバー側カーソルから1回に取得する行数
+STREAM_ITERSIZE = 2000
+
+def stream_reservation_rows(date_from, date_to, store=None, ndjson=False, primary=False):
+    """
+    予約をサーバー側カーソル（名前付きカーソル）で少しずつ読み、JSONを逐次出力するジェネレータ
+
+    全件をメモリに載せないため、件数が増えてもメモリ使用量は STREAM_ITERSIZE 行分で一定です。
+    接続はストリームの終了時（クライアント切断を含む）にプールへ返します。
+
+    Args:
+        ndjson (bool): Trueの場合は1行1予約のNDJSON（各行に date を含む）、
+                       Falseの場合は通常の /api/reservations と同じ日付グループのJSON
+        primary (bool): Trueならリードレプリカではなくプライマリから読む（read_from_primary() の結果）
+
+    Yields:
+        str: レスポンスの断片（最大 STREAM_ITERSIZE 行分ずつ）
+    """
+    # レスポンスの出力中（リクエストのコンテキストの外）に取得するため、集計用の名前を指定
+    conn = get_read_db_conn(label='get_reservations (stream)', primary=primary)
+    try:
+        with conn.cursor(name='reservations_stream', cursor_factory=RealDictCursor) as cur:
+            cur.itersize = STREAM_ITERSIZE
+            cur.execute(*reservation_rows_query(date_from, date_to, store))
+
+            current_date = None
+            chunk = [] if ndjson else ['{']
+            for row in cur:
+                date_str = row['date'].strftime('%Y-%m-%d')
+                reservation = reservation_to_dict(row)
+                if ndjson:
+                    reservation['date'] = date_str
+                    chunk.append(json.dumps(reservation, ensure_ascii=False) + '\n')
+                else:
+                    if date_str != current_date:
+                        # 行は日付順なので、日付が変わったら次のグループを開始
+                        if current_date is not None:
+                            chunk.append('],')
+                        chunk.append(json.dumps(date_str) + ':[')
+                        current_date = date_str
+                    else:
+                        chunk.append(',')
+                    chunk.append(json.dumps(reservation, ensure_ascii=False))
+                if len(chunk) >= STREAM_ITERSIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+
+            if not ndjson:
+                chunk.append(']}' if current_date is not None else '}')
+            if chunk:
+                yield ''.join(chunk)
+    finally:
+        # 名前付きカーソルのトランザクションを終了してからプールに返す
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        return_db_conn(conn)
+
+def fetch_reservations_json(cur, date_from, date_to, store=None):
+    """
+    日付でグループ化した予約JSONをPostgreSQL側で組み立てて取得
+
+    group_reservation_rows() と同じ内容のドキュメントを json_object_agg / json_agg で作るため、
+    Python側では行ごとのdict作成・strftime・シリアライズが不要になります。
+
+    Returns:
+        str: {"YYYY-MM-DD": [予約, ...], ...} のJSON文字列
+    """
+    store_names = {store_id: info.get('name_jp', store_id) for store_id, info in STORE_CONFIG.items()}
+    store_condition = 'AND store = %(store)s' if store else ''
+    query = register_query('reservations_json_store' if store else 'reservations_json', f"""
+        SELECT COALESCE(json_object_agg(day, items ORDER BY day), '{{}}'::json)::text
+        FROM (
+            SELECT to_char(date, 'YYYY-MM-DD') AS day,
+                   json_agg(json_build_object(
+                       'customer_name', customer_name,
+                       'end', to_char(end_time, 'HH24:MI'),
+                       'id', id,
+                       'room_name', room_name,
+                       'start', to_char(start_time, 'HH24:MI'),
+                       'store_id', store,
+                       'store_name', COALESCE(%(store_names)s::json ->> store, store),
+                       'type', type
+                   ) ORDER BY start_time, id) AS items
+            FROM reservations
+            WHERE date BETWEEN %(date_from)s AND %(date_to)s
+            {store_condition}
+            GROUP BY date
+        ) days
+    """)
+    execute_query(cur, query, {
+        'store_names': json.dumps(store_names),
+        'date_from': date_from,
+        'date_to': date_to,
+        'store': store
+    })
+    return cur.fetchone()[0]
+
+@app.route('/api/reservations')
+def get_reservations():
+    """
+    予約データを取得（日付でグループ化）
+
+    Query Parameters:
+    - store: 店舗ID（省略時は全店舗）
+    - date_from: 取得開始日 (YYYY-MM-DD、省略時は今日の7日前)
+    - date_to: 取得終了日 (YYYY-MM-DD、この日を含む。省略時は今日の60日後)
+    - limit: 1ページの最大件数（指定時はページング形式で返す）
+    - cursor: 前のページの next_cursor
+    - stream: 1 の場合、同じ形式のJSONをサーバー側カーソルから逐次出力（大量データのエクスポート用）
+    - format: ndjson の場合、1行1予約のNDJSONを逐次出力（各行に date を含む）
+    - format: columnar の場合、日付ごとの列形式で返す（columnar_reservation_rows を参照）
+
+    Response（limit指定時）:
+    {
+        "reservations": {"2025-12-01": [...]},
+        "next_cursor": "MjAyNS0xMi0wMXwxMDowMHwxMjM"  // 最終ページはnull
+    }
+    """
+    debug_mode = request.args.get('debug') == '1'
+    store_filter = request.args.get('store')  # 店舗パラメータ（オプション）
+
+    # 店舗バリデーション（指定されている場合のみ）
+    if store_filter and store_filter not in STORE_CONFIG:
+        return jsonify({'error': f'Invalid store: {store_filter}'}), 400
+
+    # 取得期間（省略時は今日の前後）
+    try:
+        date_from, date_to = parse_date_window(request.args.get('date_from'), request.args.get('date_to'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # ページング（キーセット方式: 日付・開始時刻・IDの続きから取得）
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    try:
+        limit = min(int(limit), MAX_RESERVATIONS_PAGE_SIZE) if limit else None
+        after = decode_reservation_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+
+    # ストリーミング出力（大量データのエクスポート用、キャッシュは使わない）
+    response_format = request.args.get('format')
+    if response_format == 'ndjson' or request.args.get('stream') == '1':
+        if limit or cursor:
+            return jsonify({'error': 'limit/cursor cannot be used with streaming'}), 400
+        ndjson = response_format == 'ndjson'
+        return app.response_class(
+            stream_reservation_rows(date_from, date_to, store_filter, ndjson, read_from_primary()),
+            mimetype='application/x-ndjson' if ndjson else 'application/json'
+        )
+
+    columnar = response_format == 'columnar'
+    if columnar and (limit or cursor):
+        return jsonify({'error': 'limit/cursor cannot be used with format=columnar'}), 400
+
+    def load(fast=True):
+        if columnar:
+            return load_columnar_reservations(store_filter, date_from, date_to)
+        conn = get_read_db_conn()
+        try:
+            if fast and not limit:
+                # 全件取得はPostgreSQLが組み立てたJSONをそのまま返す
+                with conn.cursor() as cur:
+                    return fetch_reservations_json(cur, date_from, date_to, store_filter)
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                rows = fetch_reservation_rows(cur, date_from, date_to, store_filter, after,
+                                              limit + 1 if limit else None)
+        finally:
+            return_db_conn(conn)
+
+        # 次のページがあるか判定するため1件多く取得している
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_reservation_cursor(last['date'], last['start_time'], last['id'])
+
+        reservations_db = group_reservation_rows(rows)
+        if limit:
+            return {'reservations': reservations_db, 'next_cursor': next_cursor}
+        return reservations_db
+
+    # デバッグモード：総件数を含めて返す（キャッシュ・条件付きGETは使わない）
+    if debug_mode and not columnar:
+        conn = get_db_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if store_filter:
+                    cur.execute("SELECT COUNT(*) as total FROM reservations WHERE store = %s", (store_filter,))
+                else:
+                    cur.execute("SELECT COUNT(*) as total FROM reservations")
+                total_count = cur.fetchone()['total']
+        finally:
+            return_db_conn(conn)
+
+        result = load(fast=False)
+        reservations_db = result['reservations'] if limit else result
+        return jsonify({
+            'debug': {
+                'postgres_url_exists': bool(os.environ.get('POSTGRES_URL')),
+                'total_reservations': total_count,
+                'filtered_reservations': sum(len(v) for v in reservations_db.values()),
+                'store_filter': store_filter or 'all',
+                'date_from': date_from,
+                'date_to': date_to,
+                'next_cursor': result.get('next_cursor') if limit else None,
+                'code_version': 'v6_date_window'
+            },
+            'reservations': reservations_db
+        })
+
+    # 通常モードはキャッシュと条件付きGET（ETag / Last-Modified）を利用
+    return conditional_json(
+        reservations_cache_key(store_filter, date_from, date_to, limit, cursor, columnar),
+        date_window_scopes(store_filter, date_from, date_to),
+        [store_filter] if store_filter else None,
+        load
+    )
+
+# /api/reservations/changes の1ページの件数（デフォルト・最大）
+CHANGES_PAGE_SIZE = 500
+MAX_CHANGES_PAGE_SIZE = 1000
+# 差分同期のカーソルの有効期間（日）。これより古いカーソルは 410 を返し、クライアントは since なしで取り直す
+CHANGES_RETENTION_DAYS = 30
+# 削除履歴（reservation_tombstones）は有効期間 + 1日（長いトランザクションの余裕）を過ぎたら削除する
+# 削除は /api/reservations/changes の中で、プロセスごとに CHANGES_PRUNE_INTERVAL_SECONDS 秒に1回
+CHANGES_PRUNE_INTERVAL_SECONDS = 3600
+# 最後に削除履歴を削除した time.monotonic()
+tombstones_pruned_at = None
+
+def encode_change_cursor(change_txid, change_seq, issued_at=None):
+    """差分同期用カーソル（変更キー トランザクションID|連番|発行時刻（UNIX時刻））を作成"""
+    raw = f"{change_txid}|{change_seq}|{int(time.time() if issued_at is None else issued_at)}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_change_cursor(cursor):
+    """
+    差分同期用カーソルを (トランザクションID, 連番, 発行時刻) に戻す
+
+    発行時刻を含まない以前の形式のカーソルは発行時刻が None（期限切れとして扱う）。
+
+    Raises:
+        ValueError: カーソルが不正な場合
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        parts = [int(part) for part in raw.split('|')]
+        if len(parts) == 2:
+            return parts[0], parts[1], None
+        change_txid, change_seq, issued_at = parts
+        return change_txid, change_seq, issued_at
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def prune_reservation_tombstones(conn):
+    """
+    保持期間（CHANGES_RETENTION_DAYS + 1日）を過ぎた削除履歴を削除してコミット
+
+    CHANGES_PRUNE_INTERVAL_SECONDS 秒以内に削除済みなら何もしない。
+    有効なカーソル（発行から CHANGES_RETENTION_DAYS 日以内）より後の削除履歴は残るため、
+    差分同期で削除を取りこぼすことはない。
+
+    Returns:
+        int: 削除した件数
+    """
+    global tombstones_pruned_at
+    now = time.monotonic()
+    if tombstones_pruned_at is not None and now - tombstones_pruned_at < CHANGES_PRUNE_INTERVAL_SECONDS:
+        return 0
+    tombstones_pruned_at = now
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM reservation_tombstones
+            WHERE deleted_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+        """, (CHANGES_RETENTION_DAYS + 1,))
+        deleted = cur.rowcount
+    conn.commit()
+    if deleted:
+        print(f'[DEBUG] Pruned {deleted} reservation tombstones older than {CHANGES_RETENTION_DAYS + 1} days')
+    return deleted
+
+@app.route('/api/reservations/changes')
+def get_reservation_changes():
+    """
+    前回取得以降に追加・更新・削除された予約だけを返す（差分同期）
+
+    クライアントは予約のローカルコピーを持ち、返された変更を順番に適用します。
+    - op = "upsert": 同じIDの予約を置き換え（なければ追加）
+    - op = "delete": 同じIDの予約を削除
+    同じ変更が2回返ることはありませんが、適用は冪等にしておくこと。
+
+    削除履歴は CHANGES_RETENTION_DAYS 日（+1日）だけ保持するため、カーソルの有効期間は発行から
+    CHANGES_RETENTION_DAYS 日です。期限が切れたカーソルには 410 を返すので、クライアントはローカルコピーを
+    捨てて since なしで取り直します（全件の再同期）。
+
+    Query Parameters:
+    - since: 前回の next_cursor（省略時は最初から＝全予約と保持期間内の削除履歴）
+    - store: 店舗ID（省略時は全店舗）
+    - limit: 1ページの最大件数（デフォルト500、最大1000）
+
+    Response:
+    {
+        "changes": [
+            {"op": "upsert", "id": 123, "date": "2025-12-01", "start": "10:00", ...},
+            {"op": "delete", "id": 120, "date": "2025-12-01", "store_id": "shibuya", ...}
+        ],
+        "next_cursor": "Nzc0fDIzNQ",
+        "has_more": false  // trueの場合はすぐに next_cursor で続きを取得
+    }
+
+    410（カーソルの期限切れ）:
+    {"error": "Cursor expired, resync without since", "retention_days": 30}
+    """
+    store_filter = request.args.get('store')
+    if store_filter and store_filter not in STORE_CONFIG:
+        return jsonify({'error': f'Invalid store: {store_filter}'}), 400
+
+    try:
+        since = decode_change_cursor(request.args['since']) if request.args.get('since') else (0, 0, time.time())
+        limit = int(request.args.get('limit', CHANGES_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not 1 <= limit <= MAX_CHANGES_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_CHANGES_PAGE_SIZE}'}), 400
+    # カーソルより後の削除履歴が削除されている可能性がある場合は全件の再同期が必要
+    issued_at = since[2]
+    if issued_at is None or issued_at < time.time() - CHANGES_RETENTION_DAYS * 86400:
+        return jsonify({
+            'error': 'Cursor expired, resync without since',
+            'retention_days': CHANGES_RETENTION_DAYS
+        }), 410
+    since = since[:2]
+
+    conn = get_db_conn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # 実行中の全トランザクションより古い変更だけを返す
+            # （遅れてコミットされた変更をカーソルが追い越して取りこぼさないため）
+            cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS horizon")
+            horizon = int(cur.fetchone()['horizon'])
+
+            store_condition = 'AND store = %(store)s' if store_filter else ''
+            cur.execute(f"""
+                SELECT * FROM (
+                    SELECT 'upsert' AS op, change_txid::text::bigint AS change_txid, change_seq,
+                           id, date, start_time, end_time, customer_name, type, store, room_name,
+                           updated_at AS changed_at
+                    FROM reservations
+                    WHERE (change_txid, change_seq) > (%(txid)s::text::xid8, %(seq)s)
+                    AND change_txid < %(horizon)s::text::xid8
+                    {store_condition}
+                    UNION ALL
+                    SELECT 'delete', change_txid::text::bigint, change_seq,
+                           reservation_id, date, NULL, NULL, NULL, NULL, store, NULL,
+                           deleted_at
+                    FROM reservation_tombstones
+                    WHERE (change_txid, change_seq) > (%(txid)s::text::xid8, %(seq)s)
+                    AND change_txid < %(horizon)s::text::xid8
+                    {store_condition}
+                ) changes
+                ORDER BY change_txid, change_seq
+                LIMIT %(limit)s
+            """, {
+                'txid': since[0], 'seq': since[1], 'horizon': horizon,
+                'store': store_filter, 'limit': limit + 1
+            })
+            rows = cur.fetchall()
+        conn.rollback()
+
+        try:
+            prune_reservation_tombstones(conn)
+        except psycopg2.Error as e:
+            # 削除履歴の削除に失敗しても差分は返す（次回の間隔で再試行）
+            conn.rollback()
+            print(f"⚠️  Could not prune reservation tombstones: {e}")
+    except Exception as e:
+        conn.rollback()
+        print(f"[CHANGES ERROR] {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        return_db_conn(conn)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if has_more:
+        next_cursor = (rows[-1]['change_txid'], rows[-1]['change_seq'])
+    else:
+        # horizon より古い変更はすべて返し終わった
+        next_cursor = max(since, (horizon, 0))
+
+    changes = []
+    for row in rows:
+        store_id = row['store']
+        change = {
+            'op': row['op'],
+            'id': row['id'],
+            'date': row['date'].strftime('%Y-%m-%d') if row['date'] else None,
+            'store_id': store_id,
+            'changed_at': row['changed_at'].isoformat()
+        }
+        if row['op'] == 'upsert':
+            change.update({
+                'type': row['type'],
+                'start': row['start_time'].strftime('%H:%M'),
+                'end': row['end_time'].strftime('%H:%M'),
+                'customer_name': row['customer_name'],
+                'store_name': STORE_CONFIG.get(store_id, {}).get('name_jp', store_id),
+                'room_name': row['room_name']
+            })
+        changes.append(change)
+
+    return jsonify({
+        'changes': changes,
+        'next_cursor': encode_change_cursor(*next_cursor),
+        'has_more': has_more
+    })
+
+@app.route('/api/reservations', methods=['POST'])
+def add_reservation():
+    """手動で予約を追加"""
+    if not is_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.json
+    store = data.get('store', 'shibuya')  # 店舗パラメータ取得
+
+    # 店舗バリデーション
+    if store not in STORE_CONFIG:
+        return jsonify({'error': f'Invalid store: {store}'}), 400
+
+    conn = get_db_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (
+                data.get('date'),
+                data.get('start'),
+                data.get('end'),
+                data.get('customer_name', 'N/A'),
+                data.get('room_name', '個室B'),  # room_nameを追加
+                store,
+                data.get('type', 'manual')
+            ))
+        conn.commit()
+        read_cache.invalidate(store, data.get('date'))
+
+        # Google Calendar同期（GAS側で実行しているため、Vercel側からは不要）
+        # GASが ebisu@topform.jp のカレンダーに直接書き込み
+        # if store in ['ebisu', 'hanzomon']:
+        #     add_to_calendar(
+        #         store=store,
+        #         date=data.get('date'),
+        #         start_time=data.get('start'),
+        #         end_time=data.get('end'),
+        #         customer_name=data.get('customer_name', 'N/A')
+        #     )
+
+        log_activity(f"Manual reservation added: {data}")
+        return jsonify({'message': 'Reservation added'})
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        return_db_conn(conn)
 
 @app.route('/api/reservations/delete', methods=['POST'])
 @limiter.limit("30 per minute")  # 予約削除の頻度制限
@@ -854,6 +1899,7 @@ def delete_reservation():
             print(f'[DELETE] Deleted {deleted_count} reservation(s) with ID {reservation_to_delete["id"]}')
 
         conn.commit()
+        read_cache.invalidate(store, reservation_to_delete['date'])
 
         # Google Calendar同期（恵比寿・半蔵門のみ）
         if store in ['ebisu', 'hanzomon']:
@@ -936,6 +1982,7 @@ def update_reservation_room(reservation_id):
             """, (new_room_name, reservation_id))
 
         conn.commit()
+        read_cache.invalidate(store, reservation['date'])
 
         log_activity(
             f"Room name updated: ID={reservation_id}, "
@@ -1024,6 +2071,7 @@ def cleanup_duplicates():
             time_duplicates = cur.rowcount
 
         conn.commit()
+        read_cache.clear()
         total_deleted = email_duplicates + time_duplicates
         log_activity(f"Cleaned up {total_deleted} duplicate reservations (email: {email_duplicates}, time: {time_duplicates})")
 
@@ -1076,6 +2124,56 @@ def debug_duplicates():
     finally:
         return_db_conn(conn)
 
+@app.route('/api/admin/cache-stats')
+def cache_stats():
+    """
+    読み取りキャッシュの統計（管理者専用）
+
+    Response:
+    {
+        "hits": 120, "misses": 8, "evictions": 0, "expirations": 3, "invalidations": 5,
+        "size": 6, "max_entries": 512, "ttl_seconds": 60, "hit_rate": 0.9375
+    }
+    """
+    if not is_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify(read_cache.stats())
+
+@app.route('/api/admin/db-pool-stats')
+def db_pool_stats():
+    """
+    DB接続プールの統計（管理者専用、プールの大きさの見直し用）
+
+    取得の待ち時間・保持時間・クエリ数（エンドポイントごと）と、
+    返却されていない接続（取得したときのスタック付き）を返す。形式は db_pool.ConnectionPool.stats() を参照。
+    リードレプリカを設定している場合は read_replica に、レプリカのプールの統計・最後に確認した遅延・
+    読み取りの振り分け先の件数（routing）を返す。
+    """
+    if not is_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if db_pool is None:
+        return jsonify({'mode': DB_POOL_MODE, 'initialized': False})
+    result = {
+        'mode': DB_POOL_MODE,
+        'initialized': True,
+        'prepared_statements': db_pool.prepare_statements and not query_registry.prepared_statements_disabled,
+        **db_pool.stats()
+    }
+    if read_db_pool is not None:
+        with read_routing_lock:
+            routing = dict(read_routing)
+        result['read_replica'] = {
+            'lag_seconds': replica_state['lag_seconds'],
+            'receiving': replica_state['receiving'],
+            'max_lag_seconds': DB_READ_MAX_LAG_SECONDS,
+            'sticky_seconds': DB_READ_STICKY_SECONDS,
+            'routing': routing,
+            **read_db_pool.stats()
+        }
+    return jsonify(result)
+
 @app.route('/api/admin/debug-nakameguro')
 def debug_nakameguro():
     """中目黒店のroom_nameをデバッグ（管理者専用）"""
@@ -1131,10 +2229,10 @@ def debug_env():
     """デバッグ用：環境変数とDB接続確認"""
     try:
         postgres_url_exists = bool(os.environ.get('POSTGRES_URL'))
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM reservations")
-        count = cur.fetchone()[0]
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM reservations")
+            count = cur.fetchone()[0]
 
         result = {
             'postgres_url_exists': postgres_url_exists,
@@ -1143,7 +2241,6 @@ def debug_env():
             'code_version': 'v3_fixed'
         }
 
-        return_db_conn(conn)
         return jsonify(result)
     except Exception as e:
         return jsonify({
@@ -1152,11 +2249,75 @@ def debug_env():
             'code_version': 'v3_fixed_error'
         }), 500
 
+def apply_webhook_reservations(cur, reservations):
+    """
+    webhookの予約バッチを反映し、監査ログを同じトランザクションで書き込む
+
+    gas_webhook（同期モード）と取り込みキューのワーカーで共通の処理。
+    commit・キャッシュ無効化・Calendar同期は呼び出し側で行う。
+    不正な予約はバッチ全体を失敗させずに除外し、エラー理由を結果に含める。
+
+    Returns:
+        dict: apply_reservations_partial() の結果
+    """
+    # バッチ全体を少数の一括SQLで反映（件数に依存しない往復回数）
+    # 前回反映したときから変わっていない予約（GASの再送）はスキップ
+    result = apply_reservations_partial(cur, reservations, skip_applied=True)
+    print(f'[DEBUG] Applied {len(result["applied"])} reservations in {result["phases"]} phase(s), skipped {result["skipped"]} unchanged, failed {result["failed"]}')
+
+    for index in result['applied']:
+        res = reservations[index]
+        if res.get('is_cancellation'):
+            log_activity(f"Gmail cancellation: {res['date']} {res['start']}")
+        else:
+            log_activity(f"Gmail booking processed: {res['date']} {res['start']}-{res['end']}")
+    if result['skipped']:
+        log_activity(f'Gmail webhook: {result["skipped"]} unchanged reservations skipped')
+    for index, reason in result['errors'].items():
+        log_activity(f'Gmail webhook: reservation #{index} rejected: {reason}')
+    # 監査ログは取り込みと同じトランザクションで書き込む（別接続を使わない）
+    flush_activity_logs(cur)
+    return result
+
+
+def webhook_item_errors(reservations, errors):
+    """エラーになった予約の一覧（送信側が失敗した予約だけを再送できるよう、インデックスと email_id を含める）"""
+    return [
+        {
+            'index': index,
+            'email_id': reservations[index].get('email_id') if isinstance(reservations[index], dict) else None,
+            'error': reason
+        }
+        for index, reason in sorted(errors.items())
+    ]
+
+
+def delete_calendar_events(events):
+    """キャンセルされた予約をGoogle Calendarから削除（失敗しても続行）"""
+    for event in events:
+        try:
+            delete_from_calendar(
+                store=event['store'],
+                date=event['date'],
+                start_time=event['start_time'],
+                end_time=event['end_time']
+            )
+            print(f'[DEBUG] Calendar delete success: {event["store"]} {event["date"]} {event["start_time"]}')
+        except Exception as cal_err:
+            print(f'[WARNING] Calendar delete failed: {str(cal_err)}')
+
+
 @app.route('/api/gas/webhook', methods=['POST'])
 @csrf.exempt  # 外部システム（GAS）からのリクエストなのでCSRF免除
 @limiter.limit("60 per minute")  # GASからの頻繁な同期を許可
 def gas_webhook():
-    """GASからの予約データを受信"""
+    """
+    GASからの予約データを受信
+
+    Query Parameters:
+    - mode: sync（リクエスト内で反映、既定） / async（検証して取り込みキューに追加し、202とバッチIDを返す）
+            省略時は環境変数 WEBHOOK_INGEST_MODE
+    """
     try:
         # Webhook認証チェック
         if WEBHOOK_API_KEY:
@@ -1176,170 +2337,31 @@ def gas_webhook():
         if not reservations:
             return jsonify({'error': 'No reservations provided'}), 400
 
+        # 非同期モード: 反映はワーカー（process_ingest_queue）が行う
+        if request.args.get('mode', WEBHOOK_INGEST_MODE) == 'async':
+            return enqueue_webhook_batch(reservations)
+
         conn = get_db_conn()
         print(f'[DEBUG] Got DB connection: {conn}')
         try:
-            inserted_count = 0
-            updated_count = 0
-            deleted_count = 0
-
-            # Calendar同期が必要なイベントを収集
-            calendar_events_to_add = []
-            calendar_events_to_delete = []
-
             with conn.cursor() as cur:
-                for i, res in enumerate(reservations):
-                    # キャンセルの場合は削除
-                    # 注意: キャンセルメールと予約メールは別のメールなのでemail_idが異なる
-                    # そのため、日付・時間・顧客名で削除する
-                    if res.get('is_cancellation'):
-                        customer_name = res.get('customer_name', 'N/A')
-                        room_name = res.get('room_name', '')
-                        # room_nameがある場合は条件に含める（同じ顧客が同時刻に複数部屋を予約している場合に対応）
-                        if room_name:
-                            cur.execute("""
-                                DELETE FROM reservations
-                                WHERE date = %s AND start_time = %s AND customer_name = %s AND store = %s AND room_name = %s AND type = 'gmail'
-                            """, (res['date'], res['start'], customer_name, res.get('store', 'shibuya'), room_name))
-                        else:
-                            cur.execute("""
-                                DELETE FROM reservations
-                                WHERE date = %s AND start_time = %s AND customer_name = %s AND store = %s AND type = 'gmail'
-                            """, (res['date'], res['start'], customer_name, res.get('store', 'shibuya')))
-                        deleted_count += cur.rowcount
-                        print(f'[DEBUG] Deleted cancellation: {res["date"]} {res["start"]} room={room_name}')
-
-                        # Google Calendar同期が必要な場合はリストに追加
-                        if res.get('store', 'shibuya') in ['ebisu', 'hanzomon']:
-                            calendar_events_to_delete.append({
-                                'store': res.get('store', 'shibuya'),
-                                'date': res['date'],
-                                'start_time': res['start'],
-                                'end_time': res.get('end', res['start'])
-                            })
-
-                        log_activity(f"Gmail cancellation: {res['date']} {res['start']}")
-                    else:
-                        email_id = res.get('email_id')
-
-                        # email_idがある場合は重複チェック
-                        if email_id:
-                            cur.execute("""
-                                SELECT id FROM reservations
-                                WHERE email_id = %s AND store = %s
-                            """, (email_id, res.get('store', 'shibuya')))
-                            existing = cur.fetchone()
-
-                            if existing:
-                                # 既存の予約を更新
-                                cur.execute("""
-                                    UPDATE reservations
-                                    SET date = %s, start_time = %s, end_time = %s, customer_name = %s, room_name = %s, type = %s
-                                    WHERE email_id = %s AND store = %s
-                                """, (
-                                    res['date'],
-                                    res['start'],
-                                    res['end'],
-                                    res.get('customer_name', 'N/A'),
-                                    res.get('room_name', '個室B'),
-                                    res.get('type', 'gmail'),
-                                    email_id,
-                                    res.get('store', 'shibuya')
-                                ))
-                                updated_count += 1
-                                print(f'[DEBUG] Updated [{i+1}/{len(reservations)}]: {res["date"]} {res["start"]}-{res["end"]} {res.get("customer_name")} (type: {res.get("type", "gmail")})')
-                            else:
-                                # 新規予約を追加
-                                cur.execute("""
-                                    INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                """, (
-                                    res['date'],
-                                    res['start'],
-                                    res['end'],
-                                    res.get('customer_name', 'N/A'),
-                                    res.get('room_name', '個室B'),
-                                    res.get('store', 'shibuya'),
-                                    res.get('type', 'gmail'),  # GASから送られた type を使用（貸切の場合は 'charter'）
-                                    res.get('source', 'gas_sync'),
-                                    email_id
-                                ))
-                                inserted_count += 1
-                                print(f'[DEBUG] Inserted [{i+1}/{len(reservations)}]: {res["date"]} {res["start"]}-{res["end"]} {res.get("customer_name")} (type: {res.get("type", "gmail")})')
-
-                                # Google Calendar同期が必要な場合はリストに追加
-                                if res.get('store', 'shibuya') in ['ebisu', 'hanzomon']:
-                                    calendar_events_to_add.append({
-                                        'store': res.get('store', 'shibuya'),
-                                        'date': res['date'],
-                                        'start_time': res['start'],
-                                        'end_time': res['end'],
-                                        'customer_name': res.get('customer_name', 'N/A'),
-                                        'room_name': res.get('room_name', '個室B')
-                                    })
-                        else:
-                            # email_idがない場合は日付・時間・店舗で重複チェック（より厳格）
-                            cur.execute("""
-                                SELECT id, customer_name FROM reservations
-                                WHERE date = %s AND start_time = %s AND end_time = %s
-                                AND store = %s AND type = 'gmail'
-                            """, (
-                                res['date'],
-                                res['start'],
-                                res['end'],
-                                res.get('store', 'shibuya')
-                            ))
-                            existing = cur.fetchone()
-
-                            if existing:
-                                # 既存の予約を更新（顧客名と部屋名とタイプを最新に）
-                                cur.execute("""
-                                    UPDATE reservations
-                                    SET customer_name = %s, room_name = %s, type = %s
-                                    WHERE id = %s
-                                """, (
-                                    res.get('customer_name', 'N/A'),
-                                    res.get('room_name', '個室B'),
-                                    res.get('type', 'gmail'),
-                                    existing[0]
-                                ))
-                                updated_count += 1
-                                print(f'[DEBUG] Updated (no email_id) [{i+1}/{len(reservations)}]: {res["date"]} {res["start"]}-{res["end"]} {res.get("customer_name")} (type: {res.get("type", "gmail")})')
-                            else:
-                                # 重複がない場合のみ追加
-                                cur.execute("""
-                                    INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                """, (
-                                    res['date'],
-                                    res['start'],
-                                    res['end'],
-                                    res.get('customer_name', 'N/A'),
-                                    res.get('room_name', '個室B'),
-                                    res.get('store', 'shibuya'),
-                                    res.get('type', 'gmail'),  # GASから送られた type を使用（貸切の場合は 'charter'）
-                                    res.get('source', 'gas_sync'),
-                                    None
-                                ))
-                                inserted_count += 1
-                                print(f'[DEBUG] Inserted [{i+1}/{len(reservations)}]: {res["date"]} {res["start"]}-{res["end"]} {res.get("customer_name")} (type: {res.get("type", "gmail")})')
-
-                                # Google Calendar同期が必要な場合はリストに追加
-                                if res.get('store', 'shibuya') in ['ebisu', 'hanzomon']:
-                                    calendar_events_to_add.append({
-                                        'store': res.get('store', 'shibuya'),
-                                        'date': res['date'],
-                                        'start_time': res['start'],
-                                        'end_time': res['end'],
-                                        'customer_name': res.get('customer_name', 'N/A'),
-                                        'room_name': res.get('room_name', '個室B')
-                                    })
-
-                        log_activity(f"Gmail booking processed: {res['date']} {res['start']}-{res['end']}")
+                result = apply_webhook_reservations(cur, reservations)
+                inserted_count = result['inserted']
+                updated_count = result['updated']
+                deleted_count = result['deleted']
+                skipped_count = result['skipped']
+                failed_count = result['failed']
+                # Calendar同期が必要なイベント
+                calendar_events_to_add = result['calendar_events_to_add']
+                calendar_events_to_delete = result['calendar_events_to_delete']
+                # キャッシュ無効化の対象（店舗, 日付）
+                touched = result['touched']
 
                 print(f'[DEBUG] About to commit - inserted: {inserted_count}, updated: {updated_count}, deleted: {deleted_count}')
                 conn.commit()
                 print('[DEBUG] Commit successful!')
+                for store, res_date in touched:
+                    read_cache.invalidate(store, res_date)
 
                 # データベースから件数を確認
                 cur.execute("SELECT COUNT(*) FROM reservations WHERE store = 'shibuya'")
@@ -1349,17 +2371,7 @@ def gas_webhook():
             # データベース操作完了後、Calendar同期を実行
             print(f'[DEBUG] Calendar sync - To add: {len(calendar_events_to_add)}, To delete: {len(calendar_events_to_delete)}')
 
-            for event in calendar_events_to_delete:
-                try:
-                    delete_from_calendar(
-                        store=event['store'],
-                        date=event['date'],
-                        start_time=event['start_time'],
-                        end_time=event['end_time']
-                    )
-                    print(f'[DEBUG] Calendar delete success: {event["store"]} {event["date"]} {event["start_time"]}')
-                except Exception as cal_err:
-                    print(f'[WARNING] Calendar delete failed: {str(cal_err)}')
+            delete_calendar_events(calendar_events_to_delete)
 
             # Google Calendar同期（GAS側で実行しているため、Vercel側からは不要）
             # GASが ebisu@topform.jp のカレンダーに直接書き込み
@@ -1377,20 +2389,30 @@ def gas_webhook():
             #     except Exception as cal_err:
             #         print(f'[WARNING] Calendar add failed: {str(cal_err)}')
 
+            # 一部の予約がエラーの場合も、問題のない予約は反映済み（status: partial）
+            # すべての予約がエラーの場合のみ 400
+            if failed_count == len(reservations):
+                status, status_code = 'error', 400
+            else:
+                status, status_code = ('partial' if failed_count else 'success'), 200
             return jsonify({
-                'status': 'success',
-                'message': f'予約を処理しました（追加:{inserted_count}, 更新:{updated_count}, 削除:{deleted_count}）',
+                'status': status,
+                'message': f'予約を処理しました（追加:{inserted_count}, 更新:{updated_count}, 削除:{deleted_count}, スキップ:{skipped_count}, エラー:{failed_count}）',
+                'results': result['statuses'],
+                'errors': webhook_item_errors(reservations, result['errors']),
                 'debug': {
                     'received': len(reservations),
                     'inserted': inserted_count,
                     'updated': updated_count,
                     'deleted': deleted_count,
+                    'skipped': skipped_count,
+                    'failed': failed_count,
                     'db_count_after_insert': db_count,
                     'commit_successful': True,
                     'postgres_url_exists': bool(os.environ.get('POSTGRES_URL')),
                     'connection_type': str(type(conn).__name__)
                 }
-            }), 200
+            }), status_code
 
         except Exception as e:
             print(f'[DEBUG] Error occurred: {str(e)}')
@@ -1406,31 +2428,304 @@ def gas_webhook():
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
 # ============================================================
-# Gmail予約全削除API
+# Webhook取り込みキュー（非同期モード）
 # ============================================================
 
-@app.route('/api/gas/clear-gmail-reservations', methods=['DELETE'])
-@csrf.exempt
-def clear_gmail_reservations():
-    """
-    Gmail経由の予約データを全削除
+# 失敗したバッチを再試行する回数（超えたら failed）
+INGEST_MAX_ATTEMPTS = 3
+# 再試行までの待ち時間（分、試行回数倍）
+INGEST_RETRY_DELAY_MINUTES = 1
+# 1回のワーカー実行で反映する最大バッチ数
+INGEST_BATCHES_PER_RUN = 10
+# 完了・失敗したバッチを残す日数
+INGEST_QUEUE_RETENTION_DAYS = 7
 
-    Headers:
-    - X-API-Key: Wh00k@2025!Secure$Token#ABC123XYZ
 
-    Response:
-    {
-        "status": "success",
-        "message": "Gmail予約を全削除しました",
-        "deleted_count": 123
-    }
+def enqueue_webhook_batch(reservations):
     """
-    # API Key認証
-    api_key = request.headers.get('X-API-Key')
-    if api_key != 'Wh00k@2025!Secure$Token#ABC123XYZ':
-        return jsonify({'error': 'Unauthorized'}), 401
+    webhookの予約バッチを検証して取り込みキュー（ingest_queue）に追加し、202を返す
 
-    print('[DEBUG] Clear Gmail reservations request received')
+    反映・監査ログ・Calendar同期はワーカー（process_ingest_queue）が行う。
+    不正な予約はレスポンスの errors で返し、ワーカーも反映時に除外する（すべて不正な場合は400）。
+    """
+    errors = {}
+    for index, res in enumerate(reservations):
+        reason = validate_item(res)
+        if reason is not None:
+            errors[index] = reason
+    if len(errors) == len(reservations):
+        return jsonify({
+            'error': 'No valid reservations provided',
+            'errors': webhook_item_errors(reservations, errors)
+        }), 400
+    items = [normalize_item(res) for index, res in enumerate(reservations) if index not in errors]
+
+    conn = get_db_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO ingest_queue (payload, item_count, stores)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """, (json.dumps(reservations, ensure_ascii=False), len(reservations),
+                  sorted({item['store'] for item in items})))
+            batch_id = cur.fetchone()[0]
+            log_activity(f'Gmail webhook batch queued: {batch_id} ({len(reservations)} reservations)')
+            flush_activity_logs(cur)
+        conn.commit()
+    except Exception as e:
+        print(f'[DEBUG] Error queueing webhook batch: {str(e)}')
+        conn.rollback()
+        log_activity(f'gas_webhook queue error: {str(e)}')
+        return jsonify({'error': str(e)}), 500
+    finally:
+        return_db_conn(conn)
+
+    print(f'[DEBUG] Queued webhook batch {batch_id} ({len(reservations)} reservations)')
+    return jsonify({
+        'status': 'accepted',
+        'batch_id': batch_id,
+        'received': len(reservations),
+        'errors': webhook_item_errors(reservations, errors),
+        'status_url': url_for('get_ingest_batch', batch_id=batch_id)
+    }), 202
+
+
+def claim_ingest_batch(cur):
+    """
+    待機中のバッチを1件ロックして取得（FOR UPDATE SKIP LOCKED）
+
+    同じ店舗を含むより古い待機中のバッチがある場合は取得しない（店舗ごとに受信順で反映するため）。
+    ロックは commit / rollback まで保持され、他のワーカーはそのバッチを飛ばす。
+
+    Returns:
+        tuple: (id, payload, attempts)、なければNone
+    """
+    cur.execute("""
+        SELECT q.id, q.payload, q.attempts
+        FROM ingest_queue q
+        WHERE q.status = 'pending'
+        AND q.available_at <= CURRENT_TIMESTAMP
+        AND NOT EXISTS (
+            SELECT 1 FROM ingest_queue o
+            WHERE o.status = 'pending' AND o.id < q.id AND o.stores && q.stores
+        )
+        ORDER BY q.id
+        LIMIT 1
+        FOR UPDATE OF q SKIP LOCKED
+    """)
+    return cur.fetchone()
+
+
+def process_next_ingest_batch(conn):
+    """
+    待機中のバッチを1件反映
+
+    取得・反映・完了の記録を1つのトランザクションで行うため、途中でプロセスが落ちた場合は
+    rollback されてバッチは待機中に戻る。反映に失敗した場合はセーブポイントまで戻して
+    （バッチのロックは保持したまま）エラーを記録し、INGEST_MAX_ATTEMPTS 回まで再試行する。
+
+    Returns:
+        dict: 処理結果（バッチID・状態・件数またはエラー）、待機中のバッチがなければNone
+    """
+    try:
+        with conn.cursor() as cur:
+            claimed = claim_ingest_batch(cur)
+            if claimed is None:
+                conn.rollback()
+                return None
+            batch_id, reservations, attempts = claimed
+            print(f'[DEBUG] Processing ingest batch {batch_id} ({len(reservations)} reservations)')
+
+            cur.execute("SAVEPOINT ingest_batch")
+            try:
+                result = apply_webhook_reservations(cur, reservations)
+            except Exception as e:
+                print(f'[DEBUG] Error processing ingest batch {batch_id}: {str(e)}')
+                cur.execute("ROLLBACK TO SAVEPOINT ingest_batch")
+                status = 'failed' if attempts + 1 >= INGEST_MAX_ATTEMPTS else 'pending'
+                cur.execute("""
+                    UPDATE ingest_queue
+                    SET status = %s, attempts = attempts + 1, error = %s,
+                        available_at = CURRENT_TIMESTAMP + (attempts + 1) * %s * INTERVAL '1 minute',
+                        finished_at = CASE WHEN %s = 'failed' THEN CURRENT_TIMESTAMP END
+                    WHERE id = %s
+                """, (status, str(e), INGEST_RETRY_DELAY_MINUTES, status, batch_id))
+                log_activity(f'ingest_queue batch {batch_id} error: {str(e)}')
+                flush_activity_logs(cur)
+                conn.commit()
+                return {'batch_id': batch_id, 'status': status, 'error': str(e)}
+
+            summary = {key: result[key] for key in ('inserted', 'updated', 'deleted', 'skipped', 'failed')}
+            summary['errors'] = webhook_item_errors(reservations, result['errors'])
+            cur.execute("""
+                UPDATE ingest_queue
+                SET status = 'done', attempts = attempts + 1, finished_at = CURRENT_TIMESTAMP,
+                    result = %s, error = NULL
+                WHERE id = %s
+            """, (json.dumps(summary), batch_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    for store, res_date in result['touched']:
+        read_cache.invalidate(store, res_date)
+    delete_calendar_events(result['calendar_events_to_delete'])
+    return {'batch_id': batch_id, 'status': 'done', **summary}
+
+
+def process_ingest_queue(max_batches=INGEST_BATCHES_PER_RUN):
+    """
+    取り込みキューの待機中のバッチを古い順に反映（ワーカーのエントリーポイント）
+
+    複数のワーカーを同時に実行しても、同じバッチを二重に反映しない。
+    ingest_worker.py（常駐）または POST /api/gas/ingest-queue/process（cronなど）から呼び出す。
+
+    Args:
+        max_batches (int): 反映する最大バッチ数
+
+    Returns:
+        list: バッチごとの処理結果
+    """
+    processed = []
+    conn = get_db_conn()
+    try:
+        for _ in range(max_batches):
+            outcome = process_next_ingest_batch(conn)
+            if outcome is None:
+                break
+            processed.append(outcome)
+
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM ingest_queue
+                WHERE status IN ('done', 'failed')
+                AND finished_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+            """, (INGEST_QUEUE_RETENTION_DAYS,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        return_db_conn(conn)
+    return processed
+
+
+@app.route('/api/gas/ingest-queue/process', methods=['POST'])
+@csrf.exempt
+def process_ingest_queue_endpoint():
+    """
+    取り込みキューを処理（cron・GASなどから定期的に呼び出す）
+
+    Headers:
+    - X-API-Key: WEBHOOK_API_KEY
+
+    Request Body (任意):
+    {
+        "max_batches": 10
+    }
+
+    Response:
+    {
+        "status": "success",
+        "processed": [{"batch_id": 1, "status": "done", "inserted": 3, ...}]
+    }
+    """
+    if WEBHOOK_API_KEY:
+        api_key = request.headers.get('X-API-Key')
+        if not api_key or api_key != WEBHOOK_API_KEY:
+            return jsonify({'error': 'Unauthorized: Invalid API Key'}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        max_batches = min(int(data.get('max_batches', INGEST_BATCHES_PER_RUN)), INGEST_BATCHES_PER_RUN)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_batches must be an integer'}), 400
+
+    try:
+        processed = process_ingest_queue(max_batches)
+    except Exception as e:
+        log_activity(f'process_ingest_queue error: {str(e)}')
+        return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
+    return jsonify({'status': 'success', 'processed': processed})
+
+
+@app.route('/api/gas/ingest-queue/<int:batch_id>', methods=['GET'])
+def get_ingest_batch(batch_id):
+    """
+    取り込みキューのバッチの状態を取得（GASはAPIキー、管理者はログインで参照）
+
+    Response:
+    {
+        "batch_id": 1,
+        "status": "pending" | "done" | "failed",
+        "item_count": 120,
+        "attempts": 1,
+        "received_at": "...",
+        "finished_at": "...",
+        "result": {"inserted": 3, "updated": 1, "deleted": 0, "skipped": 115, "failed": 1,
+                   "errors": [{"index": 7, "email_id": "...", "error": "missing 'end'"}]},
+        "error": null
+    }
+    """
+    if not is_logged_in():
+        api_key = request.headers.get('X-API-Key')
+        if WEBHOOK_API_KEY and (not api_key or api_key != WEBHOOK_API_KEY):
+            return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_conn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, status, item_count, attempts, received_at, finished_at, result, error
+                FROM ingest_queue
+                WHERE id = %s
+            """, (batch_id,))
+            batch = cur.fetchone()
+        conn.rollback()
+    finally:
+        return_db_conn(conn)
+
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify({
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'item_count': batch['item_count'],
+        'attempts': batch['attempts'],
+        'received_at': batch['received_at'].isoformat(),
+        'finished_at': batch['finished_at'].isoformat() if batch['finished_at'] else None,
+        'result': batch['result'],
+        'error': batch['error']
+    })
+
+# ============================================================
+# Gmail予約全削除API
+# ============================================================
+
+@app.route('/api/gas/clear-gmail-reservations', methods=['DELETE'])
+@csrf.exempt
+def clear_gmail_reservations():
+    """
+    Gmail経由の予約データを全削除
+
+    Headers:
+    - X-API-Key: Wh00k@2025!Secure$Token#ABC123XYZ
+
+    Response:
+    {
+        "status": "success",
+        "message": "Gmail予約を全削除しました",
+        "deleted_count": 123
+    }
+    """
+    # API Key認証
+    api_key = request.headers.get('X-API-Key')
+    if api_key != 'Wh00k@2025!Secure$Token#ABC123XYZ':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    print('[DEBUG] Clear Gmail reservations request received')
 
     conn = None
     try:
@@ -1447,6 +2742,7 @@ def clear_gmail_reservations():
         deleted_count = cur.rowcount
 
         conn.commit()
+        read_cache.clear()
         print(f'[DEBUG] Deleted {deleted_count} Gmail reservations')
 
         # 削除後の確認
@@ -1530,6 +2826,17 @@ def sync_ebisu_calendar():
 # データベースマイグレーションAPI
 # ============================================================
 
+# SQLファイルで定義されたマイグレーション（名前: 説明）
+FILE_MIGRATIONS = {
+    '003_add_reservation_indexes': '予約検索用インデックスを追加しました',
+    '004_add_reservation_date_index': '日付順の予約取得用インデックスを追加しました',
+    '005_add_reservation_versions': '店舗ごとの変更カウンタ（条件付きGET用）を追加しました',
+    '006_add_reservation_changes': '差分同期用の更新履歴（updated_at・削除履歴）を追加しました',
+    '007_add_reservation_email_id_unique': '予約の (店舗, email_id) 一意インデックスを追加しました',
+    '008_add_webhook_item_hashes': 'webhook の反映済み予約ハッシュ（再送のスキップ用）を追加しました',
+    '009_add_ingest_queue': 'webhook の取り込みキュー（非同期モード用）を追加しました',
+}
+
 @app.route('/api/admin/run-migration', methods=['POST'])
 @csrf.exempt
 def run_migration():
@@ -1595,6 +2902,22 @@ def run_migration():
                 'message': 'マイグレーション完了：room_nameカラムを追加しました',
                 'migration_name': migration_name
             }), 200
+        elif migration_name in FILE_MIGRATIONS:
+            # migrations/ 配下のSQLファイルをそのまま実行
+            print(f'[DEBUG] Running migration: {migration_name}')
+            with open(f'migrations/{migration_name}.sql', 'r') as f:
+                cur.execute(f.read())
+
+            conn.commit()
+            cur.close()
+
+            log_activity(f'Migration completed: {migration_name}')
+
+            return jsonify({
+                'status': 'success',
+                'message': f'マイグレーション完了：{FILE_MIGRATIONS[migration_name]}',
+                'migration_name': migration_name
+            }), 200
         else:
             return jsonify({
                 'error': 'Unknown migration',
@@ -1705,6 +3028,67 @@ def test_calendar_env():
 # 空き状況API（統合検索システム用）
 # ============================================================
 
+def build_availability_result(store, date, start_time, end_time, reservations):
+    """
+    1店舗・1時間帯の空き状況レスポンスを組み立てる
+
+    部屋がある店舗は部屋ごとの同時利用数を定員（max_capacity）と比較し、
+    部屋ごと・店舗全体の残り枠数を返します。
+    部屋がない店舗（渋谷、代々木上原）は予約数をカウントします。
+
+    Args:
+        store (str): 店舗ID
+        date (str): 日付（YYYY-MM-DD）
+        start_time (str): 開始時刻（HH:MM）
+        end_time (str): 終了時刻（HH:MM）
+        reservations (list): その店舗・日付の (開始分, 終了分, 部屋名) のタプルのリスト
+
+    Returns:
+        dict: /api/availability のレスポンス
+    """
+    store_info = STORE_CONFIG[store]
+    max_slots = store_info['max_slots']
+    rooms = store_info.get('rooms')
+    slots = generate_slots(time_to_minutes(start_time), time_to_minutes(end_time))
+
+    result = {
+        'store': store,
+        'store_name': store_info['name_jp'],
+        'date': date,
+        'start_time': start_time,
+        'end_time': end_time
+    }
+
+    if rooms:
+        # 各時間スロットで部屋ごとの利用数を数え、定員で頭打ちにした合計の最大値を取る
+        per_room, store_used = room_slot_occupancy(reservations, rooms, slots)
+        occupied_slots = max(store_used, default=0)
+        rooms_data = []
+        for room_name, room_info in rooms.items():
+            capacity = room_info.get('max_capacity', 1)
+            occupied = min(max(per_room[room_name], default=0), capacity)
+            rooms_data.append({
+                'room_name': room_name,
+                'display_name': room_info.get('display_name', room_name),
+                'max_capacity': capacity,
+                'occupied': occupied,
+                'remaining': capacity - occupied
+            })
+        result['rooms'] = rooms_data
+    else:
+        # 各時間スロットで予約数をカウントし、最大値を取る
+        occupied_slots = max(slot_occupancy(reservations, slots), default=0)
+
+    remaining_slots = max_slots - occupied_slots
+    result.update({
+        'available': remaining_slots > 0,
+        'total_slots': max_slots,
+        'occupied_slots': occupied_slots,
+        'remaining_slots': remaining_slots
+    })
+    return result
+
+
 @app.route('/api/availability', methods=['GET'])
 def check_availability():
     """
@@ -1718,16 +3102,21 @@ def check_availability():
 
     Response:
     {
-        "store": "shibuya",
-        "store_name": "渋谷店",
+        "store": "hanzomon",
+        "store_name": "半蔵門店",
         "date": "2025-12-01",
         "start_time": "10:00",
         "end_time": "12:00",
         "available": true,
-        "total_slots": 7,
+        "total_slots": 4,
         "occupied_slots": 3,
-        "remaining_slots": 4
+        "remaining_slots": 1,
+        "rooms": [
+            {"room_name": "個室A", "display_name": "STUDIO A（個室）", "max_capacity": 1, "occupied": 1, "remaining": 0},
+            {"room_name": "個室B", "display_name": "STUDIO B（オープン）", "max_capacity": 3, "occupied": 2, "remaining": 1}
+        ]
     }
+    ※ rooms は部屋がある店舗のみ
     """
     try:
         # パラメータ取得
@@ -1750,85 +3139,225 @@ def check_availability():
                 'valid_stores': list(STORE_CONFIG.keys())
             }), 400
 
-        store_info = STORE_CONFIG[store]
-        max_slots = store_info['max_slots']
-        store_name = store_info['name_jp']
+        # データベースから予約を1回で取得し、スロットごとの利用数をメモリ上で計算（キャッシュ・条件付きGET対応）
+        def load():
+            conn = get_read_db_conn()
+            try:
+                with conn.cursor() as cur:
+                    reservations = fetch_day_reservations(cur, store, date)
+            finally:
+                return_db_conn(conn)
+            return build_availability_result(store, date, start_time, end_time, reservations)
+
+        return conditional_json(
+            ('availability', store, date, (start_time, end_time)),
+            [(store, date)],
+            [store],
+            load
+        )
 
-        # データベースから予約数を取得
-        conn = get_db_conn()
-        try:
-            with conn.cursor() as cur:
-                # 時間を分に変換するヘルパー関数
-                def time_to_minutes(t):
-                    h, m = map(int, t.split(':'))
-                    return h * 60 + m
-
-                def minutes_to_time(minutes):
-                    h, m = divmod(minutes, 60)
-                    return f"{h:02d}:{m:02d}"
-
-                start_minutes = time_to_minutes(start_time)
-                end_minutes = time_to_minutes(end_time)
-
-                # 30分単位で時間スロットを生成
-                time_slots = []
-                current = start_minutes
-                while current < end_minutes:
-                    time_slots.append(minutes_to_time(current))
-                    current += 30
-
-                # 各時間スロットで使用中の部屋数をカウントし、最大値を取る
-                max_occupied = 0
-
-                for slot in time_slots:
-                    # room_nameがある店舗はDISTINCT room_nameでカウント
-                    # ない店舗（渋谷、代々木上原）は予約数をカウント
-                    if store_info.get('rooms'):
-                        cur.execute("""
-                            SELECT COUNT(DISTINCT room_name) FROM reservations
-                            WHERE date = %s
-                            AND store = %s
-                            AND start_time <= %s
-                            AND end_time > %s
-                        """, (date, store, slot, slot))
-                    else:
-                        cur.execute("""
-                            SELECT COUNT(*) FROM reservations
-                            WHERE date = %s
-                            AND store = %s
-                            AND start_time <= %s
-                            AND end_time > %s
-                        """, (date, store, slot, slot))
+    except Exception as e:
+        log_activity(f'availability_check error: {str(e)}')
+        return jsonify({
+            'error': 'Internal server error',
+            'details': str(e)
+        }), 500
 
-                    occupied = cur.fetchone()[0]
-                    max_occupied = max(max_occupied, occupied)
 
-                occupied_slots = max_occupied
-                remaining_slots = max_slots - occupied_slots
+# バッチ空き状況APIで1リクエストに含められる最大クエリ数
+MAX_BATCH_QUERIES = 500
 
-                return jsonify({
-                    'store': store,
-                    'store_name': store_name,
-                    'date': date,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'available': remaining_slots > 0,
-                    'total_slots': max_slots,
-                    'occupied_slots': occupied_slots,
-                    'remaining_slots': remaining_slots
-                }), 200
+@app.route('/api/availability/batch', methods=['POST'])
+@csrf.exempt  # 読み取り専用（社内ツールからも呼ぶため）
+def check_availability_batch():
+    """
+    バッチ空き状況取得API（複数の店舗・日付・時間帯をまとめて判定）
 
-        finally:
-            return_db_conn(conn)
+    Request Body:
+    {
+        "queries": [
+            {"store": "shibuya", "date": "2025-12-01", "start_time": "10:00", "end_time": "12:00"},
+            {"store": "hanzomon", "date": "2025-12-02", "start_time": "19:00", "end_time": "20:30"}
+        ]
+    }
+
+    Response（入力と同じ順序の配列。各要素は /api/availability と同じ形式）:
+    [
+        {"store": "shibuya", "date": "2025-12-01", ..., "remaining_slots": 4},
+        {"error": "Invalid store", "index": 1}
+    ]
+    """
+    try:
+        data = request.get_json(silent=True)
+        queries = data.get('queries') if isinstance(data, dict) else data
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'error': 'No queries provided'}), 400
+        if len(queries) > MAX_BATCH_QUERIES:
+            return jsonify({'error': f'Too many queries (max {MAX_BATCH_QUERIES})'}), 400
+
+        # 入力チェック（不正なクエリはその位置にエラーを返す）
+        results = [None] * len(queries)
+        valid = []
+        for i, q in enumerate(queries):
+            if not isinstance(q, dict):
+                results[i] = {'error': 'Query must be an object', 'index': i}
+                continue
+            store = q.get('store', 'shibuya')
+            date = q.get('date')
+            start_time = q.get('start_time')
+            end_time = q.get('end_time')
+            if not all([date, start_time, end_time]):
+                results[i] = {
+                    'error': 'Missing required parameters',
+                    'required': ['date', 'start_time', 'end_time'],
+                    'index': i
+                }
+                continue
+            if store not in STORE_CONFIG:
+                results[i] = {'error': 'Invalid store', 'index': i}
+                continue
+            try:
+                datetime.strptime(date, '%Y-%m-%d')
+                time_to_minutes(start_time)
+                time_to_minutes(end_time)
+            except (ValueError, AttributeError):
+                results[i] = {'error': 'Invalid date or time format', 'index': i}
+                continue
+            valid.append((i, store, date, start_time, end_time))
+
+        # (店舗, 日付) ごとの予約を1回のクエリでまとめて取得
+        if valid:
+            conn = get_read_db_conn()
+            try:
+                with conn.cursor() as cur:
+                    reservations = fetch_reservations_for_keys(
+                        cur, {(store, date) for _, store, date, _, _ in valid}
+                    )
+            finally:
+                return_db_conn(conn)
+
+            for i, store, date, start_time, end_time in valid:
+                results[i] = build_availability_result(
+                    store, date, start_time, end_time, reservations[(store, date)]
+                )
+
+        return jsonify(results), 200
 
     except Exception as e:
-        log_activity(f'availability_check error: {str(e)}')
+        log_activity(f'availability_batch error: {str(e)}')
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
         }), 500
 
 
+def build_detailed_result(date, start_time, end_time, reservations_by_store):
+    """
+    全店舗の詳細空き状況レスポンスを組み立てる
+
+    Args:
+        date (str): 日付（YYYY-MM-DD）
+        start_time (str): 開始時刻（HH:MM）
+        end_time (str): 終了時刻（HH:MM）
+        reservations_by_store (dict): {店舗ID: [(開始分, 終了分, 部屋名), ...]}
+
+    Returns:
+        dict: /api/availability/detailed のレスポンス
+    """
+    start_minutes = time_to_minutes(start_time)
+    end_minutes = time_to_minutes(end_time)
+
+    results = []
+
+    for store_id, store_info in STORE_CONFIG.items():
+        store_name = store_info['name_jp']
+        max_slots = store_info['max_slots']
+        has_rooms = store_info.get('rooms') is not None
+        reservations = reservations_by_store.get(store_id, [])
+
+        # 検索範囲を営業時間でクリップ
+        store_start_minutes, store_end_minutes = clip_to_store_hours(
+            store_info, start_minutes, end_minutes
+        )
+
+        # 営業時間外の場合はスキップ
+        if store_start_minutes >= store_end_minutes:
+            continue
+
+        if has_rooms:
+            # 部屋がある店舗: 各部屋の空き時間帯を取得（定員に達していなければ空き）
+            rooms_data = []
+            store_slots = generate_slots(store_start_minutes, store_end_minutes)
+            per_room, store_used = room_slot_occupancy(
+                reservations, store_info['rooms'], store_slots
+            )
+
+            for room_name, room_info in store_info['rooms'].items():
+                capacity = room_info.get('max_capacity', 1)
+                occupancy = per_room[room_name]
+
+                # 連続した空き時間をまとめる（remaining = その時間帯で確実に空いている枠数）
+                available_times = []
+                for s, e in free_ranges(store_slots, occupancy, capacity, store_end_minutes):
+                    in_range = [occupancy[i] for i, slot in enumerate(store_slots) if s <= slot < e]
+                    available_times.append({
+                        'start': minutes_to_time(s),
+                        'end': minutes_to_time(e),
+                        'remaining': capacity - max(in_range)
+                    })
+
+                if available_times:
+                    rooms_data.append({
+                        'room_name': room_name,
+                        'max_capacity': capacity,
+                        'available_times': available_times
+                    })
+
+            if rooms_data:
+                results.append({
+                    'store': store_id,
+                    'store_name': store_name,
+                    'has_rooms': True,
+                    'max_slots': max_slots,
+                    'remaining_slots': max_slots - max(store_used, default=0),
+                    'rooms': rooms_data
+                })
+
+        else:
+            # 部屋がない店舗: 1時間単位で空き枠数を取得
+            # 各時間帯の最小空き枠数（= 確実に取れる枠数）
+            available_slots = [
+                {
+                    'start': minutes_to_time(hour_start),
+                    'end': minutes_to_time(hour_end),
+                    'slots': min_slots
+                }
+                for hour_start, hour_end, min_slots in hourly_min_remaining(
+                    reservations, store_start_minutes, store_end_minutes, max_slots
+                )
+                if min_slots > 0
+            ]
+
+            if available_slots:
+                results.append({
+                    'store': store_id,
+                    'store_name': store_name,
+                    'has_rooms': False,
+                    'max_slots': max_slots,
+                    'remaining_slots': max_slots - peak_occupancy(
+                        reservations, store_start_minutes, store_end_minutes
+                    ),
+                    'available_slots': available_slots
+                })
+
+    return {
+        'date': date,
+        'start_time': start_time,
+        'end_time': end_time,
+        'stores': results
+    }
+
+
 @app.route('/api/availability/detailed', methods=['GET'])
 def check_availability_detailed():
     """
@@ -1850,18 +3379,23 @@ def check_availability_detailed():
                 "store_name": "渋谷店",
                 "has_rooms": false,
                 "max_slots": 7,
+                "remaining_slots": 3,
                 "available_slots": [
                     {"start": "10:00", "end": "12:00", "slots": 3},
                     {"start": "14:00", "end": "17:00", "slots": 5}
                 ]
             },
             {
-                "store": "ebisu",
-                "store_name": "恵比寿店",
+                "store": "hanzomon",
+                "store_name": "半蔵門店",
                 "has_rooms": true,
+                "max_slots": 4,
+                "remaining_slots": 2,
                 "rooms": [
-                    {"room_name": "個室A", "available_times": [{"start": "12:00", "end": "17:00"}]},
-                    {"room_name": "個室B", "available_times": [{"start": "10:00", "end": "17:00"}]}
+                    {"room_name": "個室A", "max_capacity": 1,
+                     "available_times": [{"start": "12:00", "end": "17:00", "remaining": 1}]},
+                    {"room_name": "個室B", "max_capacity": 3,
+                     "available_times": [{"start": "10:00", "end": "17:00", "remaining": 2}]}
                 ]
             }
         ]
@@ -1878,186 +3412,372 @@ def check_availability_detailed():
                 'required': ['date', 'start_time', 'end_time']
             }), 400
 
-        def time_to_minutes(t):
-            h, m = map(int, t.split(':'))
-            return h * 60 + m
+        # 全店舗の予約を1回のクエリで取得し、メモリ上で店舗ごとに計算（キャッシュ・条件付きGET対応）
+        def load():
+            conn = get_read_db_conn()
+            try:
+                with conn.cursor() as cur:
+                    reservations_by_store = fetch_date_reservations(cur, date)
+            finally:
+                return_db_conn(conn)
+            return build_detailed_result(date, start_time, end_time, reservations_by_store)
+
+        return conditional_json(
+            ('availability_detailed', None, date, (start_time, end_time)),
+            [(None, date)],
+            None,
+            load
+        )
 
-        def minutes_to_time(minutes):
-            h, m = divmod(minutes, 60)
-            return f"{h:02d}:{m:02d}"
+    except Exception as e:
+        log_activity(f'availability_detailed error: {str(e)}')
+        return jsonify({
+            'error': 'Internal server error',
+            'details': str(e)
+        }), 500
 
-        start_minutes = time_to_minutes(start_time)
-        end_minutes = time_to_minutes(end_time)
 
-        # 30分単位で時間スロットを生成
-        time_slots = []
-        current = start_minutes
-        while current < end_minutes:
-            time_slots.append(minutes_to_time(current))
-            current += 30
+@app.route('/api/availability/range', methods=['GET'])
+def check_availability_range():
+    """
+    期間空き状況取得API（複数日・店舗横断）
+
+    Query Parameters:
+    - date_from: 開始日 (YYYY-MM-DD)
+    - date_to: 終了日 (YYYY-MM-DD、この日を含む)
+    - start_time: 開始時刻 (HH:MM)
+    - end_time: 終了時刻 (HH:MM)
+    - stores: 店舗IDのカンマ区切り（省略時は全店舗）
+
+    Response:
+    {
+        "date_from": "2025-12-01",
+        "date_to": "2025-12-07",
+        "start_time": "19:00",
+        "end_time": "21:00",
+        "stores": [
+            {
+                "store": "shibuya",
+                "store_name": "渋谷店",
+                "has_rooms": false,
+                "max_slots": 7,
+                "slots": ["19:00", "19:30", "20:00", "20:30"],
+                "days": [
+                    {"date": "2025-12-01", "available": true, "min_remaining": 2, "remaining": [4, 3, 2, 5]}
+                ]
+            },
+            {
+                "store": "ebisu",
+                "store_name": "恵比寿店",
+                "has_rooms": true,
+                "slots": ["19:00", "19:30", "20:00", "20:30"],
+                "days": [
+                    {
+                        "date": "2025-12-01",
+                        "available": true,
+                        "free_rooms": [1, 1, 2, 2],
+                        "rooms": [
+                            {"room_name": "個室A", "max_capacity": 1,
+                             "available_times": [{"start": "20:00", "end": "21:00", "remaining": 1}]},
+                            {"room_name": "個室B", "max_capacity": 3,
+                             "available_times": [{"start": "19:00", "end": "21:00", "remaining": 2}]}
+                        ]
+                    }
+                ]
+            }
+        ]
+    }
+    """
+    try:
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        start_time = request.args.get('start_time')
+        end_time = request.args.get('end_time')
+        stores_param = request.args.get('stores')
+
+        if not all([date_from, date_to, start_time, end_time]):
+            return jsonify({
+                'error': 'Missing required parameters',
+                'required': ['date_from', 'date_to', 'start_time', 'end_time']
+            }), 400
 
-        conn = get_db_conn()
         try:
-            with conn.cursor() as cur:
-                results = []
-
-                for store_id, store_info in STORE_CONFIG.items():
-                    store_name = store_info['name_jp']
-                    max_slots = store_info['max_slots']
-                    has_rooms = store_info.get('rooms') is not None
-
-                    # 店舗の営業時間を取得し、検索範囲をクリップ
-                    store_hours = store_info.get('hours', {'start': 0, 'end': 24})
-                    store_open_minutes = int(store_hours['start'] * 60)
-                    store_close_minutes = int(store_hours['end'] * 60)
-
-                    # 検索範囲を営業時間でクリップ
-                    store_start_minutes = max(start_minutes, store_open_minutes)
-                    store_end_minutes = min(end_minutes, store_close_minutes)
-
-                    # 営業時間外の場合はスキップ
-                    if store_start_minutes >= store_end_minutes:
-                        continue
-
-                    # この店舗用の時間スロットを生成
-                    store_time_slots = []
-                    current = store_start_minutes
-                    while current < store_end_minutes:
-                        store_time_slots.append(minutes_to_time(current))
-                        current += 30
-
-                    if has_rooms:
-                        # 部屋がある店舗: 各部屋の空き時間帯を取得
-                        rooms_data = []
-
-                        # 予約されている部屋と時間を取得
-                        cur.execute("""
-                            SELECT room_name, start_time, end_time
-                            FROM reservations
-                            WHERE date = %s AND store = %s
-                            ORDER BY room_name, start_time
-                        """, (date, store_id))
-                        reservations = cur.fetchall()
-
-                        # 部屋ごとの予約をマップ
-                        room_reservations = {}
-                        for room_name, res_start, res_end in reservations:
-                            if room_name not in room_reservations:
-                                room_reservations[room_name] = []
-                            room_reservations[room_name].append((str(res_start)[:5], str(res_end)[:5]))
-
-                        # 各部屋の空き時間を計算
-                        for room_name in store_info['rooms'].keys():
-                            available_times = []
-                            reservations_for_room = room_reservations.get(room_name, [])
-
-                            # 各時間スロットが空いているかチェック
-                            slot_available = []
-                            for slot in store_time_slots:
-                                slot_mins = time_to_minutes(slot)
-                                is_available = True
-                                for res_start, res_end in reservations_for_room:
-                                    res_start_mins = time_to_minutes(res_start)
-                                    res_end_mins = time_to_minutes(res_end)
-                                    if res_start_mins <= slot_mins < res_end_mins:
-                                        is_available = False
-                                        break
-                                slot_available.append((slot, is_available))
-
-                            # 連続した空き時間をまとめる
-                            i = 0
-                            while i < len(slot_available):
-                                if slot_available[i][1]:  # 空いている
-                                    range_start = slot_available[i][0]
-                                    j = i
-                                    while j < len(slot_available) and slot_available[j][1]:
-                                        j += 1
-                                    # 終了時刻は最後の空きスロット + 30分
-                                    range_end_mins = time_to_minutes(slot_available[j-1][0]) + 30
-                                    if range_end_mins > store_end_minutes:
-                                        range_end_mins = store_end_minutes
-                                    range_end = minutes_to_time(range_end_mins)
-                                    available_times.append({
-                                        'start': range_start,
-                                        'end': range_end
-                                    })
-                                    i = j
-                                else:
-                                    i += 1
-
-                            if available_times:
-                                rooms_data.append({
-                                    'room_name': room_name,
-                                    'available_times': available_times
-                                })
-
-                        if rooms_data:
-                            results.append({
-                                'store': store_id,
-                                'store_name': store_name,
-                                'has_rooms': True,
-                                'rooms': rooms_data
-                            })
+            first_day = datetime.strptime(date_from, '%Y-%m-%d').date()
+            last_day = datetime.strptime(date_to, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format (YYYY-MM-DD)'}), 400
 
-                    else:
-                        # 部屋がない店舗: 1時間単位で空き枠数を取得
-                        available_slots = []
-
-                        # 1時間単位でループ（営業時間を考慮）
-                        hour_start = store_start_minutes
-                        while hour_start < store_end_minutes:
-                            hour_end = min(hour_start + 60, store_end_minutes)
-
-                            # この1時間内の30分スロットの空き枠数を取得
-                            slots_in_hour = []
-                            current = hour_start
-                            while current < hour_end:
-                                slot_time = minutes_to_time(current)
-                                cur.execute("""
-                                    SELECT COUNT(*) FROM reservations
-                                    WHERE date = %s
-                                    AND store = %s
-                                    AND start_time <= %s
-                                    AND end_time > %s
-                                """, (date, store_id, slot_time, slot_time))
-                                occupied = cur.fetchone()[0]
-                                remaining = max_slots - occupied
-                                slots_in_hour.append(remaining)
-                                current += 30
-
-                            # この時間帯の最小空き枠数（= 確実に取れる枠数）
-                            min_slots = min(slots_in_hour) if slots_in_hour else 0
-
-                            if min_slots > 0:
-                                available_slots.append({
-                                    'start': minutes_to_time(hour_start),
-                                    'end': minutes_to_time(hour_end),
-                                    'slots': min_slots
-                                })
-
-                            hour_start += 60
-
-                        if available_slots:
-                            results.append({
-                                'store': store_id,
-                                'store_name': store_name,
-                                'has_rooms': False,
-                                'max_slots': max_slots,
-                                'available_slots': available_slots
-                            })
+        num_days = (last_day - first_day).days + 1
+        if num_days < 1 or num_days > MAX_RANGE_DAYS:
+            return jsonify({
+                'error': f'date_to must be on or after date_from and within {MAX_RANGE_DAYS} days'
+            }), 400
 
+        if stores_param:
+            store_ids = [s.strip() for s in stores_param.split(',') if s.strip()]
+            invalid = [s for s in store_ids if s not in STORE_CONFIG]
+            if invalid:
                 return jsonify({
-                    'date': date,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'stores': results
-                }), 200
+                    'error': f'Invalid store: {", ".join(invalid)}',
+                    'valid_stores': list(STORE_CONFIG.keys())
+                }), 400
+        else:
+            store_ids = list(STORE_CONFIG.keys())
 
+        try:
+            start_minutes = time_to_minutes(start_time)
+            end_minutes = time_to_minutes(end_time)
+        except (ValueError, AttributeError):
+            return jsonify({'error': 'Invalid time format (HH:MM)'}), 400
+        day_labels = [(first_day + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(num_days)]
+
+        # 期間内の予約を1回のクエリで取得
+        conn = get_read_db_conn()
+        try:
+            with conn.cursor() as cur:
+                rows = fetch_range_reservations(cur, date_from, date_to, None if not stores_param else store_ids)
         finally:
             return_db_conn(conn)
 
+        rows_by_store = {}
+        for store, res_date, res_start, res_end, room_name in rows:
+            rows_by_store.setdefault(store, []).append(
+                ((res_date - first_day).days, res_start, res_end, room_name)
+            )
+
+        results = []
+        for store_id in store_ids:
+            store_info = STORE_CONFIG[store_id]
+            store_start_minutes, store_end_minutes = clip_to_store_hours(
+                store_info, start_minutes, end_minutes
+            )
+            if store_start_minutes >= store_end_minutes:
+                continue
+
+            slots = generate_slots(store_start_minutes, store_end_minutes)
+            slot_labels = [minutes_to_time(s) for s in slots]
+            store_rows = rows_by_store.get(store_id, [])
+            rooms = store_info.get('rooms')
+
+            if rooms:
+                # 部屋 × 日 × スロット の利用数行列
+                room_names = list(rooms.keys())
+                room_index = {name: i for i, name in enumerate(room_names)}
+                entries = [
+                    (room_index[room_name], day, res_start, res_end)
+                    for day, res_start, res_end, room_name in store_rows
+                    if room_name in room_index
+                ]
+                occupancy = build_occupancy_matrix(entries, len(room_names), num_days, slots)
+                capacities = np.array([rooms[name].get('max_capacity', 1) for name in room_names])
+                free = occupancy < capacities[:, None, None]
+                free_rooms = free.sum(axis=0)
+                # 部屋ごとの空き時間帯（remaining = その時間帯で確実に空いている枠数、/api/availability と同じ）
+                ranges_by_room = [
+                    free_ranges_remaining_matrix(occupancy[i], capacities[i], slots, store_end_minutes)
+                    for i in range(len(room_names))
+                ]
+
+                days = []
+                for d, day_label in enumerate(day_labels):
+                    days.append({
+                        'date': day_label,
+                        'available': bool(free_rooms[d].any()),
+                        'free_rooms': free_rooms[d].tolist(),
+                        'rooms': [
+                            {
+                                'room_name': room_name,
+                                'max_capacity': int(capacities[i]),
+                                'available_times': [
+                                    {'start': minutes_to_time(s), 'end': minutes_to_time(e), 'remaining': remaining}
+                                    for s, e, remaining in ranges_by_room[i][d]
+                                ]
+                            }
+                            for i, room_name in enumerate(room_names)
+                        ]
+                    })
+
+                results.append({
+                    'store': store_id,
+                    'store_name': store_info['name_jp'],
+                    'has_rooms': True,
+                    'slots': slot_labels,
+                    'days': days
+                })
+            else:
+                # 店舗 × 日 × スロット の利用数行列（店舗は1行）
+                max_slots = store_info['max_slots']
+                entries = [(0, day, res_start, res_end) for day, res_start, res_end, _ in store_rows]
+                remaining = max_slots - build_occupancy_matrix(entries, 1, num_days, slots)[0]
+                min_remaining = remaining.min(axis=1)
+                available = (remaining > 0).any(axis=1)
+
+                results.append({
+                    'store': store_id,
+                    'store_name': store_info['name_jp'],
+                    'has_rooms': False,
+                    'max_slots': max_slots,
+                    'slots': slot_labels,
+                    'days': [
+                        {
+                            'date': day_label,
+                            'available': bool(available[d]),
+                            'min_remaining': int(min_remaining[d]),
+                            'remaining': remaining[d].tolist()
+                        }
+                        for d, day_label in enumerate(day_labels)
+                    ]
+                })
+
+        return jsonify({
+            'date_from': date_from,
+            'date_to': date_to,
+            'start_time': start_time,
+            'end_time': end_time,
+            'stores': results
+        }), 200
+
     except Exception as e:
-        log_activity(f'availability_detailed error: {str(e)}')
+        log_activity(f'availability_range error: {str(e)}')
+        return jsonify({
+            'error': 'Internal server error',
+            'details': str(e)
+        }), 500
+
+
+# 次の空き枠検索の上限
+MAX_NEXT_HORIZON_DAYS = 31
+MAX_NEXT_RESULTS = 50
+
+@app.route('/api/availability/next', methods=['GET'])
+def find_next_available():
+    """
+    次の空き枠検索API（全店舗・全部屋横断）
+
+    Query Parameters:
+    - duration: 所要時間（分、例: 90）
+    - date: 検索開始日 (YYYY-MM-DD)
+    - start_time: 検索開始時刻 (HH:MM、省略時は 00:00)
+    - stores: 店舗IDのカンマ区切り（省略時は全店舗）
+    - room: 部屋名（指定時はその部屋を持つ店舗のみ）
+    - horizon_days: 検索日数（省略時は7日、最大31日）
+    - limit: 最大件数（省略時は5件、最大50件）
+
+    Response:
+    {
+        "duration": 90,
+        "date": "2025-12-01",
+        "start_time": "10:00",
+        "horizon_days": 7,
+        "candidates": [
+            {"store": "ebisu", "store_name": "恵比寿店", "room_name": "個室A",
+             "date": "2025-12-01", "start": "10:00", "end": "11:30"},
+            {"store": "shibuya", "store_name": "渋谷店", "room_name": null,
+             "date": "2025-12-01", "start": "10:00", "end": "11:30"}
+        ]
+    }
+    """
+    try:
+        date_param = request.args.get('date')
+        start_time = request.args.get('start_time', '00:00')
+        stores_param = request.args.get('stores')
+        room_filter = request.args.get('room')
+
+        try:
+            duration = int(request.args.get('duration', ''))
+            horizon_days = int(request.args.get('horizon_days', 7))
+            limit = int(request.args.get('limit', 5))
+            first_day = datetime.strptime(date_param or '', '%Y-%m-%d').date()
+            earliest_minutes = time_to_minutes(start_time)
+        except ValueError:
+            return jsonify({
+                'error': 'Missing or invalid parameters',
+                'required': ['duration', 'date']
+            }), 400
+
+        if duration <= 0 or duration > 24 * 60:
+            return jsonify({'error': 'duration must be between 1 and 1440 minutes'}), 400
+        horizon_days = max(1, min(horizon_days, MAX_NEXT_HORIZON_DAYS))
+        limit = max(1, min(limit, MAX_NEXT_RESULTS))
+
+        if stores_param:
+            store_ids = [s.strip() for s in stores_param.split(',') if s.strip()]
+            invalid = [s for s in store_ids if s not in STORE_CONFIG]
+            if invalid:
+                return jsonify({
+                    'error': f'Invalid store: {", ".join(invalid)}',
+                    'valid_stores': list(STORE_CONFIG.keys())
+                }), 400
+        else:
+            store_ids = list(STORE_CONFIG.keys())
+
+        # 検索対象（店舗, 部屋, 定員）。部屋がない店舗は店舗全体を1単位とする
+        targets = []
+        for store_id in store_ids:
+            rooms = STORE_CONFIG[store_id].get('rooms')
+            if rooms:
+                for room_name, room_info in rooms.items():
+                    if not room_filter or room_filter == room_name:
+                        targets.append((store_id, room_name, room_info.get('max_capacity', 1)))
+            elif not room_filter:
+                targets.append((store_id, None, STORE_CONFIG[store_id]['max_slots']))
+
+        last_day = first_day + timedelta(days=horizon_days - 1)
+
+        # 期間内の予約を1回のクエリで取得し、(日, 店舗, 部屋) ごとにまとめる
+        conn = get_read_db_conn()
+        try:
+            with conn.cursor() as cur:
+                rows = fetch_range_reservations(
+                    cur, first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'),
+                    store_ids if stores_param else None
+                )
+        finally:
+            return_db_conn(conn)
+
+        booked = {}
+        for store, res_date, res_start, res_end, room_name in rows:
+            rooms = STORE_CONFIG.get(store, {}).get('rooms')
+            key = (res_date, store, room_name if rooms else None)
+            booked.setdefault(key, []).append((res_start, res_end, room_name))
+
+        candidates = []
+        for day_offset in range(horizon_days):
+            day = first_day + timedelta(days=day_offset)
+            earliest = earliest_minutes if day_offset == 0 else 0
+            day_candidates = []
+
+            for store_id, room_name, capacity in targets:
+                open_minutes, close_minutes = clip_to_store_hours(STORE_CONFIG[store_id], 0, 24 * 60)
+                blocked = saturated_intervals(booked.get((day, store_id, room_name), []), capacity)
+                for start in feasible_starts(blocked, open_minutes, close_minutes,
+                                             duration, earliest, limit):
+                    day_candidates.append((start, store_id, room_name))
+
+            # 同じ日の候補は開始時刻順（同時刻は店舗・部屋の定義順）
+            day_candidates.sort(key=lambda c: c[0])
+            for start, store_id, room_name in day_candidates:
+                candidates.append({
+                    'store': store_id,
+                    'store_name': STORE_CONFIG[store_id]['name_jp'],
+                    'room_name': room_name,
+                    'date': day.strftime('%Y-%m-%d'),
+                    'start': minutes_to_time(start),
+                    'end': minutes_to_time(start + duration)
+                })
+            if len(candidates) >= limit:
+                break
+
+        return jsonify({
+            'duration': duration,
+            'date': date_param,
+            'start_time': start_time,
+            'horizon_days': horizon_days,
+            'candidates': candidates[:limit]
+        }), 200
+
+    except Exception as e:
+        log_activity(f'availability_next error: {str(e)}')
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
@@ -2100,6 +3820,46 @@ def get_stores():
         }), 500
 
 
+# --- DB Timing ---
+@app.after_request
+def add_server_timing(response):
+    """
+    リクエスト内でのDB接続の待ち時間・保持時間・クエリ時間を Server-Timing ヘッダーで返し、
+    エンドポイントごとのリクエストあたりのクエリ数を記録
+
+    例: Server-Timing: db-wait;dur=0.02, db-hold;dur=5.31, db-query;dur=3.90;desc="3 queries"
+    リードレプリカを設定している場合、読み取りAPIは読み取り先も返す（db-read;desc="replica" / "primary"）。
+    ストリーミングのレスポンスなど、レスポンスを返した後に返却された接続は含まれない。
+    """
+    timing = g.pop('db_timing', None)
+    if timing is None:
+        return response
+    if db_pool is not None:
+        db_pool.record_request(request.endpoint or request.path, timing['queries'])
+    metrics = [
+        f"db-wait;dur={timing['wait'] * 1000:.2f}",
+        f"db-hold;dur={timing['hold'] * 1000:.2f}",
+        f"db-query;dur={timing['query_seconds'] * 1000:.2f};desc=\"{timing['queries']} queries\"",
+    ]
+    if g.get('db_read_target'):
+        metrics.append(f"db-read;desc=\"{g.db_read_target}\"")
+    response.headers.add('Server-Timing', ', '.join(metrics))
+    return response
+
+@app.after_request
+def stick_admin_reads_to_primary(response):
+    """
+    管理者が書き込んだ後 DB_READ_STICKY_SECONDS 秒間は、そのセッションの読み取りをプライマリで行う
+
+    リードレプリカの遅延で、追加・削除した予約が直後の画面に出ないことを防ぐ（read-your-writes）。
+    セッション（Cookie）に保存するため、別のインスタンスに振り分けられても有効
+    （そのインスタンスの読み取りキャッシュは conditional_json() が変更カウンタで確認してから使う）。
+    """
+    if (os.environ.get('POSTGRES_READ_URL') and request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400 and is_logged_in()):
+        session[DB_READ_PRIMARY_UNTIL_KEY] = time.time() + DB_READ_STICKY_SECONDS
+    return response
+
 # --- Security Headers ---
 @app.after_request
 def set_security_headers(response):
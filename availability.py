@@ -0,0 +1,488 @@
+"""
+空き状況計算モジュール（占有エンジン）
+
+店舗・日付ごとの予約を1回のクエリで取得し、30分スロットごとの
+同時利用数をPython側のスイープ処理で計算します。
+スロットごとにCOUNTクエリを発行しないため、検索時間帯の幅に関係なく
+DBへの問い合わせは1回で済みます。
+
+複数日の検索では、予約を 部屋（または店舗）× 日 × スロット の
+NumPy配列に展開し、空き枠数や空き時間帯をベクトル演算で求めます。
+"""
+import numpy as np
+
+from query_registry import register_query, execute_query
+
+# 空き状況を判定する時間スロットの単位（分）
+SLOT_MINUTES = 30
+
+
+def time_to_minutes(t):
+    """
+    時刻を0時からの経過分に変換
+
+    Args:
+        t (str | datetime.time): 時刻（HH:MM）またはtimeオブジェクト
+
+    Returns:
+        int: 0時からの経過分
+    """
+    if isinstance(t, str):
+        h, m = map(int, t.split(':')[:2])
+        return h * 60 + m
+    return t.hour * 60 + t.minute
+
+
+def minutes_to_time(minutes):
+    """
+    0時からの経過分を時刻文字列（HH:MM）に変換
+    """
+    h, m = divmod(int(minutes), 60)
+    return f"{h:02d}:{m:02d}"
+
+
+def generate_slots(start_minutes, end_minutes, step=SLOT_MINUTES):
+    """
+    検索範囲内のスロット開始時刻（分）を生成
+
+    既存APIと同じく、開始時刻から30分刻みで終了時刻未満まで生成します。
+    """
+    return list(range(start_minutes, end_minutes, step))
+
+
+DAY_RESERVATIONS_QUERY = register_query('availability_day_reservations', """
+    SELECT start_time, end_time, room_name
+    FROM reservations
+    WHERE store = %s AND date = %s
+""")
+
+
+def fetch_day_reservations(cur, store, date):
+    """
+    店舗・日付の予約を1回のクエリで取得
+
+    Args:
+        cur: psycopg2カーソル（タプルを返すもの）
+        store (str): 店舗ID
+        date (str): 日付（YYYY-MM-DD）
+
+    Returns:
+        list: (開始分, 終了分, 部屋名) のタプルのリスト
+    """
+    execute_query(cur, DAY_RESERVATIONS_QUERY, (store, date))
+    return [
+        (time_to_minutes(start), time_to_minutes(end), room_name)
+        for start, end, room_name in cur.fetchall()
+    ]
+
+
+def slot_occupancy(reservations, slots, distinct_rooms=False):
+    """
+    各スロット時点の同時利用数を計算（開始・終了イベントのスイープ）
+
+    スロット時刻 t において start <= t < end を満たす予約を「利用中」とします。
+    これは従来のスロットごとのSQL（start_time <= slot AND end_time > slot）と同じ判定です。
+
+    Args:
+        reservations (list): (開始分, 終了分, 部屋名) のタプルのリスト
+        slots (list): スロット時刻（分）のリスト
+        distinct_rooms (bool): Trueの場合は予約数ではなく使用中の部屋数を数える
+            （COUNT(DISTINCT room_name) と同じく部屋名がNULLの予約は数えない）
+
+    Returns:
+        list: slots と同じ順序の同時利用数のリスト
+    """
+    # 開始・終了をイベント化（開始>=終了の予約はどのスロットにも該当しないので除外）
+    events = []
+    for start, end, room_name in reservations:
+        if start >= end:
+            continue
+        events.append((start, 1, room_name))
+        events.append((end, -1, room_name))
+    events.sort(key=lambda e: e[0])
+
+    order = sorted(range(len(slots)), key=lambda i: slots[i])
+    result = [0] * len(slots)
+
+    active = 0
+    room_counts = {}
+    active_rooms = 0
+    pos = 0
+    for i in order:
+        t = slots[i]
+        # t 以前に発生したイベントをすべて適用
+        while pos < len(events) and events[pos][0] <= t:
+            _, delta, room_name = events[pos]
+            active += delta
+            if room_name is not None:
+                before = room_counts.get(room_name, 0)
+                after = before + delta
+                room_counts[room_name] = after
+                if before <= 0 < after:
+                    active_rooms += 1
+                elif after <= 0 < before:
+                    active_rooms -= 1
+            pos += 1
+        result[i] = active_rooms if distinct_rooms else active
+
+    return result
+
+
+def peak_occupancy(reservations, start_minutes, end_minutes, distinct_rooms=False):
+    """
+    検索範囲内の最大同時利用数を計算
+
+    Args:
+        reservations (list): (開始分, 終了分, 部屋名) のタプルのリスト
+        start_minutes (int): 検索開始（分）
+        end_minutes (int): 検索終了（分）
+        distinct_rooms (bool): 使用中の部屋数で数える場合True
+
+    Returns:
+        int: 最大同時利用数（スロットがない場合は0）
+    """
+    slots = generate_slots(start_minutes, end_minutes)
+    return max(slot_occupancy(reservations, slots, distinct_rooms), default=0)
+
+
+DATE_RESERVATIONS_QUERY = register_query('availability_date_reservations', """
+    SELECT store, start_time, end_time, room_name
+    FROM reservations
+    WHERE date = %s
+""")
+
+
+def fetch_date_reservations(cur, date):
+    """
+    指定日の全店舗の予約を1回のクエリで取得し、店舗ごとにまとめる
+
+    Args:
+        cur: psycopg2カーソル（タプルを返すもの）
+        date (str): 日付（YYYY-MM-DD）
+
+    Returns:
+        dict: {店舗ID: [(開始分, 終了分, 部屋名), ...]}
+    """
+    execute_query(cur, DATE_RESERVATIONS_QUERY, (date,))
+    by_store = {}
+    for store, start, end, room_name in cur.fetchall():
+        by_store.setdefault(store, []).append(
+            (time_to_minutes(start), time_to_minutes(end), room_name)
+        )
+    return by_store
+
+
+def clip_to_store_hours(store_info, start_minutes, end_minutes):
+    """
+    検索範囲を店舗の営業時間でクリップ
+
+    Returns:
+        tuple: (開始分, 終了分)。営業時間外の場合は開始 >= 終了 になる
+    """
+    store_hours = store_info.get('hours', {'start': 0, 'end': 24})
+    open_minutes = int(store_hours['start'] * 60)
+    close_minutes = int(store_hours['end'] * 60)
+    return max(start_minutes, open_minutes), min(end_minutes, close_minutes)
+
+
+def free_ranges(slots, occupancy, capacity, end_limit):
+    """
+    空きスロット（利用数 < 定員）の連続区間をまとめる
+
+    Args:
+        slots (list): スロット時刻（分、昇順）
+        occupancy (list): 各スロットの利用数
+        capacity (int): 定員
+        end_limit (int): 区間終了の上限（分）。営業終了時刻など
+
+    Returns:
+        list: (開始分, 終了分) のタプルのリスト
+    """
+    ranges = []
+    range_start = None
+    for i, slot in enumerate(slots):
+        if occupancy[i] < capacity:
+            if range_start is None:
+                range_start = slot
+            # 終了時刻は最後の空きスロット + 30分
+            is_last = i + 1 == len(slots) or occupancy[i + 1] >= capacity
+            if is_last:
+                ranges.append((range_start, min(slot + SLOT_MINUTES, end_limit)))
+                range_start = None
+    return ranges
+
+
+def hourly_min_remaining(reservations, start_minutes, end_minutes, max_slots):
+    """
+    1時間単位で、その時間内の30分スロットの最小空き枠数を計算
+
+    Returns:
+        list: (時間帯開始分, 時間帯終了分, 最小空き枠数) のタプルのリスト
+    """
+    slots = generate_slots(start_minutes, end_minutes)
+    occupancy = dict(zip(slots, slot_occupancy(reservations, slots)))
+
+    hours = []
+    for hour_start in range(start_minutes, end_minutes, 60):
+        hour_end = min(hour_start + 60, end_minutes)
+        remaining = [max_slots - occupancy[slot] for slot in generate_slots(hour_start, hour_end)]
+        hours.append((hour_start, hour_end, min(remaining) if remaining else 0))
+    return hours
+
+
+RANGE_RESERVATIONS_QUERY = register_query('availability_range_reservations', """
+    SELECT store, date, start_time, end_time, room_name
+    FROM reservations
+    WHERE date BETWEEN %s AND %s
+""")
+RANGE_RESERVATIONS_STORES_QUERY = register_query('availability_range_reservations_stores', """
+    SELECT store, date, start_time, end_time, room_name
+    FROM reservations
+    WHERE date BETWEEN %s AND %s AND store = ANY(%s)
+""", ('date', 'date', 'text[]'))
+
+
+def fetch_range_reservations(cur, date_from, date_to, stores=None):
+    """
+    期間内の予約を1回のクエリで取得
+
+    Args:
+        cur: psycopg2カーソル（タプルを返すもの）
+        date_from (str): 開始日（YYYY-MM-DD、この日を含む）
+        date_to (str): 終了日（YYYY-MM-DD、この日を含む）
+        stores (list): 対象店舗IDのリスト（Noneの場合は全店舗）
+
+    Returns:
+        list: (店舗ID, 日付, 開始分, 終了分, 部屋名) のタプルのリスト
+    """
+    if stores:
+        execute_query(cur, RANGE_RESERVATIONS_STORES_QUERY, (date_from, date_to, list(stores)))
+    else:
+        execute_query(cur, RANGE_RESERVATIONS_QUERY, (date_from, date_to))
+    return [
+        (store, res_date, time_to_minutes(start), time_to_minutes(end), room_name)
+        for store, res_date, start, end, room_name in cur.fetchall()
+    ]
+
+
+def build_occupancy_matrix(entries, num_rows, num_days, slots):
+    """
+    予約を 行 × 日 × スロット の利用数行列に展開
+
+    各予約が占有するスロット範囲 [lo, hi) を二分探索で求め、差分配列に
+    +1/-1 を加算してからスロット方向に累積和を取ります。
+    判定は slot_occupancy と同じ start <= slot < end です。
+
+    Args:
+        entries (list): (行インデックス, 日インデックス, 開始分, 終了分) のタプルのリスト
+        num_rows (int): 行数（店舗または部屋の数）
+        num_days (int): 日数
+        slots (list): スロット時刻（分、昇順）
+
+    Returns:
+        numpy.ndarray: 形状 (num_rows, num_days, len(slots)) の利用数行列
+    """
+    slot_array = np.asarray(slots, dtype=np.int32)
+    diff = np.zeros((num_rows, num_days, len(slots) + 1), dtype=np.int32)
+    if entries:
+        data = np.asarray(entries, dtype=np.int32)
+        rows, days, starts, ends = data.T
+        lo = np.searchsorted(slot_array, starts, side='left')
+        hi = np.searchsorted(slot_array, ends, side='left')
+        valid = lo < hi
+        np.add.at(diff, (rows[valid], days[valid], lo[valid]), 1)
+        np.add.at(diff, (rows[valid], days[valid], hi[valid]), -1)
+    return np.cumsum(diff[:, :, :-1], axis=2)
+
+
+def free_ranges_matrix(free_mask, slots, end_limit):
+    """
+    空きフラグ行列（日 × スロット）から、日ごとの連続した空き時間帯を求める
+
+    Args:
+        free_mask (numpy.ndarray): 形状 (日数, スロット数) のbool配列
+        slots (list): スロット時刻（分、昇順）
+        end_limit (int): 区間終了の上限（分）
+
+    Returns:
+        list: 日ごとの (開始分, 終了分) タプルのリスト
+    """
+    num_days = free_mask.shape[0]
+    slot_array = np.asarray(slots, dtype=np.int32)
+    padded = np.zeros((num_days, free_mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = free_mask
+    edges = np.diff(padded, axis=1)
+    start_days, start_idx = np.nonzero(edges == 1)
+    _, end_idx = np.nonzero(edges == -1)
+
+    # 終了時刻は最後の空きスロット + 30分（上限でクリップ）
+    range_starts = slot_array[start_idx]
+    range_ends = np.minimum(slot_array[end_idx - 1] + SLOT_MINUTES, end_limit)
+
+    ranges = [[] for _ in range(num_days)]
+    for day, s, e in zip(start_days.tolist(), range_starts.tolist(), range_ends.tolist()):
+        ranges[day].append((s, e))
+    return ranges
+
+
+def free_ranges_remaining_matrix(occupancy, capacity, slots, end_limit):
+    """
+    利用数行列（日 × スロット）から、日ごとの連続した空き時間帯と残り枠数を求める
+
+    残り枠数は時間帯内で最も利用数が多いスロットの空き（その時間帯を通して確実に空いている枠数）。
+    1日分の free_ranges() の区間に残り枠数を付けたものと同じです。
+
+    Args:
+        occupancy (numpy.ndarray): 形状 (日数, スロット数) の利用数
+        capacity (int): 定員
+        slots (list): スロット時刻（分、昇順）
+        end_limit (int): 区間終了の上限（分）
+
+    Returns:
+        list: 日ごとの (開始分, 終了分, 残り枠数) タプルのリスト
+    """
+    slot_array = np.asarray(slots, dtype=np.int32)
+    ranges = []
+    for day, day_ranges in enumerate(free_ranges_matrix(occupancy < capacity, slots, end_limit)):
+        day_result = []
+        for s, e in day_ranges:
+            first, last = np.searchsorted(slot_array, (s, e))
+            day_result.append((s, e, int(capacity - occupancy[day, first:last].max())))
+        ranges.append(day_result)
+    return ranges
+
+
+def saturated_intervals(reservations, capacity):
+    """
+    同時利用数が定員に達している区間を求める（空き検索用の区間インデックス）
+
+    予約は半開区間 [開始, 終了) として扱い、同時刻の終了は開始より先に処理します。
+
+    Args:
+        reservations (list): (開始分, 終了分, 部屋名) のタプルのリスト
+        capacity (int): 定員
+
+    Returns:
+        list: 満室区間 (開始分, 終了分) の昇順リスト（隣接区間は結合済み）
+    """
+    events = []
+    for start, end, _ in reservations:
+        if start < end:
+            events.append((start, 1))
+            events.append((end, -1))
+    events.sort()
+
+    intervals = []
+    active = 0
+    full_since = None
+    for t, delta in events:
+        active += delta
+        if full_since is None and active >= capacity:
+            full_since = t
+        elif full_since is not None and active < capacity:
+            if intervals and intervals[-1][1] == full_since:
+                intervals[-1] = (intervals[-1][0], t)
+            elif full_since < t:
+                intervals.append((full_since, t))
+            full_since = None
+    return intervals
+
+
+def feasible_starts(blocked, open_minutes, close_minutes, duration, earliest=0, limit=None):
+    """
+    満室区間を避けて、所要時間を確保できる開始時刻を30分刻みで列挙
+
+    Args:
+        blocked (list): 満室区間 (開始分, 終了分) の昇順リスト
+        open_minutes (int): 営業開始（分）
+        close_minutes (int): 営業終了（分）
+        duration (int): 所要時間（分）
+        earliest (int): これより前には開始しない（分）
+        limit (int): 最大件数（Noneの場合は無制限）
+
+    Returns:
+        list: 開始時刻（分）のリスト
+    """
+    starts = []
+    gap_start = open_minutes
+    for block_start, block_end in list(blocked) + [(close_minutes, close_minutes)]:
+        gap_end = min(block_start, close_minutes)
+        # 空き区間 [gap_start, gap_end) 内で30分刻みの開始時刻を探す
+        t = max(gap_start, earliest)
+        t = -(-t // SLOT_MINUTES) * SLOT_MINUTES
+        while t + duration <= gap_end:
+            starts.append(t)
+            if limit is not None and len(starts) >= limit:
+                return starts
+            t += SLOT_MINUTES
+        gap_start = max(gap_start, block_end)
+        if gap_start >= close_minutes:
+            break
+    return starts
+
+
+def room_slot_occupancy(reservations, rooms, slots):
+    """
+    部屋ごとの同時利用数と、定員を考慮した店舗全体の利用枠数を計算
+
+    部屋ごとに予約をまとめてスイープし、各スロットの利用数を求めます。
+    店舗全体の利用枠数は、各部屋の利用数を定員（max_capacity）で頭打ちにして合計します。
+    STORE_CONFIG にない部屋名は定員1の部屋として数え、部屋名がNULLの予約は数えません。
+
+    Args:
+        reservations (list): (開始分, 終了分, 部屋名) のタプルのリスト
+        rooms (dict): STORE_CONFIG の rooms（部屋名 → {'max_capacity': n, ...}）
+        slots (list): スロット時刻（分）のリスト
+
+    Returns:
+        tuple: ({部屋名: 各スロットの利用数リスト}, 各スロットの店舗全体の利用枠数リスト)
+    """
+    by_room = {room_name: [] for room_name in rooms}
+    for reservation in reservations:
+        room_name = reservation[2]
+        if room_name is not None:
+            by_room.setdefault(room_name, []).append(reservation)
+
+    per_room = {}
+    store_used = [0] * len(slots)
+    for room_name, room_reservations in by_room.items():
+        counts = slot_occupancy(room_reservations, slots)
+        capacity = rooms.get(room_name, {}).get('max_capacity', 1)
+        for i, count in enumerate(counts):
+            store_used[i] += min(count, capacity)
+        if room_name in rooms:
+            per_room[room_name] = counts
+    return per_room, store_used
+
+
+KEYS_RESERVATIONS_QUERY = register_query('availability_keys_reservations', """
+    SELECT store, date, start_time, end_time, room_name
+    FROM reservations
+    WHERE store = ANY(%s) AND date = ANY(%s::date[])
+""", ('text[]', 'text[]'))
+
+
+def fetch_reservations_for_keys(cur, keys):
+    """
+    複数の (店舗, 日付) の予約を1回のクエリで取得
+
+    Args:
+        cur: psycopg2カーソル（タプルを返すもの）
+        keys (iterable): (店舗ID, 日付文字列 YYYY-MM-DD) のタプル
+
+    Returns:
+        dict: {(店舗ID, 日付文字列): [(開始分, 終了分, 部屋名), ...]}
+            （予約がないキーも空リストで含む）
+    """
+    result = {key: [] for key in keys}
+    if not result:
+        return result
+
+    stores = sorted({store for store, _ in result})
+    dates = sorted({date for _, date in result})
+    execute_query(cur, KEYS_RESERVATIONS_QUERY, (stores, dates))
+    for store, res_date, start, end, room_name in cur.fetchall():
+        key = (store, res_date.strftime('%Y-%m-%d'))
+        if key in result:
+            result[key].append((time_to_minutes(start), time_to_minutes(end), room_name))
+    return result
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+接続プールの取得・返却オーバーヘッドのマイクロベンチマーク
+
+1リクエスト = 接続の取得 → SELECT 1件 → 返却 として、次の2つを比較します。
+
+- before: 従来の SimpleConnectionPool + 取得のたびに SELECT 1 で生存確認
+- after:  db_pool.ConnectionPool（一定時間使われていなかった接続だけを確認）
+
+それぞれ 1スレッド と 複数スレッド（Flaskのスレッド実行を想定）で計測し、
+1リクエストあたりのプール関連の時間（µs）を表示します。
+before の複数スレッドは SimpleConnectionPool がスレッドセーフでないため計測しません。
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python benchmark_db_pool.py              # 5,000 リクエスト, 8 スレッド
+    python benchmark_db_pool.py 20000 16     # リクエスト数・スレッド数を指定
+"""
+import os
+import sys
+import threading
+import time
+
+from psycopg2.pool import SimpleConnectionPool
+
+from db_pool import ConnectionPool
+
+
+class PingingPool:
+    """従来の取得処理（SimpleConnectionPool + 毎回 SELECT 1）"""
+
+    def __init__(self, minconn, maxconn, dsn):
+        self._pool = SimpleConnectionPool(minconn, maxconn, dsn)
+
+    def getconn(self):
+        conn = self._pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        return conn
+
+    def putconn(self, conn):
+        self._pool.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+def request(pool):
+    """1リクエスト分の処理を実行し、プールの取得・返却にかかった時間を返す"""
+    start = time.perf_counter()
+    conn = pool.getconn()
+    acquired = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute('SELECT 1')
+        cur.fetchone()
+    conn.commit()
+    released = time.perf_counter()
+    pool.putconn(conn)
+    end = time.perf_counter()
+    return (acquired - start) + (end - released)
+
+
+def run(pool, count, threads):
+    """count 件のリクエストを threads スレッドで実行し、(プール時間µs/件, 全体µs/件) を返す"""
+    per_thread = count // threads
+    overheads = []
+    lock = threading.Lock()
+
+    def worker():
+        total = sum(request(pool) for _ in range(per_thread))
+        with lock:
+            overheads.append(total)
+
+    # 接続を作る時間は含めない
+    for _ in range(threads):
+        request(pool)
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    done = per_thread * threads
+    return sum(overheads) / done * 1e6, elapsed / done * 1e6 * threads
+
+
+def main():
+    database_url = os.environ.get('POSTGRES_URL')
+    if not database_url:
+        print("❌ POSTGRES_URL environment variable is not set")
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    print(f"{'pool':<8} {'threads':>7} {'pool µs/req':>12} {'total µs/req':>13}")
+    for name, factory, thread_counts in (
+        ('before', lambda: PingingPool(1, 20, database_url), (1,)),
+        ('after', lambda: ConnectionPool(1, 20, database_url), (1, threads)),
+    ):
+        for n in thread_counts:
+            pool = factory()
+            try:
+                overhead, total = run(pool, count, n)
+            finally:
+                pool.closeall()
+            print(f"{name:<8} {n:>7} {overhead:>12,.1f} {total:>13,.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+プリペアドステートメント（query_registry）のベンチマーク
+
+空き状況と webhook の取り込みでよく実行されるクエリについて、次の2つを比較します。
+
+- plain:    通常の実行（毎回 構文解析 → 実行計画の作成 → 実行）
+- prepared: 接続ごとに1回 PREPARE し、以降は EXECUTE
+
+1本の接続での 1回あたりの時間（µs、1リクエスト = 1トランザクションとして計測）と
+EXPLAIN ANALYZE の Planning Time（サーバーでの実行計画の作成時間）に加えて、
+アプリと同じく接続プール（db_pool.ConnectionPool、server モードの設定）から複数スレッドで
+取得 → クエリ → 返却 を間隔をあけて繰り返したとき（同時に使う本数が増減する）の
+1リクエストあたりの時間（取得から返却まで）と新規接続数を表示します。
+プールが返却した接続を保持しない（max_idle < maxconn）と、接続し直すたびに PREPARE が必要になるため
+プリペアドステートメントは使いません（その場合の新規接続数も比較用に表示）。
+専用のスキーマ（bench_prepared、終了時に削除）にテーブルを作るため、本番テーブルには触れません。
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python benchmark_prepared_statements.py                 # 50,000 件, 各 2,000 回, 8 スレッド
+    python benchmark_prepared_statements.py 200000 5000 16  # 件数・回数・スレッド数を指定
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+from availability import (
+    DAY_RESERVATIONS_QUERY, RANGE_RESERVATIONS_STORES_QUERY, fetch_day_reservations, fetch_range_reservations
+)
+from db_pool import ConnectionPool, InstrumentedConnection
+from ingest import EMAIL_POSITIONS_QUERY, fetch_email_positions
+
+STORES = ['shibuya', 'yoyogi-uehara', 'nakameguro', 'ebisu', 'hanzomon']
+SCHEMA = 'bench_prepared'
+# 接続プールの計測で、各スレッドがリクエストの間にあける時間（秒、リクエストごとに 0〜4倍）
+THINK_SECONDS = 0.0005
+
+
+class CountingConnection(InstrumentedConnection):
+    """新規接続数を数える接続"""
+    connects = 0
+    _connects_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._connects_lock:
+            CountingConnection.connects += 1
+
+
+def create_table(cur, count):
+    """専用スキーマに、本番と同じ列・インデックスを持つテーブルを作って予約を投入"""
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute("""
+        CREATE TABLE reservations (
+            id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+            customer_name VARCHAR(100), room_name VARCHAR(50), store VARCHAR(50),
+            type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255),
+            is_cancellation BOOLEAN DEFAULT FALSE
+        )
+    """)
+    cur.execute("""
+        INSERT INTO reservations (date, start_time, end_time, room_name, store, type, email_id)
+        SELECT DATE '2024-01-01' + (i / 40), make_time(8 + i %% 13, 0, 0), make_time(9 + i %% 13, 0, 0),
+               CASE WHEN i %% 2 = 0 THEN '個室A' ELSE '個室B' END,
+               (%s::text[])[1 + i %% 5], 'gmail', 'mail-' || i
+        FROM generate_series(0, %s - 1) AS i
+    """, (STORES, count))
+    cur.execute("CREATE INDEX ON reservations (store, date)")
+    cur.execute("CREATE INDEX ON reservations (date, start_time, id)")
+    cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+    cur.execute("ANALYZE reservations")
+
+
+def workloads(count):
+    """(名前, 登録したクエリ, 実行する関数, EXPLAIN するパラメータ)"""
+    items = [{'kind': 'email', 'store': STORES[i % 5], 'email_id': f'mail-{i * 97 % count}'} for i in range(20)]
+
+    def day(cur, i):
+        fetch_day_reservations(cur, STORES[i % 5], f'2024-01-{1 + i % 28:02d}')
+
+    def stores(cur, i):
+        fetch_range_reservations(cur, '2024-02-01', '2024-02-07', STORES[:2])
+
+    def webhook(cur, i):
+        fetch_email_positions(cur, items)
+
+    return [
+        ('availability (day)', DAY_RESERVATIONS_QUERY, day, ('shibuya', '2024-01-01')),
+        ('availability (range)', RANGE_RESERVATIONS_STORES_QUERY, stores, ('2024-02-01', '2024-02-07', STORES[:2])),
+        ('webhook email_id', EMAIL_POSITIONS_QUERY, webhook,
+         ([item['store'] for item in items], [item['email_id'] for item in items])),
+    ]
+
+
+def per_call_us(conn, run, iterations):
+    """1トランザクションに1回実行したときの平均時間（µs）"""
+    cur = conn.cursor()
+    for i in range(20):
+        run(cur, i)
+        conn.rollback()
+    start = time.perf_counter()
+    for i in range(iterations):
+        run(cur, i)
+        cur.fetchall()
+        conn.rollback()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def pooled_per_request_us(database_url, run, iterations, threads, prepare_statements, max_idle=None):
+    """
+    接続プールから threads 本のスレッドで 取得 → クエリ → 返却 を間隔をあけて繰り返したときの
+    1リクエストあたりの平均時間（µs、取得から返却まで）と新規接続数
+    """
+    CountingConnection.connects = 0
+    pool = ConnectionPool(1, threads, database_url, max_idle=max_idle, prepare_statements=prepare_statements,
+                          connection_factory=CountingConnection, options=f'-c search_path={SCHEMA}')
+    counter = iter(range(iterations))
+    lock = threading.Lock()
+    elapsed = []
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            time.sleep(THINK_SECONDS * (i % 5))
+            start = time.perf_counter()
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    run(cur, i)
+                    cur.fetchall()
+                conn.rollback()
+            finally:
+                pool.putconn(conn)
+            with lock:
+                elapsed.append(time.perf_counter() - start)
+
+    try:
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return sum(elapsed) / len(elapsed) * 1e6, CountingConnection.connects
+    finally:
+        pool.closeall()
+
+
+def planning_ms(conn, sql, params):
+    """EXPLAIN ANALYZE の Planning Time（ms、5回の中央値）"""
+    times = []
+    with conn.cursor() as cur:
+        for _ in range(5):
+            cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            times.append(plan[0]['Planning Time'])
+    conn.rollback()
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    database_url = os.environ.get('POSTGRES_URL')
+    if not database_url:
+        print("❌ POSTGRES_URL environment variable is not set")
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    conn = psycopg2.connect(database_url, connection_factory=InstrumentedConnection,
+                            options=f'-c search_path={SCHEMA}')
+    try:
+        with conn.cursor() as cur:
+            create_table(cur, count)
+        conn.commit()
+
+        print(f"{count:,} reservations, {iterations:,} calls each")
+        print("single connection:")
+        print(f"{'query':<22} {'plain µs':>9} {'prepared µs':>12} {'saved':>7}"
+              f" {'plan ms (plain)':>16} {'plan ms (prepared)':>19}")
+        for name, query, run, params in workloads(count):
+            conn.prepared_statements = None
+            plain = per_call_us(conn, run, iterations)
+            plain_plan = planning_ms(conn, query.sql, params)
+
+            conn.prepared_statements = set()
+            conn.prepared_statements_verified = False
+            prepared = per_call_us(conn, run, iterations)
+            prepared_plan = planning_ms(conn, query.execute_sql, query.execute_params(params))
+
+            print(f"{name:<22} {plain:>9.1f} {prepared:>12.1f} {1 - prepared / plain:>7.0%}"
+                  f" {plain_plan:>16.3f} {prepared_plan:>19.3f}")
+
+        print(f"connection pool, {threads} threads (µs per request / new connections):")
+        print(f"{'query':<22} {'plain':>14} {'prepared':>14} {'saved':>7} {'max_idle=1':>14}")
+        for name, query, run, params in workloads(count):
+            plain, plain_connects = pooled_per_request_us(database_url, run, iterations, threads, False)
+            prepared, prepared_connects = pooled_per_request_us(database_url, run, iterations, threads, True)
+            # 返却した接続を1本しか保持しない場合（プリペアドステートメントは使われない）
+            churn, churn_connects = pooled_per_request_us(database_url, run, iterations, threads, True, max_idle=1)
+            print(f"{name:<22} {plain:>8.1f} / {plain_connects:<3} {prepared:>8.1f} / {prepared_connects:<3}"
+                  f" {1 - prepared / plain:>7.0%} {churn:>8.1f} / {churn_connects:<3}")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
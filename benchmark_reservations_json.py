@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+/api/reservations のJSON生成ベンチマーク
+
+従来のPython経路（RealDictCursor → 行ごとにdict作成 → jsonify相当のシリアライズ）と、
+PostgreSQLでJSONを組み立てて文字列をそのまま返す経路（fetch_reservations_json）を比較します。
+
+- 一時テーブル reservations に指定件数のダミー予約を投入（本番テーブルには触れない）
+- 1リクエストあたりの 経過時間 / Pythonプロセスの CPU時間 / tracemalloc のピークメモリ を計測
+  （CPU時間はPythonプロセスのみ。PostgreSQL側の処理時間は経過時間に含まれる）
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python benchmark_reservations_json.py            # 1,000 / 10,000 / 100,000 件
+    python benchmark_reservations_json.py 100000     # 件数を指定
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+DATE_FROM = '2025-01-01'
+DATE_TO = '2025-12-31'
+REPEAT = 3
+
+
+def load_rows(cur, count):
+    """一時テーブルにダミー予約を投入（1年間に均等に分散、店舗・部屋・種別はローテーション）"""
+    cur.execute("DROP TABLE IF EXISTS pg_temp.reservations")
+    cur.execute("""
+        CREATE TEMP TABLE reservations (
+            id SERIAL PRIMARY KEY,
+            date DATE, start_time TIME, end_time TIME,
+            customer_name VARCHAR(100), type VARCHAR(20), is_cancellation BOOLEAN DEFAULT FALSE,
+            store VARCHAR(50), room_name VARCHAR(50)
+        )
+    """)
+    cur.execute("""
+        INSERT INTO reservations (date, start_time, end_time, customer_name, type, store, room_name)
+        SELECT DATE '2025-01-01' + (i %% 365),
+               TIME '09:00' + ((i %% 24) * INTERVAL '30 minutes'),
+               TIME '10:00' + ((i %% 24) * INTERVAL '30 minutes'),
+               'お客様' || i,
+               (ARRAY['gmail', 'manual'])[1 + i %% 2],
+               (ARRAY['shibuya', 'yoyogiuehara', 'nakameguro', 'ebisu', 'hanzomon'])[1 + i %% 5],
+               (ARRAY['個室A', '個室B', NULL])[1 + i %% 3]
+        FROM generate_series(1, %s) AS i
+    """, (count,))
+    cur.execute("CREATE INDEX ON reservations (date, start_time, id)")
+    cur.execute("ANALYZE reservations")
+
+
+def python_path(app, conn):
+    """従来の経路: 行をdictで取得し、Pythonでグループ化してシリアライズ"""
+    from app import fetch_reservation_rows, group_reservation_rows
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        rows = fetch_reservation_rows(cur, DATE_FROM, DATE_TO)
+    result = group_reservation_rows(rows)
+    with app.app_context():
+        return app.json.dumps(result).encode()
+
+
+def postgres_path(app, conn):
+    """高速経路: PostgreSQLが組み立てたJSON文字列をそのまま返す"""
+    from app import fetch_reservations_json
+    with conn.cursor() as cur:
+        return fetch_reservations_json(cur, DATE_FROM, DATE_TO).encode()
+
+
+def measure(func, app, conn):
+    """最良の 経過時間・CPU時間（REPEAT回）と、ピークメモリ・レスポンスサイズを返す"""
+    wall_best, cpu_best = None, None
+    for _ in range(REPEAT):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func(app, conn)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        wall_best = wall if wall_best is None else min(wall_best, wall)
+        cpu_best = cpu if cpu_best is None else min(cpu_best, cpu)
+
+    # tracemalloc は実行を遅くするため、メモリは別の1回で計測
+    tracemalloc.start()
+    body = func(app, conn)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return wall_best, cpu_best, peak, len(body)
+
+
+def main():
+    if not os.environ.get('POSTGRES_URL'):
+        print("❌ POSTGRES_URL environment variable is not set")
+        sys.exit(1)
+
+    import app as app_module
+    app = app_module.app
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+    conn = psycopg2.connect(os.environ['POSTGRES_URL'])
+    try:
+        print(f"{'rows':>8} {'path':<9} {'wall ms':>9} {'cpu ms':>9} {'peak MB':>9} {'bytes':>11}")
+        for count in counts:
+            with conn.cursor() as cur:
+                load_rows(cur, count)
+            for name, func in (('python', python_path), ('postgres', postgres_path)):
+                wall, cpu, peak, size = measure(func, app, conn)
+                print(f"{count:>8} {name:<9} {wall * 1000:>9.1f} {cpu * 1000:>9.1f} "
+                      f"{peak / 1024 / 1024:>9.2f} {size:>11,}")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
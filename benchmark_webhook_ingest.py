@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+GAS webhook 取り込みのスループット・ベンチマーク
+
+履歴の再取り込み（clear-gmail-reservations → GASの全件再送）を想定し、
+同じバッチを3つの方法で反映して 1秒あたりの件数 を比較します。
+
+- legacy: 従来の1件ずつの処理（SELECT → UPDATE / INSERT）
+- values: execute_values による一括処理（ingest.apply_reservation_batch, use_copy=False）
+- copy:   COPY で一時テーブルに投入してから一括処理（use_copy=True）
+
+それぞれ 新規取り込み（全件INSERT）と 再取り込み（全件UPDATE）を計測します。
+一時テーブル reservations を使うため、本番テーブルには触れません。
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python benchmark_webhook_ingest.py              # 1,000 / 10,000 / 50,000 件
+    python benchmark_webhook_ingest.py 10000        # 件数を指定
+"""
+import os
+import sys
+import time
+
+import psycopg2
+
+from ingest import apply_reservation_batch
+from test_ingest import legacy_apply
+
+STORES = ['shibuya', 'yoyogi-uehara', 'nakameguro', 'ebisu', 'hanzomon']
+
+
+def make_batch(count):
+    """GASが送るのと同じ形式のダミー予約（7割が email_id あり、1割がキャンセル）"""
+    batch = []
+    for i in range(count):
+        hour = 8 + i % 13
+        res = {
+            'store': STORES[i % len(STORES)],
+            'date': f'2024-{1 + i % 12:02d}-{1 + i // 12 % 28:02d}',
+            'start': f'{hour:02d}:00',
+            'end': f'{hour + 1:02d}:00',
+            'customer_name': f'お客様{i}',
+            'room_name': '個室A' if i % 2 else '個室B',
+            'type': 'gmail'
+        }
+        if i % 10 == 9:
+            res['is_cancellation'] = True
+        elif i % 10 < 7:
+            res['email_id'] = f'mail-{i}'
+        batch.append(res)
+    return batch
+
+
+def create_table(cur):
+    """本番と同じ列・一意インデックスを持つ一時テーブルを作成"""
+    cur.execute("DROP TABLE IF EXISTS pg_temp.reservations")
+    cur.execute("""
+        CREATE TEMP TABLE reservations (
+            id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+            customer_name VARCHAR(100), room_name VARCHAR(50), store VARCHAR(50),
+            type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255),
+            is_cancellation BOOLEAN DEFAULT FALSE
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+    cur.execute("CREATE INDEX ON reservations (store, date, start_time)")
+
+
+def run(cur, method, batch):
+    """1回分の取り込みを実行して経過時間を返す"""
+    start = time.perf_counter()
+    if method == 'legacy':
+        legacy_apply(cur, batch)
+    else:
+        apply_reservation_batch(cur, batch, use_copy=(method == 'copy'))
+    return time.perf_counter() - start
+
+
+def main():
+    database_url = os.environ.get('POSTGRES_URL')
+    if not database_url:
+        print("❌ POSTGRES_URL environment variable is not set")
+        sys.exit(1)
+
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        print(f"{'rows':>8} {'method':<8} {'insert rows/s':>14} {'update rows/s':>14}")
+        for count in counts:
+            batch = make_batch(count)
+            for method in ('legacy', 'values', 'copy'):
+                create_table(cur)
+                insert_time = run(cur, method, batch)
+                update_time = run(cur, method, batch)
+                conn.commit()
+                print(f"{count:>8} {method:<8} {count / insert_time:>14,.0f} {count / update_time:>14,.0f}")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
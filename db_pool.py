@@ -0,0 +1,469 @@
+"""
+PostgreSQL接続プール
+
+psycopg2 の ThreadedConnectionPool と同じくスレッドセーフで、次の機能を加えたものです。
+使っていない接続の一覧はこのクラスで管理します（ThreadedConnectionPool の非公開の属性に依存しない）。
+
+- 生存確認: 取得のたびに SELECT 1 を実行せず、idle_ping_seconds 以上使われていなかった接続だけを確認
+- 接続の寿命: max_age_seconds を超えた接続は閉じて作り直す（長時間の接続でのサーバー側の切断対策）
+- 壊れた接続の入れ替え: 壊れた接続だけを閉じてプールから外す（プール全体は作り直さない）
+- 取得の待機: 接続が maxconn 本すべて使用中の場合は timeout 秒まで返却を待つ
+  （ThreadedConnectionPool はすぐに PoolError を投げる）
+- 使っていない接続の保持数: max_idle 本まで（既定は maxconn 本。minconn=0 なら最初に必要になるまで接続しない）
+- プリペアドステートメント: prepare_statements=True の場合、接続ごとに PREPARE 済みのクエリ名を記録
+  （返却した接続をすべて保持する max_idle >= maxconn の場合のみ。閉じる接続では PREPARE の分だけ遅くなる）
+  （query_registry.execute_query() が使う）
+- 計測: 取得の待ち時間・保持時間・クエリ数を呼び出し元（エンドポイント）ごとに集計し、
+  leak_seconds 以上返却されていない接続は取得したときのスタックと一緒にログに出す（stats() で取得）
+"""
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+# この秒数以上使われていなかった接続は、渡す前に SELECT 1 で確認
+IDLE_PING_SECONDS = 30
+# この秒数を超えた接続は閉じて作り直す
+MAX_CONNECTION_AGE_SECONDS = 30 * 60
+# 接続が空くのを待つ最大秒数
+CHECKOUT_TIMEOUT_SECONDS = 10
+# 壊れた接続を外して取り直す最大回数
+MAX_CHECKOUT_ATTEMPTS = 3
+# この秒数以上返却されていない接続を返却漏れとしてログに出す
+LEAK_SECONDS = 60
+# 返却漏れのログに出すスタックの深さ
+LEAK_STACK_DEPTH = 12
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """実行したクエリの数と時間を数える接続（cursor_factory を指定したカーソルも対象）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_count = 0
+        self.query_seconds = 0.0
+        # PREPARE 済みのクエリ名（Noneの場合はプリペアドステートメントを使わない）
+        self.prepared_statements = None
+        # 前のトランザクションで PREPARE したものを使えた（プーラー越しではない）と確認できた場合にTrue
+        self.prepared_statements_verified = False
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        factory = cursor_factory or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(name, cursor_factory=counting_cursor_class(factory), **kwargs)
+
+
+class CountingCursorMixin:
+    """execute / executemany / copy_expert の回数と時間を接続に記録"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._count(start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._count(start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._count(start)
+
+    def _count(self, start):
+        self.connection.query_count += 1
+        self.connection.query_seconds += time.perf_counter() - start
+
+
+_counting_cursor_classes = {}
+
+
+def counting_cursor_class(factory):
+    """カーソルクラスにクエリ数の記録を加えたサブクラス（クラスごとに1回だけ作成）"""
+    cls = _counting_cursor_classes.get(factory)
+    if cls is None:
+        cls = _counting_cursor_classes[factory] = type(f'Counting{factory.__name__}',
+                                                       (CountingCursorMixin, factory), {})
+    return cls
+
+
+def caller_stack(skip, depth=LEAK_STACK_DEPTH):
+    """呼び出し元のスタック [(ファイル, 行, 関数名)]（traceback より軽い、返却漏れのログ用）"""
+    frame = sys._getframe(skip + 1)
+    stack = []
+    while frame is not None and len(stack) < depth:
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    return stack
+
+
+def average_ms(seconds, count):
+    return round(seconds / count * 1000, 3) if count else 0
+
+
+def summarize_label(stats):
+    """ラベルごとの集計を stats() の形式（ミリ秒・平均）に変換"""
+    return {
+        'checkouts': stats['checkouts'],
+        'avg_wait_ms': average_ms(stats['wait_seconds'], stats['checkouts']),
+        'max_wait_ms': round(stats['max_wait_seconds'] * 1000, 3),
+        'avg_hold_ms': average_ms(stats['hold_seconds'], stats['checkouts']),
+        'max_hold_ms': round(stats['max_hold_seconds'] * 1000, 3),
+        'queries': stats['queries'],
+        'avg_query_ms': average_ms(stats['query_seconds'], stats['queries']),
+        'requests': stats['requests'],
+        'queries_per_request': round(stats['request_queries'] / stats['requests'], 2) if stats['requests'] else 0,
+        'max_queries_per_request': stats['max_queries_per_request']
+    }
+
+
+class Checkout:
+    """貸し出し中の接続の記録"""
+    __slots__ = ('label', 'acquired_at', 'wait', 'stack', 'reported')
+
+    def __init__(self, label, acquired_at, wait, stack):
+        self.label = label
+        self.acquired_at = acquired_at
+        self.wait = wait
+        self.stack = stack
+        self.reported = False
+
+
+class ConnectionPool:
+    """スレッドセーフな接続プール（生存確認は一定時間使われていなかった接続のみ）"""
+
+    def __init__(self, minconn, maxconn, dsn, idle_ping_seconds=IDLE_PING_SECONDS,
+                 max_age_seconds=MAX_CONNECTION_AGE_SECONDS, timeout=CHECKOUT_TIMEOUT_SECONDS,
+                 max_idle=None, leak_seconds=LEAK_SECONDS, prepare_statements=False, **connect_kwargs):
+        """
+        Args:
+            minconn (int): 作成時に開いておく接続数
+            maxconn (int): 同時に使える接続の上限
+            dsn (str): 接続文字列
+            max_idle (int): 返却後も開いたまま保持する接続数（Noneの場合は maxconn、すべて保持）
+            leak_seconds (float): この秒数以上返却されていない接続を返却漏れとしてログに出す
+            prepare_statements (bool): 登録したクエリを接続ごとに PREPARE して使うか
+                                       （トランザクションモードのプーラー越しではFalse。
+                                       max_idle < maxconn の場合は使わない）
+            **connect_kwargs: psycopg2.connect() に渡す追加の引数（connect_timeout など）
+                              connection_factory の既定は InstrumentedConnection（クエリ数の計測用）
+        """
+        connect_kwargs.setdefault('connection_factory', InstrumentedConnection)
+        self._dsn = dsn
+        self._connect_kwargs = connect_kwargs
+        self.maxconn = maxconn
+        # 返却時にこの本数を超える接続は閉じる
+        self.max_idle = maxconn if max_idle is None else max_idle
+        self.idle_ping_seconds = idle_ping_seconds
+        self.max_age_seconds = max_age_seconds
+        self.timeout = timeout
+        self.leak_seconds = leak_seconds
+        # 返却時に閉じる接続があると、接続し直すたびに PREPARE + EXECUTE になり通常の実行より遅い
+        self.prepare_statements = prepare_statements and self.max_idle >= maxconn
+        if prepare_statements and not self.prepare_statements:
+            print(f"⚠️  Prepared statements disabled: max_idle ({self.max_idle}) < maxconn ({maxconn})")
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # 使っていない接続（最後に返却したものから使う）
+        self._idle = []
+        # id(conn) -> 開いている接続（使用中を含む）
+        self._conns = {}
+        # id(conn) -> 作成時刻 / 最終返却時刻（time.monotonic()）
+        self._created = {}
+        self._last_used = {}
+        # id(conn) -> Checkout
+        self._checked_out = {}
+        self._counters = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'pings': 0,
+            'discarded': 0,
+            'leaks': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0
+        }
+        # ラベル（エンドポイント）ごとの集計
+        self._labels = {}
+        for _ in range(minconn):
+            conn = self._connect()
+            self._idle.append(conn)
+
+    def getconn(self, label=None):
+        """
+        接続を取得
+
+        Args:
+            label (str): 集計・返却漏れのログに使う呼び出し元の名前（エンドポイント名など）
+
+        Raises:
+            PoolError: timeout 秒待っても接続が空かない場合
+            psycopg2.OperationalError: 新しい接続を作れない場合
+        """
+        start = time.monotonic()
+        self.check_leaks(start)
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._counters['timeouts'] += 1
+            raise PoolError(f"connection pool exhausted ({self.maxconn} connections in use)")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        now = time.monotonic()
+        wait = now - start
+        if isinstance(conn, InstrumentedConnection):
+            conn.query_count = 0
+            conn.query_seconds = 0.0
+        with self._lock:
+            self._checked_out[id(conn)] = Checkout(label, now, wait, caller_stack(1))
+            self._counters['checkouts'] += 1
+            self._counters['wait_seconds'] += wait
+            self._counters['max_wait_seconds'] = max(self._counters['max_wait_seconds'], wait)
+        return conn
+
+    def _connect(self):
+        """新しい接続を作成して記録"""
+        conn = psycopg2.connect(self._dsn, **self._connect_kwargs)
+        if self.prepare_statements and isinstance(conn, InstrumentedConnection):
+            conn.prepared_statements = set()
+        with self._lock:
+            self._conns[id(conn)] = conn
+            self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _checkout(self):
+        """
+        生存確認を通った接続を取得（壊れた接続・古い接続は閉じて取り直す）
+
+        使っていない接続がなければ新しく作ります（使用中の本数は getconn() のセマフォで maxconn 以下）。
+        MAX_CHECKOUT_ATTEMPTS 本続けて壊れていた場合（サーバーの再起動など）は、残りの使っていない接続も
+        壊れているとみなしてすべて閉じ、新しく作った接続で最後にもう一度試す。
+
+        Raises:
+            psycopg2.OperationalError: 新しく作った接続も使えない場合
+        """
+        for attempt in range(MAX_CHECKOUT_ATTEMPTS + 1):
+            if attempt == MAX_CHECKOUT_ATTEMPTS:
+                self._discard_idle()
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                # 作ったばかりの接続はそのまま使う
+                return self._connect()
+            now = time.monotonic()
+            with self._lock:
+                created = self._created.get(id(conn), now)
+                last_used = self._last_used.get(id(conn))
+
+            if conn.closed or now - created > self.max_age_seconds:
+                self._discard(conn)
+                continue
+            # 最近使われた接続（minconn で作ってから未使用のものを含む）はそのまま使う
+            if last_used is None or now - last_used < self.idle_ping_seconds:
+                return conn
+            try:
+                with self._lock:
+                    self._counters['pings'] += 1
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                print(f"⚠️  Connection dead, discarding it: {e}")
+                self._discard(conn)
+        raise psycopg2.OperationalError("could not get a working database connection")
+
+    def putconn(self, conn, close=False):
+        """
+        接続を返却（close=True または接続が閉じている場合はプールから外す）
+
+        Returns:
+            dict: この貸し出しの計測値 {'wait', 'hold', 'query_seconds'（秒）, 'queries'}
+                  （二重返却の場合はNone）
+        """
+        now = time.monotonic()
+        queries = getattr(conn, 'query_count', 0)
+        query_seconds = getattr(conn, 'query_seconds', 0.0)
+        with self._lock:
+            checkout = self._checked_out.pop(id(conn), None)
+            if checkout is None:
+                print("⚠️  Connection returned twice or not from this pool")
+                return None
+            hold = now - checkout.acquired_at
+            stats = self._label_stats(checkout.label)
+            stats['checkouts'] += 1
+            stats['wait_seconds'] += checkout.wait
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], checkout.wait)
+            stats['hold_seconds'] += hold
+            stats['max_hold_seconds'] = max(stats['max_hold_seconds'], hold)
+            stats['queries'] += queries
+            stats['query_seconds'] += query_seconds
+        if checkout.reported:
+            print(f"⚠️  Connection from {checkout.label} returned after {hold:.1f}s")
+        try:
+            if close or conn.closed or not self._reset(conn):
+                self._discard(conn)
+            else:
+                with self._lock:
+                    keep = len(self._idle) < self.max_idle
+                    if keep:
+                        self._last_used[id(conn)] = time.monotonic()
+                        self._idle.append(conn)
+                # max_idle を超える分は閉じる
+                if not keep:
+                    self._close(conn)
+        finally:
+            self._slots.release()
+        return {'wait': checkout.wait, 'hold': hold, 'queries': queries, 'query_seconds': query_seconds}
+
+    def owns(self, conn):
+        """このプールから貸し出し中の接続か（複数のプールを使う場合の返却先の判定用）"""
+        with self._lock:
+            return id(conn) in self._checked_out
+
+    def record_request(self, label, queries):
+        """1リクエストで実行したクエリ数を記録（リクエストあたりのクエリ数の集計用）"""
+        with self._lock:
+            stats = self._label_stats(label)
+            stats['requests'] += 1
+            stats['request_queries'] += queries
+            stats['max_queries_per_request'] = max(stats['max_queries_per_request'], queries)
+
+    def _label_stats(self, label):
+        """ラベルごとの集計（呼び出し側で self._lock を取得済みであること）"""
+        stats = self._labels.get(label)
+        if stats is None:
+            stats = self._labels[label] = {
+                'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                'hold_seconds': 0.0, 'max_hold_seconds': 0.0, 'queries': 0, 'query_seconds': 0.0,
+                'requests': 0, 'request_queries': 0, 'max_queries_per_request': 0
+            }
+        return stats
+
+    def check_leaks(self, now=None):
+        """
+        leak_seconds 以上返却されていない接続を、取得したときのスタックと一緒にログに出す（接続ごとに1回）
+
+        Returns:
+            list: 返却されていない接続 [{'label', 'held_seconds', 'stack'}]
+        """
+        now = time.monotonic() if now is None else now
+        leaks = []
+        newly_reported = []
+        with self._lock:
+            for checkout in self._checked_out.values():
+                held = now - checkout.acquired_at
+                if held < self.leak_seconds:
+                    continue
+                leaks.append({
+                    'label': checkout.label,
+                    'held_seconds': round(held, 1),
+                    'stack': [f'{filename}:{lineno} in {name}' for filename, lineno, name in checkout.stack]
+                })
+                if not checkout.reported:
+                    checkout.reported = True
+                    self._counters['leaks'] += 1
+                    newly_reported.append(leaks[-1])
+        for leak in newly_reported:
+            print(f"⚠️  Connection from {leak['label']} not returned for {leak['held_seconds']}s, acquired at:\n  "
+                  + '\n  '.join(leak['stack']))
+        return leaks
+
+    def stats(self):
+        """
+        プールの統計（管理画面・プールの大きさの見直し用、時間はミリ秒）
+
+        Returns:
+            dict: {
+                "maxconn": 20, "open": 3, "in_use": 1,
+                "checkouts": 1200, "timeouts": 0, "pings": 14, "discarded": 0, "leaks": 0,
+                "avg_wait_ms": 0.01, "max_wait_ms": 2.3,
+                "endpoints": {"get_reservations": {"checkouts": 300, "avg_wait_ms": 0.01, "max_wait_ms": 0.2,
+                                                   "avg_hold_ms": 4.1, "max_hold_ms": 30.2,
+                                                   "queries": 600, "avg_query_ms": 1.2, "requests": 150,
+                                                   "queries_per_request": 4.0, "max_queries_per_request": 6}},
+                "unreturned": [{"label": "...", "held_seconds": 75.0, "stack": ["app.py:123 in ..."]}]
+            }
+        """
+        leaks = self.check_leaks()
+        with self._lock:
+            counters = dict(self._counters)
+            labels = {label: dict(stats) for label, stats in self._labels.items()}
+            in_use = len(self._checked_out)
+            open_count = len(self._conns)
+        checkouts = counters.pop('checkouts')
+        wait_seconds = counters.pop('wait_seconds')
+        max_wait_seconds = counters.pop('max_wait_seconds')
+        return {
+            'maxconn': self.maxconn,
+            'open': open_count,
+            'in_use': in_use,
+            'checkouts': checkouts,
+            **counters,
+            'avg_wait_ms': average_ms(wait_seconds, checkouts),
+            'max_wait_ms': round(max_wait_seconds * 1000, 3),
+            'endpoints': {
+                str(label): summarize_label(stats)
+                for label, stats in sorted(labels.items(), key=lambda item: str(item[0]))
+            },
+            'unreturned': leaks
+        }
+
+    def _reset(self, conn):
+        """
+        返却された接続のトランザクションを終える（ThreadedConnectionPool の返却時と同じ）
+
+        Returns:
+            bool: 再利用できる場合True（状態が不明・rollback に失敗した接続はFalse）
+        """
+        status = conn.info.transaction_status
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        """壊れた・古い接続を閉じてプールから外す"""
+        with self._lock:
+            self._counters['discarded'] += 1
+        self._close(conn)
+
+    def _discard_idle(self):
+        """使っていない接続をすべて閉じる"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def _close(self, conn):
+        """接続を閉じて記録から外す"""
+        with self._lock:
+            self._conns.pop(id(conn), None)
+            self._created.pop(id(conn), None)
+            self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def closeall(self):
+        """すべての接続（使用中を含む）を閉じる"""
+        with self._lock:
+            conns = list(self._conns.values())
+            self._idle = []
+        for conn in conns:
+            self._close(conn)
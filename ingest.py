@@ -0,0 +1,851 @@
+"""
+GAS webhook 予約取り込みモジュール
+
+gas_webhook が受け取った予約のバッチを、件数に依存しない少数のSQLでまとめて反映します。
+従来の1件ずつの処理（SELECT → UPDATE / INSERT、キャンセルごとのDELETE）と同じ結果・同じ件数になるよう、
+バッチを「フェーズ」に分けて実行します。
+
+- email_id あり: INSERT ... ON CONFLICT (store, email_id) DO UPDATE（xmax = 0 なら追加）
+- email_id なし: 日付・開始・終了・店舗が一致する gmail 予約を更新、なければ追加
+- キャンセル: DELETE ... USING (VALUES ...) で一括削除
+
+同じ枠（店舗・日付・開始時刻）に種類の異なる処理が続く場合や、同じ予約が2回送られた場合は、
+処理順で結果が変わるため新しいフェーズに分けます（通常のバッチは1フェーズ）。
+email_id の予約の移動元の枠を判定するため、最初に現在の枠を1回のクエリで取得します。
+
+大量のバッチ（COPY_THRESHOLD 件以上）は COPY で一時テーブルに投入し、
+同じSQLの入力をそのテーブルから読みます。
+
+skip_applied=True の場合は、予約ごとの内容ハッシュを webhook_item_hashes に記録し、
+前回反映したときから変わっていない予約をスキップします（GASの10分ごとの再送対策）。
+ハッシュは反映後の店舗の変更カウンタ（reservation_versions）と一緒に記録し、
+webhook 以外の書き込み（管理画面での編集・削除、Gmail予約の全削除など）でカウンタが進むと
+その店舗のハッシュはすべて無効になります。
+判定と反映の間に別のトランザクションが同じ店舗を変更した場合は、その変更が次の変更か
+ITEM_HASH_TTL_MINUTES が経過するまで反映されないことがあります。
+
+同じ店舗に同時に届いたバッチは、店舗ごとのアドバイザリロック（トランザクション終了時に解放）を
+店舗名順に取ってから反映するため順番に実行されます（変更カウンタの行ロックの取り合いによるデッドロック対策）。
+
+apply_reservations_partial は反映前に予約を1件ずつ検証し、問題のある予約だけを除いて反映します
+（1件の不正な予約でバッチ全体を rollback しない）。
+
+マイグレーションが未実行の場合（check_schema）は従来の処理に戻します。
+(store, email_id) の一意インデックス（007）がなければ1件ずつ SELECT → UPDATE / INSERT で反映し、
+reservation_versions（005）か webhook_item_hashes（008）がなければ skip_applied を使いません。
+"""
+import hashlib
+import io
+import json
+import re
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from query_registry import register_query, execute_query
+
+# Google Calendar と同期している店舗（キャンセル時にカレンダーからも削除）
+CALENDAR_STORES = ('ebisu', 'hanzomon')
+# この件数以上のバッチは COPY で一時テーブルに投入してから反映（履歴の再取り込みなど）
+COPY_THRESHOLD = 1000
+# 反映済みハッシュの有効期間（分）。期限が切れた予約は次の再送で再び反映する
+ITEM_HASH_TTL_MINUTES = 60
+# ハッシュの記録・照合で1回のSQLに含める件数
+ITEM_HASH_PAGE_SIZE = 1000
+# 文字列項目の最大長（reservations テーブルの列定義）
+FIELD_MAX_LENGTHS = {
+    'store': 50,
+    'customer_name': 100,
+    'room_name': 50,
+    'type': 20,
+    'source': 50,
+    'email_id': 255
+}
+TIME_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})(:\d{2})?$')
+# 必要なマイグレーション（005・007・008）がすべて実行済みと確認できたか（以降は確認しない）
+schema_ready = False
+
+
+def normalize_item(res):
+    """
+    webhookの予約1件に既定値を補い、処理の種類（email / noemail / cancel）を判定
+
+    Raises:
+        KeyError: 必須項目（date, start, キャンセル以外は end）がない場合
+    """
+    store = res.get('store', 'shibuya')
+    if res.get('is_cancellation'):
+        return {
+            'kind': 'cancel',
+            'store': store,
+            'date': res['date'],
+            'start': res['start'],
+            'end': res.get('end', res['start']),
+            'customer_name': res.get('customer_name', 'N/A'),
+            # room_nameがある場合のみ条件に含める（同じ顧客が同時刻に複数部屋を予約している場合に対応）
+            'room_name': res.get('room_name', '') or None
+        }
+
+    email_id = res.get('email_id')
+    return {
+        'kind': 'email' if email_id else 'noemail',
+        'store': store,
+        'date': res['date'],
+        'start': res['start'],
+        'end': res['end'],
+        'customer_name': res.get('customer_name', 'N/A'),
+        'room_name': res.get('room_name', '個室B'),
+        'type': res.get('type', 'gmail'),  # GASから送られた type を使用（貸切の場合は 'charter'）
+        'source': res.get('source', 'gas_sync'),
+        'email_id': email_id or None
+    }
+
+
+def validate_item(res):
+    """
+    webhookの予約1件を反映前に検証（データベースでエラーになる内容を事前に検出）
+
+    Returns:
+        str: エラー理由（問題がなければNone）
+    """
+    if not isinstance(res, dict):
+        return 'reservation must be an object'
+    try:
+        item = normalize_item(res)
+    except KeyError as e:
+        return f'missing {e}'
+
+    if not isinstance(item['date'], str):
+        return 'date must be a string (YYYY-MM-DD)'
+    try:
+        datetime.strptime(item['date'], '%Y-%m-%d')
+    except ValueError:
+        return f"invalid date: {item['date']}"
+
+    for field in ('start', 'end'):
+        match = TIME_PATTERN.match(item[field]) if isinstance(item[field], str) else None
+        hour, minute = (int(match.group(1)), int(match.group(2))) if match else (None, None)
+        if match is None or minute > 59 or hour > 24 or (hour == 24 and minute > 0):
+            return f'invalid {field}: {item[field]}'
+
+    for field, max_length in FIELD_MAX_LENGTHS.items():
+        value = item.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            return f'{field} must be a string'
+        if len(value) > max_length:
+            return f'{field} is too long (max {max_length})'
+    return None
+
+
+def check_schema(cur):
+    """
+    一括反映・スキップに必要なマイグレーションが実行済みか確認
+
+    すべてそろっていれば結果を schema_ready に保存し、以降はSQLを実行しません
+    （未実行の間は毎回確認するため、マイグレーションを実行すると再起動なしで一括反映に切り替わる）。
+
+    Returns:
+        tuple: ((store, email_id) の一意インデックス（007）があるか,
+                reservation_versions（005）と webhook_item_hashes（008）があるか)
+    """
+    global schema_ready
+    if schema_ready:
+        return True, True
+    # 一時テーブル（テスト）も検索パスの順に解決される
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            WHERE i.indrelid = 'reservations'::regclass AND i.indisunique AND i.indpred IS NULL
+            AND ARRAY(
+                SELECT a.attname::text FROM pg_attribute a
+                WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) ORDER BY 1
+            ) = ARRAY['email_id', 'store']
+            AND i.indnkeyatts = 2
+        ),
+        to_regclass('reservation_versions') IS NOT NULL AND to_regclass('webhook_item_hashes') IS NOT NULL
+    """)
+    upsert_ready, hashes_ready = cur.fetchone()
+    schema_ready = upsert_ready and hashes_ready
+    if not schema_ready:
+        print(f"⚠️  Webhook migrations not applied (email_id unique index: {upsert_ready}, "
+              f"versions/item hashes: {hashes_ready}) - falling back to per-item upserts / no skipping")
+    return upsert_ready, hashes_ready
+
+
+def slot_key(store, res_date, start):
+    """枠（店舗・日付・開始時刻）の比較用キー（'9:00' と '09:00:00' を同じ枠として扱う）"""
+    if hasattr(start, 'hour'):
+        start = (start.hour, start.minute)
+    else:
+        start = tuple(int(part) for part in str(start).split(':')[:2])
+    return store, str(res_date), start
+
+
+def lock_stores(cur, stores):
+    """
+    店舗ごとのトランザクションレベルのアドバイザリロックを店舗名順に取得
+
+    複数店舗のバッチ同士が reservation_versions の行を逆順にロックし合うのを防ぎます。
+    ロックはトランザクション内で完結するため、トランザクションモードのプーラー越しでも使えます。
+    """
+    for store in sorted(stores):
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f'reservations:{store}',))
+
+
+EMAIL_POSITIONS_QUERY = register_query('webhook_email_positions', """
+    SELECT r.store, r.email_id, r.date, r.start_time
+    FROM reservations r
+    JOIN unnest(%s::text[], %s::text[]) AS v (store, email_id) ON r.store = v.store AND r.email_id = v.email_id
+""", ('text[]', 'text[]'))
+
+
+def fetch_email_positions(cur, items):
+    """
+    バッチ内の email_id の予約が現在ある枠を取得
+
+    件数によらず同じSQL（配列2つを渡す）なので、プリペアドステートメントで実行できます。
+
+    Returns:
+        dict: {(店舗, email_id): slot_key}
+    """
+    keys = sorted({(item['store'], item['email_id']) for item in items if item['kind'] == 'email'})
+    if not keys:
+        return {}
+    execute_query(cur, EMAIL_POSITIONS_QUERY, ([store for store, _ in keys], [email_id for _, email_id in keys]))
+    return {(store, email_id): slot_key(store, res_date, start)
+            for store, email_id, res_date, start in cur.fetchall()}
+
+
+def plan_phases(items, positions=None):
+    """
+    正規化済みの予約をフェーズに分割
+
+    1つのフェーズ内では、同じ枠（店舗・日付・開始時刻）に異なる種類の処理がなく、
+    同じ予約（email_id、または email_id なしの日付・開始・終了）が重複しないため、
+    種類ごとにまとめて実行しても1件ずつ処理した場合と同じ結果になります。
+    email_id の予約は日付・時刻の変更で移動するため、移動元の枠も使用する枠として扱います。
+
+    Args:
+        items (list): normalize_item() で正規化した予約
+        positions (dict): fetch_email_positions() の結果（email_id の予約が現在ある枠）
+
+    Returns:
+        list: [{'email': [...], 'noemail': [...], 'cancel': [...]}, ...]（処理順）
+    """
+    phases = []
+    current = None
+    keys, slot_kinds = set(), {}
+    for item, footprint in zip(items, item_footprints(items, positions or {})):
+        if current is None or overlaps(footprint, keys, slot_kinds):
+            current = {'email': [], 'noemail': [], 'cancel': []}
+            phases.append(current)
+            keys, slot_kinds = set(), {}
+
+        current[item['kind']].append(item)
+        add_footprint(footprint, keys, slot_kinds)
+    return phases
+
+
+def item_hash(item):
+    """正規化済みの予約の内容ハッシュ（16進32文字）"""
+    payload = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def item_footprints(items, positions):
+    """
+    予約ごとの処理が関係する範囲（フェーズ分割・スキップ判定で使用）
+
+    同じ予約（email_id、または email_id なしの日付・開始・終了）か、
+    同じ枠（店舗・日付・開始時刻）の種類の異なる処理は、処理順で結果が変わります。
+
+    Args:
+        items (list): normalize_item() で正規化した予約（処理順）
+        positions (dict): fetch_email_positions() の結果
+
+    Returns:
+        list: 予約ごとの (種類, 予約のキー（キャンセルはNone）, 使用する枠のset)
+    """
+    positions = dict(positions)
+    footprints = []
+    for item in items:
+        slot = slot_key(item['store'], item['date'], item['start'])
+        slots = {slot}
+        if item['kind'] == 'email':
+            key = ('email', item['store'], item['email_id'])
+            previous = positions.get(key[1:])
+            if previous is not None:
+                slots.add(previous)
+            positions[key[1:]] = slot
+        elif item['kind'] == 'noemail':
+            key = ('noemail', slot, slot_key(item['store'], item['date'], item['end'])[2])
+        else:
+            key = None
+        footprints.append((item['kind'], key, slots))
+    return footprints
+
+
+def overlaps(footprint, keys, slot_kinds):
+    """footprint が、keys・slot_kinds に追加済みの処理と処理順で結果が変わる関係にあるか"""
+    kind, key, slots = footprint
+    return key in keys or any(slot_kinds.get(slot, {kind}) != {kind} for slot in slots)
+
+
+def add_footprint(footprint, keys, slot_kinds):
+    """footprint を keys・slot_kinds に追加"""
+    kind, key, slots = footprint
+    if key is not None:
+        keys.add(key)
+    for slot in slots:
+        slot_kinds.setdefault(slot, set()).add(kind)
+
+
+def find_applied_items(cur, items, hashes):
+    """
+    前回反映したときから変わっていない予約（スキップできる予約）を取得
+
+    Args:
+        items (list): normalize_item() で正規化した予約
+        hashes (list): 各予約の item_hash()
+
+    Returns:
+        set: スキップできる予約のインデックス
+    """
+    rows = [(index, item['store'], item_hash_value) for index, (item, item_hash_value) in enumerate(zip(items, hashes))]
+    result = execute_values(cur, f"""
+        SELECT v.idx
+        FROM (VALUES %s) AS v (idx, store, item_hash)
+        JOIN webhook_item_hashes h ON h.store = v.store AND h.item_hash = v.item_hash
+        LEFT JOIN reservation_versions rv ON rv.store = h.store
+        WHERE h.version = COALESCE(rv.version, 0)
+        AND h.applied_at > CURRENT_TIMESTAMP - INTERVAL '{ITEM_HASH_TTL_MINUTES} minutes'
+    """, rows, page_size=ITEM_HASH_PAGE_SIZE, fetch=True)
+    return {row[0] for row in result}
+
+
+def exclude_conflicting(items, applied, positions):
+    """
+    反映する予約と処理順で結果が変わる関係にある予約はスキップしない
+
+    例: スキップした予約のキャンセルが同じバッチにある場合は、予約も反映してからキャンセルする。
+    反映する予約と重ならなくなるまでスキップ対象から外します。
+
+    Returns:
+        set: スキップする予約のインデックス
+    """
+    footprints = item_footprints(items, positions)
+    applied = set(applied)
+    keys, slot_kinds = set(), {}
+    pending = [index for index in range(len(items)) if index not in applied]
+    while pending:
+        for index in pending:
+            add_footprint(footprints[index], keys, slot_kinds)
+        pending = [index for index in applied if overlaps(footprints[index], keys, slot_kinds)]
+        applied.difference_update(pending)
+    return applied
+
+
+def final_items(items, positions):
+    """
+    バッチの後ろの予約に上書きされない予約（再送しても結果が変わらない予約）のインデックス
+
+    後ろに処理順で結果が変わる関係の予約がある場合、その予約のハッシュは記録しない
+    """
+    footprints = item_footprints(items, positions)
+    keys, slot_kinds = set(), {}
+    result = []
+    for index in range(len(items) - 1, -1, -1):
+        if not overlaps(footprints[index], keys, slot_kinds):
+            result.append(index)
+        add_footprint(footprints[index], keys, slot_kinds)
+    return result[::-1]
+
+
+def record_applied_items(cur, items, hashes, positions):
+    """
+    バッチの予約のハッシュを現在の店舗の変更カウンタと一緒に記録し、古いハッシュを削除
+
+    反映後（同じトランザクション内）に呼び出します。
+
+    Args:
+        positions (dict): 反映前の fetch_email_positions() の結果
+    """
+    rows = sorted({(items[index]['store'], hashes[index]) for index in final_items(items, positions)})
+    execute_values(cur, """
+        INSERT INTO webhook_item_hashes AS h (store, item_hash, version, applied_at)
+        SELECT v.store, v.item_hash, COALESCE(rv.version, 0), CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS v (store, item_hash)
+        LEFT JOIN reservation_versions rv ON rv.store = v.store
+        ON CONFLICT (store, item_hash) DO UPDATE
+        SET version = EXCLUDED.version, applied_at = EXCLUDED.applied_at
+    """, rows, page_size=ITEM_HASH_PAGE_SIZE)
+    cur.execute(f"""
+        DELETE FROM webhook_item_hashes h
+        WHERE h.store = ANY(%s)
+        AND (h.version <> COALESCE((SELECT rv.version FROM reservation_versions rv WHERE rv.store = h.store), 0)
+             OR h.applied_at <= CURRENT_TIMESTAMP - INTERVAL '{ITEM_HASH_TTL_MINUTES} minutes')
+    """, (sorted({item['store'] for item in items}),))
+
+
+def load_staging(cur, phases):
+    """
+    フェーズ分け済みの予約を一時テーブル ingest_staging に COPY で投入
+
+    大量の予約（件数 >= COPY_THRESHOLD）では、VALUES に全行を埋め込んだSQLを組み立てる代わりに
+    COPY で一時テーブルへ流し込み、各フェーズのSQLはそこから読みます。
+    一時テーブルはトランザクション終了時に削除されます。
+    """
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS ingest_staging (
+            phase INTEGER, idx INTEGER, kind TEXT, store TEXT, email_id TEXT, date TEXT,
+            start_time TEXT, end_time TEXT, customer_name TEXT, room_name TEXT, type TEXT, source TEXT
+        ) ON COMMIT DROP
+    """)
+    cur.execute("TRUNCATE ingest_staging")
+
+    buffer = io.StringIO()
+    idx = 0
+    for phase_number, phase in enumerate(phases):
+        for kind in ('email', 'noemail', 'cancel'):
+            for item in phase[kind]:
+                buffer.write(','.join(csv_field(value) for value in (
+                    phase_number, idx, kind, item['store'], item.get('email_id'), item['date'], item['start'],
+                    item['end'], item['customer_name'], item['room_name'], item.get('type'), item.get('source')
+                )) + '\n')
+                idx += 1
+    buffer.seek(0)
+    cur.copy_expert("""
+        COPY ingest_staging (phase, idx, kind, store, email_id, date, start_time, end_time,
+                             customer_name, room_name, type, source)
+        FROM STDIN WITH (FORMAT csv, NULL '\\N')
+    """, buffer)
+    # 一時テーブルは自動で統計が取られないため、結合の実行計画のために集計
+    cur.execute("ANALYZE ingest_staging")
+
+
+def csv_field(value):
+    """COPY (CSV形式) の1項目（Noneは \\N、文字列は常にクォートして空文字列と区別）"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, int):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def execute_batch_sql(cur, sql, columns, kind, rows, staging_phase=None):
+    """
+    入力 v を (VALUES ...) またはステージングテーブルから読むSQLを実行
+
+    Args:
+        sql (str): {source} を入力（v の列 columns）に置き換えるSQL
+        rows (callable): VALUES で渡す行のリストを返す関数
+        staging_phase (int): 指定時は ingest_staging のこのフェーズ・種類の行を入力にする
+    """
+    if staging_phase is None:
+        values = rows()
+        return execute_values(cur, sql.format(source='VALUES %s'), values, page_size=len(values), fetch=True)
+    source = f"SELECT {', '.join(columns)} FROM ingest_staging WHERE phase = %s AND kind = %s"
+    cur.execute(sql.format(source=source), (staging_phase, kind))
+    return cur.fetchall()
+
+
+def upsert_by_email_id(cur, items, staging_phase=None):
+    """
+    email_id ありの予約を一括で追加・更新
+
+    Returns:
+        tuple: (追加件数, 更新件数, 変更前の (店舗, 日付) のリスト, 追加した予約のリスト)
+    """
+    if not items:
+        return 0, 0, [], []
+    columns = ('store', 'email_id', 'date', 'start_time', 'end_time', 'customer_name', 'room_name', 'type', 'source')
+    result = execute_batch_sql(cur, """
+        WITH v (store, email_id, date, start_time, end_time, customer_name, room_name, type, source) AS (
+            {source}
+        ),
+        previous AS (
+            SELECT r.store, r.date FROM reservations r
+            JOIN v ON r.store = v.store AND r.email_id = v.email_id
+        ),
+        upserted AS (
+            INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
+            SELECT date::date, start_time::time, end_time::time, customer_name, room_name, store, type, source, email_id
+            FROM v
+            ON CONFLICT (store, email_id) DO UPDATE
+            SET date = EXCLUDED.date, start_time = EXCLUDED.start_time, end_time = EXCLUDED.end_time,
+                customer_name = EXCLUDED.customer_name, room_name = EXCLUDED.room_name, type = EXCLUDED.type
+            RETURNING (xmax = 0) AS inserted, store, date, start_time, end_time, customer_name, room_name
+        )
+        SELECT inserted, store, date::text, to_char(start_time, 'HH24:MI'), to_char(end_time, 'HH24:MI'),
+               customer_name, room_name
+        FROM upserted
+        UNION ALL
+        SELECT NULL, store, date::text, NULL, NULL, NULL, NULL FROM previous
+    """, columns, 'email', lambda: [
+        (item['store'], item['email_id'], item['date'], item['start'], item['end'],
+         item['customer_name'], item['room_name'], item['type'], item['source'])
+        for item in items
+    ], staging_phase)
+
+    inserted = [row for row in result if row[0] is True]
+    updated_count = sum(1 for row in result if row[0] is False)
+    previous = [(row[1], row[2]) for row in result if row[0] is None]
+    return len(inserted), updated_count, previous, [row[1:] for row in inserted]
+
+
+def upsert_without_email_id(cur, items, staging_phase=None):
+    """
+    email_id なしの予約を一括で追加・更新
+
+    日付・開始・終了・店舗が一致する gmail 予約があれば顧客名・部屋名・タイプを更新し、
+    なければ追加します。
+
+    Returns:
+        tuple: (追加件数, 更新件数, 追加した予約のリスト)
+    """
+    if not items:
+        return 0, 0, []
+    columns = ('idx', 'store', 'date', 'start_time', 'end_time', 'customer_name', 'room_name', 'type', 'source')
+    result = execute_batch_sql(cur, """
+        WITH v (idx, store, date, start_time, end_time, customer_name, room_name, type, source) AS (
+            {source}
+        ),
+        matched AS (
+            SELECT DISTINCT ON (v.idx) v.idx, r.id
+            FROM v
+            JOIN reservations r
+            ON r.date = v.date::date AND r.start_time = v.start_time::time AND r.end_time = v.end_time::time
+            AND r.store = v.store AND r.type = 'gmail'
+            ORDER BY v.idx, r.id
+        ),
+        updated AS (
+            UPDATE reservations r
+            SET customer_name = v.customer_name, room_name = v.room_name, type = v.type
+            FROM matched m JOIN v ON v.idx = m.idx
+            WHERE r.id = m.id
+            RETURNING r.id
+        ),
+        inserted AS (
+            INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
+            SELECT date::date, start_time::time, end_time::time, customer_name, room_name, store, type, source, NULL
+            FROM v
+            WHERE NOT EXISTS (SELECT 1 FROM matched m WHERE m.idx = v.idx)
+            RETURNING store, date, start_time, end_time, customer_name, room_name
+        )
+        SELECT FALSE, NULL, NULL, NULL, NULL, NULL, NULL FROM updated
+        UNION ALL
+        SELECT TRUE, store, date::text, to_char(start_time, 'HH24:MI'), to_char(end_time, 'HH24:MI'),
+               customer_name, room_name
+        FROM inserted
+    """, columns, 'noemail', lambda: [
+        (idx, item['store'], item['date'], item['start'], item['end'],
+         item['customer_name'], item['room_name'], item['type'], item['source'])
+        for idx, item in enumerate(items)
+    ], staging_phase)
+
+    inserted = [row[1:] for row in result if row[0]]
+    return len(inserted), len(result) - len(inserted), inserted
+
+
+def delete_cancellations(cur, items, staging_phase=None):
+    """
+    キャンセルの予約を一括削除
+
+    注意: キャンセルメールと予約メールは別のメールなのでemail_idが異なる。
+    そのため、日付・開始時刻・顧客名・店舗（・部屋名）で gmail 予約を削除する。
+
+    Returns:
+        int: 削除件数
+    """
+    if not items:
+        return 0
+    columns = ('store', 'date', 'start_time', 'customer_name', 'room_name')
+    result = execute_batch_sql(cur, """
+        DELETE FROM reservations r
+        USING ({source}) AS v (store, date, start_time, customer_name, room_name)
+        WHERE r.date = v.date::date AND r.start_time = v.start_time::time
+        AND r.customer_name = v.customer_name AND r.store = v.store
+        AND (v.room_name IS NULL OR r.room_name = v.room_name)
+        AND r.type = 'gmail'
+        RETURNING r.id
+    """, columns, 'cancel', lambda: [
+        (item['store'], item['date'], item['start'], item['customer_name'], item['room_name'])
+        for item in items
+    ], staging_phase)
+    return len(result)
+
+
+def apply_items_one_by_one(cur, items, result):
+    """
+    正規化済みの予約を1件ずつ反映（(store, email_id) の一意インデックスがない場合）
+
+    ON CONFLICT が使えないため、従来の gas_webhook と同じく SELECT → UPDATE / INSERT、
+    キャンセルごとの DELETE で反映し、件数などを result に加算します。
+    """
+    for item in items:
+        if item['kind'] == 'cancel':
+            cur.execute("""
+                DELETE FROM reservations
+                WHERE date = %s AND start_time = %s AND customer_name = %s AND store = %s
+                AND (%s::text IS NULL OR room_name = %s) AND type = 'gmail'
+            """, (item['date'], item['start'], item['customer_name'], item['store'], item['room_name'], item['room_name']))
+            result['deleted'] += cur.rowcount
+            continue
+
+        if item['kind'] == 'email':
+            cur.execute("SELECT date::text FROM reservations WHERE email_id = %s AND store = %s",
+                        (item['email_id'], item['store']))
+            previous = cur.fetchall()
+            if previous:
+                # 日付が変わる場合に備えて、元の日付もキャッシュ無効化の対象にする
+                result['touched'].update((item['store'], row[0]) for row in previous)
+                cur.execute("""
+                    UPDATE reservations
+                    SET date = %s, start_time = %s, end_time = %s, customer_name = %s, room_name = %s, type = %s
+                    WHERE email_id = %s AND store = %s
+                """, (item['date'], item['start'], item['end'], item['customer_name'], item['room_name'],
+                      item['type'], item['email_id'], item['store']))
+                result['updated'] += 1
+                continue
+        else:
+            cur.execute("""
+                SELECT id FROM reservations
+                WHERE date = %s AND start_time = %s AND end_time = %s AND store = %s AND type = 'gmail'
+                ORDER BY id LIMIT 1
+            """, (item['date'], item['start'], item['end'], item['store']))
+            existing = cur.fetchone()
+            if existing:
+                cur.execute("UPDATE reservations SET customer_name = %s, room_name = %s, type = %s WHERE id = %s",
+                            (item['customer_name'], item['room_name'], item['type'], existing[0]))
+                result['updated'] += 1
+                continue
+
+        cur.execute("""
+            INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (item['date'], item['start'], item['end'], item['customer_name'], item['room_name'],
+              item['store'], item['type'], item['source'], item['email_id']))
+        result['inserted'] += 1
+        if item['store'] in CALENDAR_STORES:
+            result['calendar_events_to_add'].append({
+                'store': item['store'],
+                'date': item['date'],
+                'start_time': item['start'],
+                'end_time': item['end'],
+                'customer_name': item['customer_name'],
+                'room_name': item['room_name']
+            })
+
+
+def apply_reservation_batch(cur, reservations, use_copy=None, skip_applied=False, record_hashes=True):
+    """
+    webhookの予約バッチをデータベースに反映（コミットは呼び出し側）
+
+    Args:
+        cur: データベースカーソル
+        reservations (list): webhookの予約（dict）のリスト
+        use_copy (bool): COPY で一時テーブルに投入してから反映するか
+                         （Noneの場合は件数が COPY_THRESHOLD 以上なら使う）
+        skip_applied (bool): 前回反映したときから変わっていない予約をスキップするか
+                             （reservation_versions・webhook_item_hashes テーブルがなければ使わない）
+        record_hashes (bool): skip_applied の場合に反映後のハッシュを記録するか
+                              （False の場合は呼び出し側が record_applied_items() で記録する）
+
+    Returns:
+        dict: {
+            'inserted', 'updated', 'deleted': 件数,
+            'skipped': 変更がないためスキップした件数,
+            'applied': 反映した予約のインデックス（reservations の順）,
+            'touched': キャッシュ無効化の対象 (店舗, 日付) のset（日付が変わった予約の元の日付を含む）,
+            'calendar_events_to_add': Calendar同期店舗で追加した予約,
+            'calendar_events_to_delete': Calendar同期店舗のキャンセル,
+            'phases': 実行したフェーズ数
+        }
+
+    Raises:
+        KeyError: 必須項目がない予約が含まれる場合（何も反映しない）
+    """
+    all_items = [normalize_item(res) for res in reservations]
+    upsert_ready, hashes_ready = check_schema(cur) if all_items else (True, True)
+    skip_applied = skip_applied and hashes_ready
+    lock_stores(cur, {item['store'] for item in all_items})
+    skipped = set()
+    positions = None
+    if skip_applied and all_items:
+        hashes = [item_hash(item) for item in all_items]
+        skipped = find_applied_items(cur, all_items, hashes)
+        if len(skipped) < len(all_items):
+            positions = fetch_email_positions(cur, all_items)
+            # 一部だけ変わった場合は、処理順で結果が変わる予約をスキップ対象から外す
+            skipped = exclude_conflicting(all_items, skipped, positions)
+
+    applied = [index for index in range(len(all_items)) if index not in skipped]
+    items = [all_items[index] for index in applied]
+    result = {
+        'inserted': 0,
+        'updated': 0,
+        'deleted': 0,
+        'skipped': len(skipped),
+        'applied': applied,
+        'touched': {(item['store'], item['date']) for item in items},
+        'calendar_events_to_add': [],
+        'calendar_events_to_delete': [],
+        'phases': 0
+    }
+    if not items:
+        return result
+
+    if positions is None:
+        positions = fetch_email_positions(cur, items)
+    if upsert_ready:
+        phases = plan_phases(items, positions)
+        if use_copy is None:
+            use_copy = len(items) >= COPY_THRESHOLD
+        if use_copy:
+            load_staging(cur, phases)
+    else:
+        # 一意インデックス（007）がないと ON CONFLICT が使えないため、従来どおり1件ずつ反映
+        phases = []
+        result['phases'] = 1
+        apply_items_one_by_one(cur, items, result)
+
+    for phase_number, phase in enumerate(phases):
+        result['phases'] += 1
+        staging_phase = phase_number if use_copy else None
+
+        inserted, updated, previous, added_by_email = upsert_by_email_id(cur, phase['email'], staging_phase)
+        result['inserted'] += inserted
+        result['updated'] += updated
+        # 日付が変わる場合に備えて、元の日付もキャッシュ無効化の対象にする
+        result['touched'].update(previous)
+
+        inserted, updated, added_without_email = upsert_without_email_id(cur, phase['noemail'], staging_phase)
+        result['inserted'] += inserted
+        result['updated'] += updated
+
+        result['deleted'] += delete_cancellations(cur, phase['cancel'], staging_phase)
+
+        for store, res_date, start, end, customer_name, room_name in added_by_email + added_without_email:
+            if store in CALENDAR_STORES:
+                result['calendar_events_to_add'].append({
+                    'store': store,
+                    'date': res_date,
+                    'start_time': start,
+                    'end_time': end,
+                    'customer_name': customer_name,
+                    'room_name': room_name
+                })
+
+    for item in items:
+        if item['kind'] == 'cancel' and item['store'] in CALENDAR_STORES:
+            result['calendar_events_to_delete'].append({
+                'store': item['store'],
+                'date': item['date'],
+                'start_time': item['start'],
+                'end_time': item['end']
+            })
+
+    if skip_applied and record_hashes:
+        record_applied_items(cur, all_items, hashes, positions)
+    return result
+
+
+# 予約ごとのエラーとして報告するデータベースのエラー（予約の内容によるもの: 型・長さ・制約違反など）。
+# それ以外（デッドロック・直列化の失敗・接続断など）はバッチ全体の失敗として呼び出し側に投げ、
+# 取り込みキューで再試行させる
+ITEM_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def apply_reservations_partial(cur, reservations, skip_applied=False):
+    """
+    webhookの予約バッチのうち、問題のない予約だけを反映（コミットは呼び出し側）
+
+    validate_item で不正な予約を除いてからまとめて反映します。それでもデータベースで
+    予約の内容によるエラー（ITEM_ERRORS）になった場合はセーブポイントまで戻し、1件ずつセーブポイントを
+    作って反映してエラーになった予約だけを除きます（遅い経路、通常は使わない）。
+    1件ずつ反映する場合、反映済みハッシュは最後にまとめて記録します（1件ごとに記録すると、
+    変更カウンタが進むたびにそれまでに記録した同じ店舗のハッシュが削除されるため）。
+
+    Args:
+        cur: データベースカーソル
+        reservations (list): webhookの予約のリスト
+        skip_applied (bool): apply_reservation_batch() の skip_applied
+
+    Returns:
+        dict: apply_reservation_batch() の結果（'applied' は reservations のインデックス）に加えて
+              'failed': エラーの件数,
+              'errors': {インデックス: エラー理由},
+              'statuses': 予約ごとの 'applied' / 'skipped' / 'error'（reservations の順）
+
+    Raises:
+        psycopg2.Error: ITEM_ERRORS 以外のエラー（デッドロックなど、1件ずつ反映しても解決しないもの）
+    """
+    errors = {}
+    valid = []
+    for index, res in enumerate(reservations):
+        reason = validate_item(res)
+        if reason is None:
+            valid.append(index)
+        else:
+            errors[index] = reason
+
+    cur.execute("SAVEPOINT apply_batch")
+    try:
+        results = [(valid, apply_reservation_batch(cur, [reservations[index] for index in valid],
+                                                   skip_applied=skip_applied))]
+        cur.execute("RELEASE SAVEPOINT apply_batch")
+    except ITEM_ERRORS:
+        cur.execute("ROLLBACK TO SAVEPOINT apply_batch")
+        skip_applied = skip_applied and check_schema(cur)[1]
+        if skip_applied:
+            items = [normalize_item(reservations[index]) for index in valid]
+            # record_applied_items() には反映前の枠を渡す
+            positions = fetch_email_positions(cur, items)
+        results = []
+        for index in valid:
+            cur.execute("SAVEPOINT apply_item")
+            try:
+                results.append(([index], apply_reservation_batch(cur, [reservations[index]], skip_applied=skip_applied,
+                                                                 record_hashes=False)))
+                cur.execute("RELEASE SAVEPOINT apply_item")
+            except ITEM_ERRORS as e:
+                cur.execute("ROLLBACK TO SAVEPOINT apply_item")
+                errors[index] = (e.pgerror or str(e)).strip()
+
+        # エラーにならなかった予約（反映・スキップ）のハッシュを、すべて反映した後の変更カウンタと一緒に記録
+        succeeded = [position for position, index in enumerate(valid) if index not in errors]
+        if skip_applied and succeeded:
+            record_applied_items(cur, [items[position] for position in succeeded],
+                                 [item_hash(items[position]) for position in succeeded], positions)
+
+    merged = {
+        'inserted': 0,
+        'updated': 0,
+        'deleted': 0,
+        'skipped': 0,
+        'applied': [],
+        'touched': set(),
+        'calendar_events_to_add': [],
+        'calendar_events_to_delete': [],
+        'phases': 0
+    }
+    for indexes, result in results:
+        for key in ('inserted', 'updated', 'deleted', 'skipped', 'phases'):
+            merged[key] += result[key]
+        merged['applied'].extend(indexes[position] for position in result['applied'])
+        merged['touched'].update(result['touched'])
+        merged['calendar_events_to_add'].extend(result['calendar_events_to_add'])
+        merged['calendar_events_to_delete'].extend(result['calendar_events_to_delete'])
+    merged['applied'].sort()
+
+    applied = set(merged['applied'])
+    merged['failed'] = len(errors)
+    merged['errors'] = errors
+    merged['statuses'] = [
+        'error' if index in errors else 'applied' if index in applied else 'skipped'
+        for index in range(len(reservations))
+    ]
+    return merged
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Webhook取り込みキュー（ingest_queue）のワーカー
+
+gas_webhook の非同期モード（?mode=async または WEBHOOK_INGEST_MODE=async）で
+キューに追加されたバッチを、古い順に反映します。
+複数のワーカーを同時に起動しても、同じバッチを二重に反映しません（FOR UPDATE SKIP LOCKED）。
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python ingest_worker.py          # 常駐（キューが空の間は POLL_INTERVAL 秒ごとに確認）
+    python ingest_worker.py --once   # 待機中のバッチを1回処理して終了
+"""
+import sys
+import time
+
+from app import app, process_ingest_queue
+
+# キューが空のときの確認間隔（秒）
+POLL_INTERVAL = 5
+
+
+def main():
+    once = '--once' in sys.argv[1:]
+    while True:
+        try:
+            with app.app_context():
+                processed = process_ingest_queue()
+        except Exception as e:
+            # DB接続エラーなどはワーカーを止めずに次の確認まで待つ
+            print(f"⚠️  Ingest worker error: {e}")
+            processed = []
+        for outcome in processed:
+            print(f"[INFO] batch {outcome['batch_id']}: {outcome['status']}"
+                  + (f" ({outcome['error']})" if outcome.get('error') else ''))
+        if once:
+            break
+        if not processed:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+サーバーレス向け接続モード（DB_POOL_MODE=serverless）の負荷試験
+
+Vercel のインスタンスを別プロセスで再現し、それぞれが app.py を読み込んで
+webhook（同期・非同期）と読み取りAPI（通常・ストリーミング・空き状況）を繰り返し呼び出します。
+接続は PgBouncer（トランザクションモード）の代わりの PoolerStandInConnection（test_db_pool.py）を通すため、
+トランザクションをまたぐセッション状態に依存するコードがあればエラーとして表示されます。
+
+計測するもの:
+- 接続数のピーク（pg_stat_activity を監視）と、上限（インスタンス数 × 1インスタンスの上限）
+- インスタンスごとの新規接続数（温まったインスタンスは接続を再利用するので 1 前後）
+- レスポンス時間（p50 / p95）とエラー数
+
+テーブルは専用のスキーマ（loadtest_pooler、終了時に削除）に migrations/ から作成するため、
+本番のテーブルには触れません。
+
+使い方:
+    export POSTGRES_URL='postgresql://...'
+    python loadtest_serverless_pool.py                  # 8 インスタンス × 100 リクエスト、各インスタンス 1 並列
+    python loadtest_serverless_pool.py 16 200 4         # インスタンス数・リクエスト数・インスタンス内の並列数
+    python loadtest_serverless_pool.py 8 100 4 server   # 比較用に server モードで実行
+"""
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+SCHEMA = 'loadtest_pooler'
+APPLICATION_NAME = 'loadtest_pooler'
+STORES = ['shibuya', 'yoyogi-uehara', 'nakameguro', 'ebisu', 'hanzomon']
+MIGRATIONS = [
+    '001_add_security_tables', '003_add_reservation_indexes', '004_add_reservation_date_index',
+    '005_add_reservation_versions', '006_add_reservation_changes', '007_add_reservation_email_id_unique',
+    '008_add_webhook_item_hashes', '009_add_ingest_queue',
+]
+# COPY で取り込む大きなバッチ（ingest.COPY_THRESHOLD 以上）を送るリクエストの間隔
+LARGE_BATCH_EVERY = 50
+
+
+def connect_options():
+    """専用スキーマを使い、pg_stat_activity で見分けられるようにする接続パラメータ"""
+    return {'options': f'-c search_path={SCHEMA}', 'application_name': APPLICATION_NAME}
+
+
+def create_schema(database_url):
+    """専用スキーマに予約テーブルを作り、migrations/ を適用"""
+    conn = psycopg2.connect(database_url, **connect_options())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            cur.execute(f"CREATE SCHEMA {SCHEMA}")
+            cur.execute("""
+                CREATE TABLE reservations (
+                    id SERIAL PRIMARY KEY, date DATE NOT NULL, start_time TIME NOT NULL, end_time TIME NOT NULL,
+                    customer_name VARCHAR(100), type VARCHAR(20) DEFAULT 'gmail',
+                    is_cancellation BOOLEAN DEFAULT FALSE, store VARCHAR(50) DEFAULT 'shibuya',
+                    source VARCHAR(50), email_id VARCHAR(255), created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    room_name VARCHAR(50) DEFAULT '個室B'
+                )
+            """)
+            for name in MIGRATIONS:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations', f'{name}.sql')) as f:
+                    cur.execute(f.read())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def drop_schema(database_url):
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def make_batch(instance, request_number, count):
+    """インスタンス・リクエストごとに email_id の異なる予約バッチ"""
+    batch = []
+    for i in range(count):
+        hour = 8 + i % 12
+        batch.append({
+            'store': STORES[(instance + i) % len(STORES)],
+            'date': f'2030-{1 + request_number % 12:02d}-{1 + i % 28:02d}',
+            'start': f'{hour:02d}:00',
+            'end': f'{hour + 1:02d}:00',
+            'customer_name': f'お客様{instance}-{i}',
+            'room_name': '個室A' if i % 2 else '個室B',
+            'email_id': f'load-{instance}-{request_number}-{i}'
+        })
+    return batch
+
+
+def instance_requests(client, app_module, instance, request_number):
+    """1リクエスト分の処理（種類を順番に切り替える）。(リクエストの種類, ステータスコード) を返す"""
+    store = STORES[(instance + request_number) % len(STORES)]
+    kind = request_number % 5
+    if request_number % LARGE_BATCH_EVERY == 0:
+        batch = make_batch(instance, request_number, 1200)
+        return 'webhook-copy', client.post('/api/gas/webhook', json={'reservations': batch}).status_code
+    if kind == 0:
+        batch = make_batch(instance, request_number, 20)
+        return 'webhook', client.post('/api/gas/webhook', json={'reservations': batch}).status_code
+    if kind == 1:
+        batch = make_batch(instance, request_number, 20)
+        status = client.post('/api/gas/webhook?mode=async', json={'reservations': batch}).status_code
+        with app_module.app.app_context():
+            app_module.process_ingest_queue(1)
+        return 'webhook-async', status
+    if kind == 2:
+        response = client.get(f'/api/reservations?store={store}&date_from=2030-01-01&date_to=2030-02-28')
+        return 'reservations', response.status_code
+    if kind == 3:
+        response = client.get(f'/api/reservations?store={store}&date_from=2030-01-01&date_to=2030-12-31&stream=1')
+        response.get_data()
+        return 'stream', response.status_code
+    response = client.get(f'/api/availability?date=2030-01-{1 + request_number % 28:02d}'
+                          f'&start_time=10:00&end_time=11:00&store={store}')
+    return 'availability', response.status_code
+
+
+def run_instance(instance, requests_per_instance, concurrency, mode, results):
+    """1インスタンス（1プロセス）分の負荷をかけ、結果を results に追加"""
+    # アプリの [DEBUG] 出力は表示しない
+    sys.stdout = open(os.devnull, 'w')
+    os.environ['DB_POOL_MODE'] = mode
+    import app as app_module
+    from db_pool import ConnectionPool
+    from test_db_pool import PoolerStandInConnection
+
+    app_module.limiter.enabled = False
+    settings = dict(app_module.DB_POOL_SETTINGS[mode], maxconn=app_module.DB_POOL_MAX_CONNECTIONS)
+    # server モードではプリペアドステートメントを使う（プーラーの代わりの接続で消えても通常の実行に戻ること）
+    settings['prepare_statements'] = app_module.use_prepared_statements(
+        os.environ.get('DB_PREPARED_STATEMENTS'), mode, os.environ['POSTGRES_URL'])
+    app_module.db_pool = ConnectionPool(dsn=os.environ['POSTGRES_URL'], connection_factory=PoolerStandInConnection,
+                                        **settings, **connect_options())
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(requests_per_instance))
+
+    def worker():
+        client = app_module.app.test_client()
+        while True:
+            with lock:
+                request_number = next(counter, None)
+            if request_number is None:
+                return
+            start = time.perf_counter()
+            try:
+                kind, status = instance_requests(client, app_module, instance, request_number)
+                error = f'{kind}: HTTP {status}' if status >= 400 else None
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors.append(error)
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    results.put({
+        'instance': instance,
+        'latencies': latencies,
+        'errors': errors,
+        'connects': PoolerStandInConnection.connects,
+        'maxconn': settings['maxconn'],
+    })
+
+
+def main():
+    database_url = os.environ.get('POSTGRES_URL')
+    if not database_url:
+        print("❌ POSTGRES_URL environment variable is not set")
+        sys.exit(1)
+
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests_per_instance = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    mode = sys.argv[4] if len(sys.argv) > 4 else 'serverless'
+
+    create_schema(database_url)
+    monitor = psycopg2.connect(database_url)
+    monitor.autocommit = True
+    peak = 0
+    try:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = [
+            context.Process(target=run_instance, args=(i, requests_per_instance, concurrency, mode, results))
+            for i in range(instances)
+        ]
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        collected = []
+        with monitor.cursor() as cur:
+            while len(collected) < instances:
+                cur.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE application_name = %s",
+                            (APPLICATION_NAME,))
+                peak = max(peak, cur.fetchone()[0])
+                while not results.empty():
+                    collected.append(results.get())
+                if not any(p.is_alive() for p in processes) and results.empty():
+                    break
+                time.sleep(0.01)
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        monitor.close()
+        drop_schema(database_url)
+
+    limit = sum(result['maxconn'] for result in collected)
+    latencies = sorted(latency for result in collected for latency in result['latencies'])
+    errors = [error for result in collected for error in result['errors']]
+    connects = [result['connects'] for result in collected]
+
+    print(f"mode={mode} instances={instances} requests/instance={requests_per_instance} concurrency={concurrency}")
+    print(f"requests:          {len(latencies)} in {elapsed:.1f}s")
+    if latencies:
+        print(f"latency p50 / p95: {latencies[len(latencies) // 2] * 1000:.1f} ms / "
+              f"{latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+    print(f"peak connections:  {peak} (limit {limit})")
+    print(f"connects/instance: min {min(connects, default=0)} max {max(connects, default=0)}")
+    print(f"errors:            {len(errors)}")
+    for error in sorted(set(errors))[:10]:
+        print(f"  ⚠️  {error}")
+    if len(collected) < instances or errors or peak > limit:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
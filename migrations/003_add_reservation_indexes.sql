@@ -0,0 +1,5 @@
+-- Add composite index for per-store/per-date reservation lookups
+-- Used by the availability engine, which loads a store's whole day in one query
+
+CREATE INDEX IF NOT EXISTS idx_reservations_store_date
+ON reservations(store, date, start_time);
@@ -0,0 +1,5 @@
+-- Add index for date-windowed reservation listing across all stores
+-- Matches the keyset pagination order of /api/reservations (date, start_time, id)
+
+CREATE INDEX IF NOT EXISTS idx_reservations_date_start_id
+ON reservations(date, start_time, id);
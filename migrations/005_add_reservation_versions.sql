@@ -0,0 +1,52 @@
+-- Add per-store change counter for conditional GET (ETag / Last-Modified)
+-- Every statement that writes reservations bumps the version of each store it touched,
+-- including writes from scripts outside app.py (e.g. clear_gmail_reservations.py)
+
+CREATE TABLE IF NOT EXISTS reservation_versions (
+    store VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO reservation_versions (store)
+SELECT DISTINCT store FROM reservations WHERE store IS NOT NULL
+ON CONFLICT (store) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_reservation_versions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO reservation_versions AS v (store, version, updated_at)
+        SELECT DISTINCT store, 1, CURRENT_TIMESTAMP FROM new_rows WHERE store IS NOT NULL
+        ON CONFLICT (store) DO UPDATE SET version = v.version + 1, updated_at = CURRENT_TIMESTAMP;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO reservation_versions AS v (store, version, updated_at)
+        SELECT store, 1, CURRENT_TIMESTAMP FROM (
+            SELECT store FROM new_rows UNION SELECT store FROM old_rows
+        ) touched WHERE store IS NOT NULL
+        ON CONFLICT (store) DO UPDATE SET version = v.version + 1, updated_at = CURRENT_TIMESTAMP;
+    ELSE
+        INSERT INTO reservation_versions AS v (store, version, updated_at)
+        SELECT DISTINCT store, 1, CURRENT_TIMESTAMP FROM old_rows WHERE store IS NOT NULL
+        ON CONFLICT (store) DO UPDATE SET version = v.version + 1, updated_at = CURRENT_TIMESTAMP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reservations_version_insert ON reservations;
+CREATE TRIGGER reservations_version_insert
+AFTER INSERT ON reservations
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_reservation_versions();
+
+DROP TRIGGER IF EXISTS reservations_version_update ON reservations;
+CREATE TRIGGER reservations_version_update
+AFTER UPDATE ON reservations
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_reservation_versions();
+
+DROP TRIGGER IF EXISTS reservations_version_delete ON reservations;
+CREATE TRIGGER reservations_version_delete
+AFTER DELETE ON reservations
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_reservation_versions();
@@ -0,0 +1,63 @@
+-- Add change tracking for delta sync (/api/reservations/changes)
+-- Every inserted/updated row gets updated_at and a change key (change_txid, change_seq);
+-- every deleted row leaves a tombstone with its own change key.
+-- Triggers cover all write paths, including scripts outside app.py
+-- (delete_reservation, gas_webhook cancellations, clear_gmail_reservations, cleanup-duplicates).
+--
+-- change_txid is the writing transaction's id. Readers only return changes from
+-- transactions older than every running transaction (pg_snapshot_xmin), so a slow
+-- transaction that commits late can never be skipped by a cursor that already moved past it.
+
+CREATE SEQUENCE IF NOT EXISTS reservation_change_seq;
+
+ALTER TABLE reservations ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;
+ALTER TABLE reservations ADD COLUMN IF NOT EXISTS change_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE reservations ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('reservation_change_seq');
+
+-- Existing rows: last update = creation time
+UPDATE reservations SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+ALTER TABLE reservations ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE reservations ALTER COLUMN updated_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_reservations_change
+ON reservations (change_txid, change_seq);
+
+CREATE TABLE IF NOT EXISTS reservation_tombstones (
+    change_seq BIGINT PRIMARY KEY DEFAULT nextval('reservation_change_seq'),
+    change_txid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+    reservation_id INTEGER NOT NULL,
+    store VARCHAR(50),
+    date DATE,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_reservation_tombstones_change
+ON reservation_tombstones (change_txid, change_seq);
+
+CREATE OR REPLACE FUNCTION stamp_reservation_change() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := CURRENT_TIMESTAMP;
+    NEW.change_txid := pg_current_xact_id();
+    NEW.change_seq := nextval('reservation_change_seq');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reservations_change_stamp ON reservations;
+CREATE TRIGGER reservations_change_stamp
+BEFORE INSERT OR UPDATE ON reservations
+FOR EACH ROW EXECUTE FUNCTION stamp_reservation_change();
+
+CREATE OR REPLACE FUNCTION record_reservation_tombstones() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO reservation_tombstones (reservation_id, store, date)
+    SELECT id, store, date FROM old_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reservations_tombstone ON reservations;
+CREATE TRIGGER reservations_tombstone
+AFTER DELETE ON reservations
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION record_reservation_tombstones();
@@ -0,0 +1,16 @@
+-- Add unique index on (store, email_id) for set-based webhook upserts
+-- (INSERT ... ON CONFLICT (store, email_id) DO UPDATE)
+
+-- Empty email_id is treated as "no email_id" by the webhook
+UPDATE reservations SET email_id = NULL WHERE email_id = '';
+
+-- Remove existing duplicates, keeping the newest row (same rule as /api/admin/cleanup-duplicates)
+DELETE FROM reservations r1
+USING reservations r2
+WHERE r1.id < r2.id
+AND r1.email_id IS NOT NULL
+AND r1.email_id = r2.email_id
+AND r1.store = r2.store;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_reservations_store_email_id
+ON reservations (store, email_id);
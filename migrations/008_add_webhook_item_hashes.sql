@@ -0,0 +1,11 @@
+-- Add per-store content hashes of recently applied webhook items
+-- gas_webhook skips items whose hash was recorded at the store's current
+-- reservation_versions.version (i.e. nothing has changed the store since)
+
+CREATE TABLE IF NOT EXISTS webhook_item_hashes (
+    store VARCHAR(50) NOT NULL,
+    item_hash CHAR(32) NOT NULL,
+    version BIGINT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (store, item_hash)
+);
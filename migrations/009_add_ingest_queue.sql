@@ -0,0 +1,23 @@
+-- Add queue for asynchronous webhook ingest (gas_webhook ?mode=async)
+-- gas_webhook appends the raw batch and returns 202; workers claim pending
+-- batches with FOR UPDATE SKIP LOCKED and apply them (process_ingest_queue)
+
+CREATE TABLE IF NOT EXISTS ingest_queue (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending / done / failed
+    payload JSONB NOT NULL,
+    item_count INTEGER NOT NULL,
+    stores TEXT[] NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMPTZ,
+    result JSONB,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_pending
+ON ingest_queue (id) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_finished_at
+ON ingest_queue (finished_at) WHERE status IN ('done', 'failed');
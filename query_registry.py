@@ -0,0 +1,141 @@
+"""
+よく使うクエリの登録とプリペアドステートメント
+
+空き状況・予約一覧・webhook の email_id の検索・ログインのユーザー検索など、
+1日に何千回も実行される少数のSQLに名前を付けて登録します。
+長く使う接続（server モードのプールの接続）では、接続ごとに1回だけ PREPARE し、
+以降は EXECUTE で実行するため、毎回の構文解析と実行計画の作成を省けます。
+
+次の場合は通常の実行（cur.execute(sql, params)）になります。
+
+- 接続がプールの接続でない（prepared_statements 属性がない、またはNone。テスト・スクリプトの接続など）
+- サーバーレスモード・プーラー越し（app.py の DB_PREPARED_STATEMENTS の判定で無効）
+- 実行中にプリペアドステートメントが消えていた（トランザクションモードのプーラーで別のサーバー接続に
+  切り替わった）場合。以降はプロセス全体で通常の実行に切り替えます
+- トランザクションの途中の文で、前のトランザクションで PREPARE したものを使えることがまだ接続で
+  確認できていない場合（途中で失敗するとトランザクションごとやり直しになるため）
+
+SQLのプレースホルダーは psycopg2 と同じ %s または %(名前)s です（リテラルの % は %%）。
+配列のパラメータは、通常の実行と同じ型になるよう register_query() の param_types で型を指定します
+（psycopg2 はリストを text[] として渡すため、PREPARE で date[] などと推論されるとエラーになる）。
+"""
+import re
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+PLACEHOLDER_PATTERN = re.compile(r'%\((\w+)\)s|%s|%%')
+
+# 名前 -> Query
+QUERIES = {}
+# プーラー越しでプリペアドステートメントが使えないと分かった場合にTrue
+prepared_statements_disabled = False
+
+
+class Query:
+    """登録したクエリ（PREPARE / EXECUTE 用のSQLを作成済み）"""
+    __slots__ = ('name', 'sql', 'prepare_sql', 'execute_sql', 'param_names')
+
+    def __init__(self, name, sql, param_types=None):
+        self.name = name
+        self.sql = sql
+        names = []
+        positions = {}
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                names.append(None)
+                return f'${len(names)}'
+            # 同じ名前は同じパラメータ番号を使う
+            if match.group(1) not in positions:
+                names.append(match.group(1))
+                positions[match.group(1)] = len(names)
+            return f'${positions[match.group(1)]}'
+
+        body = PLACEHOLDER_PATTERN.sub(replace, sql)
+        if None in names and any(names):
+            raise ValueError(f"query {name}: cannot mix %s and %(name)s placeholders")
+        self.param_names = names if any(names) else None
+        if param_types is not None and len(param_types) != len(names):
+            raise ValueError(f"query {name}: {len(names)} parameters but {len(param_types)} param_types")
+        types = f" ({', '.join(param_types)})" if param_types else ''
+        self.prepare_sql = f'PREPARE {name}{types} AS {body}'
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * len(names))})" if names else f'EXECUTE {name}'
+
+    def execute_params(self, params):
+        """EXECUTE に渡す位置パラメータ（%(名前)s の場合は辞書から並べ替え）"""
+        if self.param_names is None:
+            return params
+        return [params[name] for name in self.param_names]
+
+
+def register_query(name, sql, param_types=None):
+    """
+    クエリを名前付きで登録（同じ名前・同じSQLの場合は登録済みのものを返す）
+
+    Args:
+        name (str): プリペアドステートメントの名前（英小文字・数字・_）
+        sql (str): SQL
+        param_types (tuple): PREPARE のパラメータの型（例: ('text[]', 'text[]')、Noneの場合は推論させる）
+
+    Raises:
+        ValueError: 同じ名前で別のSQLが登録済みの場合
+    """
+    query = QUERIES.get(name)
+    if query is None:
+        if not re.fullmatch(r'[a-z_][a-z0-9_]*', name):
+            raise ValueError(f"invalid query name: {name}")
+        query = QUERIES[name] = Query(name, sql, param_types)
+    elif query.sql != sql:
+        raise ValueError(f"query {name} is already registered with different SQL")
+    return query
+
+
+def execute_query(cur, query, params=()):
+    """
+    登録したクエリを実行（使える接続ではプリペアドステートメント、それ以外は通常の実行）
+
+    Args:
+        cur: データベースカーソル
+        query (Query): register_query() の戻り値
+        params (tuple/dict): パラメータ（SQLのプレースホルダーに合わせる）
+    """
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared_statements', None)
+    if prepared is None or prepared_statements_disabled:
+        cur.execute(query.sql, params)
+        return
+
+    # トランザクションの最初の文なら、プリペアドステートメントが消えていても通常の実行でやり直せる
+    was_idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if not was_idle and not conn.prepared_statements_verified:
+        # トランザクションの途中で失敗するとやり直せないため、接続で確認できるまでは通常の実行
+        cur.execute(query.sql, params)
+        return
+    reused = was_idle and query.name in prepared
+    try:
+        if query.name not in prepared:
+            # PREPARE はトランザクションが rollback されても残る
+            cur.execute(query.prepare_sql)
+            prepared.add(query.name)
+        cur.execute(query.execute_sql, query.execute_params(params))
+    except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement) as e:
+        disable_prepared_statements(f"{type(e).__name__} on {query.name}")
+        if not was_idle:
+            raise
+        conn.rollback()
+        cur.execute(query.sql, params)
+        return
+    if reused:
+        conn.prepared_statements_verified = True
+
+
+def disable_prepared_statements(reason):
+    """プロセス全体でプリペアドステートメントを使わないようにする（プーラー越しと判断した場合）"""
+    global prepared_statements_disabled
+    if not prepared_statements_disabled:
+        prepared_statements_disabled = True
+        print(f"⚠️  Prepared statements disabled (transaction pooler suspected: {reason})")
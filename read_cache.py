@@ -0,0 +1,144 @@
+"""
+読み取りキャッシュモジュール
+
+予約一覧・空き状況APIの計算結果をプロセス内にキャッシュします。
+店舗・日付のデータは書き込み（GAS webhook、手動追加・削除、部屋名変更）でしか
+変わらないため、書き込み時に該当する (店舗, 日付) のエントリだけを無効化します。
+
+- 件数上限を超えたら最も使われていないエントリから削除（LRU）
+- 別インスタンスからの書き込みは検知できないため、TTLで必ず期限切れにする
+- ヒット・ミス・削除件数を管理画面向けに集計
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReadCache:
+    """
+    (エンドポイント, 店舗, 日付, パラメータ) をキーにしたLRUキャッシュ
+
+    各エントリは依存する「スコープ」(店舗, 日付) のリストを持ちます。
+    Noneはワイルドカードで、(None, '2025-12-01') は全店舗のその日、
+    ('shibuya', None) は渋谷店の全日付に依存することを表します。
+    """
+
+    def __init__(self, max_entries=512, ttl_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, scopes, value)
+        self._lock = threading.Lock()
+        # 無効化のたびに増える世代番号（計算中に無効化された結果を保存しないため）
+        self._generation = 0
+        # 最後に無効化した時刻（time.monotonic()、リードレプリカが書き込みに追いついたかの判定用）
+        self._invalidated_at = None
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    @property
+    def generation(self):
+        """現在の世代番号（set() に渡して、計算中の無効化を検知する）"""
+        return self._generation
+
+    @property
+    def invalidated_at(self):
+        """最後に無効化した時刻（time.monotonic()、一度も無効化していない場合はNone）"""
+        return self._invalidated_at
+
+    def get(self, key):
+        """キャッシュから取得（ない・期限切れの場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[2]
+
+    def set(self, key, value, scopes, generation=None):
+        """
+        キャッシュに保存
+
+        Args:
+            key (tuple): キャッシュキー
+            value: 保存する値（Noneは保存しない）
+            scopes (list): 依存する (店舗, 日付) のリスト
+            generation (int): 計算開始時の世代番号。その後に無効化があった場合は保存しない
+        """
+        if value is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, list(scopes), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def get_or_compute(self, key, scopes, compute):
+        """
+        キャッシュにあれば返し、なければ compute() の結果を保存して返す
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation
+        value = compute()
+        self.set(key, value, scopes, generation)
+        return value
+
+    def invalidate(self, store=None, date=None):
+        """
+        書き込みのあった (店舗, 日付) に依存するエントリを削除
+
+        Args:
+            store (str): 店舗ID（Noneの場合は全店舗）
+            date (str | datetime.date): 日付（Noneの場合は全日付）
+
+        Returns:
+            int: 削除したエントリ数
+        """
+        date = str(date) if date is not None else None
+        with self._lock:
+            self._generation += 1
+            self._invalidated_at = time.monotonic()
+            stale = [
+                key for key, (_, scopes, _) in self._entries.items()
+                if any(
+                    (s is None or store is None or s == store) and
+                    (d is None or date is None or d == date)
+                    for s, d in scopes
+                )
+            ]
+            for key in stale:
+                del self._entries[key]
+            self._counters['invalidations'] += len(stale)
+            return len(stale)
+
+    def clear(self):
+        """全エントリを削除（一括削除などの書き込み用）"""
+        return self.invalidate()
+
+    def stats(self):
+        """ヒット率などの集計値を取得"""
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return dict(
+                self._counters,
+                size=len(self._entries),
+                max_entries=self.max_entries,
+                ttl_seconds=self.ttl_seconds,
+                hit_rate=round(self._counters['hits'] / lookups, 4) if lookups else None
+            )
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+空き状況計算モジュールのテスト
+
+ランダムな予約データに対して、占有エンジン（availability.py）の結果が
+従来のスロットごとのCOUNTクエリと一致することを確認します。
+
+- 常に sqlite3（インメモリ）で従来SQLを実行して比較
+- POSTGRES_URL が設定されていれば、PostgreSQLの一時テーブルでも比較
+"""
+import os
+import random
+import sqlite3
+
+import pytest
+
+from availability import (
+    generate_slots, minutes_to_time, slot_occupancy, peak_occupancy,
+    free_ranges, build_occupancy_matrix, free_ranges_matrix, free_ranges_remaining_matrix,
+    saturated_intervals, feasible_starts, room_slot_occupancy
+)
+
+# PostgreSQLを使うテスト（POSTGRES_URL が設定されていなければスキップ）
+requires_postgres = pytest.mark.skipif(not os.environ.get('POSTGRES_URL'), reason='POSTGRES_URL not set')
+
+# 従来の check_availability で使っていたスロットごとのSQL
+LEGACY_COUNT_SQL = """
+    SELECT COUNT(*) FROM reservations
+    WHERE date = %s
+    AND store = %s
+    AND start_time <= %s
+    AND end_time > %s
+"""
+LEGACY_DISTINCT_ROOM_SQL = """
+    SELECT COUNT(DISTINCT room_name) FROM reservations
+    WHERE date = %s
+    AND store = %s
+    AND start_time <= %s
+    AND end_time > %s
+"""
+
+DATE = '2025-12-01'
+STORE = 'hanzomon'
+ROOMS = ['個室A', '個室B', None]
+
+
+def random_reservations(rng, count):
+    """ランダムな予約（開始分, 終了分, 部屋名）を生成（15分刻み・開始>=終了の不正データも含む）"""
+    reservations = []
+    for _ in range(count):
+        start = rng.randrange(0, 24 * 60, 15)
+        end = rng.randrange(0, 24 * 60, 15)
+        if rng.random() < 0.9 and end <= start:
+            start, end = end, start
+        reservations.append((start, end, rng.choice(ROOMS)))
+    return reservations
+
+
+def legacy_slot_counts(cur, slots, distinct_rooms, placeholder='%s'):
+    """従来のスロットごとのSQLでスロット時点の利用数を取得"""
+    sql = LEGACY_DISTINCT_ROOM_SQL if distinct_rooms else LEGACY_COUNT_SQL
+    sql = sql.replace('%s', placeholder)
+    counts = []
+    for slot in slots:
+        slot_time = minutes_to_time(slot)
+        cur.execute(sql, (DATE, STORE, slot_time, slot_time))
+        counts.append(cur.fetchone()[0])
+    return counts
+
+
+def compare_with_cursor(cur, load, placeholder, rounds=30):
+    """任意のDBカーソルで従来SQLと占有エンジンの結果を比較"""
+    rng = random.Random(20251201)
+    for _ in range(rounds):
+        reservations = random_reservations(rng, rng.randrange(0, 40))
+        load(reservations)
+
+        start = rng.randrange(0, 24 * 60, 30)
+        end = rng.randrange(start, 24 * 60 + 1, 30)
+        slots = generate_slots(start, end)
+
+        for distinct_rooms in (False, True):
+            expected = legacy_slot_counts(cur, slots, distinct_rooms, placeholder)
+            actual = slot_occupancy(reservations, slots, distinct_rooms)
+            assert actual == expected, (reservations, start, end, distinct_rooms)
+            assert peak_occupancy(reservations, start, end, distinct_rooms) == max(expected, default=0)
+
+
+def test_matches_legacy_sql_sqlite():
+    """sqlite3で従来SQLと比較（時刻はHH:MM文字列なので文字列比較で同じ判定になる）"""
+    conn = sqlite3.connect(':memory:')
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE reservations (
+            date TEXT, store TEXT, start_time TEXT, end_time TEXT, room_name TEXT
+        )
+    """)
+
+    def load(reservations):
+        cur.execute("DELETE FROM reservations")
+        cur.executemany(
+            "INSERT INTO reservations VALUES (?, ?, ?, ?, ?)",
+            [(DATE, STORE, minutes_to_time(s), minutes_to_time(e), room) for s, e, room in reservations]
+        )
+        # 他店舗・他日付のデータは結果に影響しないこと
+        cur.execute("INSERT INTO reservations VALUES (?, ?, '00:00', '23:30', '個室A')", ('2025-12-02', STORE))
+        cur.execute("INSERT INTO reservations VALUES (?, ?, '00:00', '23:30', '個室A')", (DATE, 'shibuya'))
+
+    compare_with_cursor(cur, load, '?')
+    conn.close()
+
+
+@requires_postgres
+def test_matches_legacy_sql_postgres():
+    """PostgreSQLの一時テーブルで従来SQLと比較（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # 一時テーブルは同名の本番テーブルより優先されるので、従来SQLをそのまま実行できる
+        cur.execute("""
+            CREATE TEMP TABLE reservations (
+                date DATE, store VARCHAR(50), start_time TIME, end_time TIME, room_name VARCHAR(50)
+            )
+        """)
+
+        def load(reservations):
+            cur.execute("DELETE FROM reservations")
+            cur.executemany(
+                "INSERT INTO reservations VALUES (%s, %s, %s, %s, %s)",
+                [(DATE, STORE, minutes_to_time(s), minutes_to_time(e), room) for s, e, room in reservations]
+            )
+
+        compare_with_cursor(cur, load, '%s')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_boundaries():
+    """終了時刻ちょうどのスロットは空き、開始時刻ちょうどのスロットは使用中"""
+    reservations = [(600, 660, '個室A'), (660, 720, '個室A')]
+    assert slot_occupancy(reservations, [570, 600, 630, 660, 690, 720]) == [0, 1, 1, 1, 1, 0]
+    assert slot_occupancy(reservations, [660], distinct_rooms=True) == [1]
+    assert peak_occupancy(reservations, 600, 600) == 0
+
+
+def test_room_capacity():
+    """定員3の部屋は3件目の予約で満室になり、店舗全体の利用枠は定員で頭打ちになること"""
+    rooms = {'個室A': {'max_capacity': 1}, '個室B': {'max_capacity': 3}}
+    reservations = [
+        (600, 720, '個室A'), (600, 720, '個室A'),
+        (600, 660, '個室B'), (630, 690, '個室B'), (630, 720, '個室B'), (600, 720, '個室B'),
+        (600, 720, None), (600, 720, '不明な部屋'),
+    ]
+    per_room, store_used = room_slot_occupancy(reservations, rooms, [570, 600, 630, 690])
+    assert per_room == {'個室A': [0, 2, 2, 2], '個室B': [0, 2, 4, 2]}
+    assert store_used == [0, 4, 5, 4]
+
+
+def test_matrix_matches_sweep():
+    """複数日の利用数行列・空き時間帯が、日ごとのスイープ計算と一致すること"""
+    rng = random.Random(7)
+    num_rooms, num_days = 3, 5
+    for _ in range(20):
+        start = rng.randrange(0, 24 * 60, 30)
+        end = rng.randrange(start, 24 * 60 + 1, 30)
+        slots = generate_slots(start, end)
+        entries = [
+            (rng.randrange(num_rooms), rng.randrange(num_days), s, e)
+            for s, e, _ in random_reservations(rng, rng.randrange(0, 60))
+        ]
+        matrix = build_occupancy_matrix(entries, num_rooms, num_days, slots)
+        assert matrix.shape == (num_rooms, num_days, len(slots))
+
+        for room in range(num_rooms):
+            ranges = free_ranges_matrix(matrix[room] < 1, slots, end)
+            for day in range(num_days):
+                day_reservations = [(s, e, None) for r, d, s, e in entries if r == room and d == day]
+                occupancy = slot_occupancy(day_reservations, slots)
+                assert matrix[room, day].tolist() == occupancy
+                assert ranges[day] == free_ranges(slots, occupancy, 1, end)
+
+            # 定員が複数の部屋: 残り枠数が /api/availability（build_detailed_result）と同じ計算になること
+            capacity = rng.randrange(1, 4)
+            remaining = free_ranges_remaining_matrix(matrix[room], capacity, slots, end)
+            for day in range(num_days):
+                occupancy = matrix[room, day].tolist()
+                assert remaining[day] == [
+                    (s, e, capacity - max(occupancy[i] for i, slot in enumerate(slots) if s <= slot < e))
+                    for s, e in free_ranges(slots, occupancy, capacity, end)
+                ]
+
+
+def test_feasible_starts_match_brute_force():
+    """区間インデックスによる空き枠検索が、1分刻みの総当たりと一致すること"""
+    rng = random.Random(42)
+    for _ in range(50):
+        capacity = rng.choice([1, 2, 3])
+        reservations = random_reservations(rng, rng.randrange(0, 15))
+        open_minutes, close_minutes = rng.choice([(0, 24 * 60), (510, 1320)])
+        duration = rng.choice([30, 60, 90, 150])
+        earliest = rng.randrange(0, 24 * 60, 10)
+
+        expected = []
+        for t in range(0, 24 * 60, 30):
+            if t < max(open_minutes, earliest) or t + duration > close_minutes:
+                continue
+            peak = max(
+                sum(1 for s, e, _ in reservations if s <= m < e)
+                for m in range(t, t + duration)
+            )
+            if peak < capacity:
+                expected.append(t)
+
+        blocked = saturated_intervals(reservations, capacity)
+        assert feasible_starts(blocked, open_minutes, close_minutes, duration, earliest) == expected
+        assert feasible_starts(blocked, open_minutes, close_minutes, duration, earliest, limit=2) == expected[:2]
+
+
+if __name__ == '__main__':
+    test_matches_legacy_sql_sqlite()
+    if os.environ.get('POSTGRES_URL'):
+        test_matches_legacy_sql_postgres()
+    test_boundaries()
+    test_room_capacity()
+    test_matrix_matches_sweep()
+    test_feasible_starts_match_brute_force()
+    print("✓ 全テスト合格")
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+空き状況APIの入力チェックのテスト（Flaskのテストクライアント）
+
+入力エラーはデータベースに接続する前に400を返すため、POSTGRES_URL は不要です。
+"""
+import app as app_module
+
+
+def test_range_invalid_time_returns_400():
+    """/api/availability/range: 不正な時刻は500ではなく400を返すこと"""
+    client = app_module.app.test_client()
+    for start_time, end_time in [('7pm', '21:00'), ('19:00', '9'), ('19:xx', '21:00')]:
+        response = client.get(f'/api/availability/range?date_from=2030-01-01&date_to=2030-01-07'
+                              f'&start_time={start_time}&end_time={end_time}')
+        assert response.status_code == 400, (start_time, end_time, response.status_code)
+        assert response.json['error'] == 'Invalid time format (HH:MM)'
+
+
+def test_next_invalid_time_returns_400():
+    """/api/availability/next: 不正な時刻は400を返すこと（range と同じ扱い）"""
+    client = app_module.app.test_client()
+    response = client.get('/api/availability/next?date=2030-01-01&duration=60&start_time=7pm')
+    assert response.status_code == 400
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+差分同期API（/api/reservations/changes）のカーソルのテスト（Flaskのテストクライアント）
+
+期限切れ・不正なカーソルはデータベースに接続する前に返すため、POSTGRES_URL は不要です。
+"""
+import time
+
+import app as app_module
+
+
+def test_cursor_round_trip():
+    """カーソルに変更キーと発行時刻が入り、以前の形式は発行時刻なしになること"""
+    cursor = app_module.encode_change_cursor(774, 235, issued_at=1700000000)
+    assert app_module.decode_change_cursor(cursor) == (774, 235, 1700000000)
+    assert app_module.decode_change_cursor('Nzc0fDIzNQ') == (774, 235, None)
+
+
+def test_expired_cursor_returns_410():
+    """保持期間より古いカーソル・発行時刻のないカーソルは 410（全件の再同期）を返すこと"""
+    client = app_module.app.test_client()
+    expired = app_module.encode_change_cursor(
+        1, 1, issued_at=time.time() - app_module.CHANGES_RETENTION_DAYS * 86400 - 60
+    )
+    for cursor in (expired, 'Nzc0fDIzNQ'):
+        response = client.get(f'/api/reservations/changes?since={cursor}')
+        assert response.status_code == 410
+        assert response.json['retention_days'] == app_module.CHANGES_RETENTION_DAYS
+
+    response = client.get('/api/reservations/changes?since=zz')
+    assert response.status_code == 400
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+接続プール（db_pool.ConnectionPool）のテスト
+
+POSTGRES_URL が設定されている場合のみ実行します。
+PoolerStandInConnection は loadtest_serverless_pool.py でも使います。
+"""
+import os
+import threading
+import time
+
+import psycopg2
+import pytest
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+
+from db_pool import ConnectionPool, InstrumentedConnection
+
+
+# PostgreSQLを使うテスト（POSTGRES_URL が設定されていなければスキップ）
+requires_postgres = pytest.mark.skipif(not os.environ.get('POSTGRES_URL'), reason='POSTGRES_URL not set')
+
+
+class PoolerStandInConnection(InstrumentedConnection):
+    """
+    PgBouncer（トランザクションモード）の代わりになる接続
+
+    トランザクションが終わるたびに DISCARD ALL でセッション状態を捨てます。
+    プーラー越しでは次のトランザクションが別のサーバー接続で実行されるため、
+    トランザクションをまたいで SET・PREPARE・一時テーブル・WITH HOLD カーソルに依存するコードは
+    この接続でもエラーになるか、状態が消えて結果が変わります。
+    """
+    connects = 0
+    _connects_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._connects_lock:
+            PoolerStandInConnection.connects += 1
+
+    def commit(self):
+        super().commit()
+        self._discard_session()
+
+    def rollback(self):
+        super().rollback()
+        self._discard_session()
+
+    def _discard_session(self):
+        if self.closed or self.autocommit:
+            return
+        self.autocommit = True
+        try:
+            with self.cursor() as cur:
+                cur.execute('DISCARD ALL')
+        finally:
+            self.autocommit = False
+
+
+def backend_pid(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_backend_pid()')
+        pid = cur.fetchone()[0]
+    conn.rollback()
+    return pid
+
+
+@requires_postgres
+def test_reuse_and_evict_postgres():
+    """最近使った接続はそのまま再利用し、壊れた接続だけを作り直すこと（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    pool = ConnectionPool(2, 4, database_url, idle_ping_seconds=0)
+    try:
+        first, second = pool.getconn(), pool.getconn()
+        first_pid, second_pid = backend_pid(first), backend_pid(second)
+        pool.putconn(first)
+        pool.putconn(second)
+
+        # サーバー側で1本だけ切断 → 生存確認で検出して、その接続だけを作り直す
+        killer = pool.getconn()
+        killer_pid = backend_pid(killer)
+        other_pid = first_pid if killer_pid == second_pid else second_pid
+        with killer.cursor() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s)', (other_pid,))
+        killer.commit()
+        pool.putconn(killer)
+
+        conns = [pool.getconn(), pool.getconn()]
+        pids = {backend_pid(conn) for conn in conns}
+        assert killer_pid in pids
+        assert other_pid not in pids
+        for conn in conns:
+            pool.putconn(conn)
+    finally:
+        pool.closeall()
+
+
+@requires_postgres
+def test_keeps_concurrent_connections_idle_postgres():
+    """同時に使った本数分の接続を返却後も保持し、次の同時取得で接続し直さないこと（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    PoolerStandInConnection.connects = 0
+    pool = ConnectionPool(1, 4, database_url, connection_factory=PoolerStandInConnection)
+    try:
+        barrier = threading.Barrier(4)
+
+        def use_connection():
+            conn = pool.getconn()
+            barrier.wait()
+            pool.putconn(conn)
+
+        for _ in range(3):
+            threads = [threading.Thread(target=use_connection) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = pool.stats()
+            assert stats['open'] == 4
+            assert stats['in_use'] == 0
+        assert PoolerStandInConnection.connects == 4
+    finally:
+        pool.closeall()
+
+
+@requires_postgres
+def test_all_idle_connections_dead_postgres():
+    """使っていない接続がすべて切断されていても、確認済みの新しい接続を返すこと（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    pool = ConnectionPool(5, 5, database_url, idle_ping_seconds=0)
+    try:
+        conns = [pool.getconn() for _ in range(5)]
+        pids = {backend_pid(conn) for conn in conns}
+        for conn in conns:
+            pool.putconn(conn)
+
+        # サーバーの再起動の代わりに、プールの接続をすべて別の接続から切断
+        admin = psycopg2.connect(database_url)
+        try:
+            with admin.cursor() as cur:
+                cur.execute('SELECT pg_terminate_backend(pid) FROM unnest(%s::int[]) AS pid', (list(pids),))
+            admin.commit()
+        finally:
+            admin.close()
+
+        conn = pool.getconn()
+        assert backend_pid(conn) not in pids
+        assert pool.stats()['open'] == 1
+        pool.putconn(conn)
+    finally:
+        pool.closeall()
+
+
+@requires_postgres
+def test_returned_transaction_rolled_back_postgres():
+    """トランザクションの途中で返却された接続は rollback してから再利用すること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    pool = ConnectionPool(0, 1, database_url)
+    try:
+        conn = pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE pool_rollback_check (id INTEGER)")
+        pool.putconn(conn)
+
+        assert pool.getconn() is conn
+        assert conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('pool_rollback_check')")
+            assert cur.fetchone()[0] is None
+        conn.rollback()
+        pool.putconn(conn)
+        assert pool.stats()['open'] == 1
+    finally:
+        pool.closeall()
+    assert conn.closed
+
+
+@requires_postgres
+def test_checkout_timeout_postgres():
+    """すべて使用中なら返却を待ち、timeout を過ぎたら PoolError になること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    pool = ConnectionPool(1, 1, database_url, timeout=0.05)
+    try:
+        conn = pool.getconn()
+        try:
+            pool.getconn()
+            assert False, 'expected PoolError'
+        except PoolError:
+            pass
+
+        # 別スレッドが返却すれば待っていた取得が成功する
+        pool.timeout = 5
+        threading.Timer(0.05, pool.putconn, (conn,)).start()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        # 二重返却は無視される
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+    finally:
+        pool.closeall()
+
+
+@requires_postgres
+def test_serverless_pool_postgres():
+    """サーバーレス向けの設定: 必要になるまで接続せず、返却した1本を再利用し、上限を守ること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    PoolerStandInConnection.connects = 0
+    pool = ConnectionPool(0, 2, database_url, max_idle=1, timeout=0.05,
+                          connection_factory=PoolerStandInConnection)
+    try:
+        assert PoolerStandInConnection.connects == 0
+
+        conn = pool.getconn()
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+        assert PoolerStandInConnection.connects == 1
+
+        other = pool.getconn()
+        try:
+            pool.getconn()
+            assert False, 'expected PoolError'
+        except PoolError:
+            pass
+        # max_idle を超える1本は返却時に閉じる
+        pool.putconn(conn)
+        pool.putconn(other)
+        assert conn.closed != other.closed
+
+        # セッション状態はトランザクションをまたいで残らない（プーラーの代わり）
+        conn = pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute("PREPARE pooler_check AS SELECT 1")
+        conn.commit()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE pooler_check")
+            assert False, 'expected prepared statement to be discarded'
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.rollback()
+        pool.putconn(conn)
+    finally:
+        pool.closeall()
+
+
+@requires_postgres
+def test_instrumentation_postgres():
+    """クエリ数・保持時間をラベルごとに集計し、返却されていない接続を取得したスタック付きで返すこと（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    pool = ConnectionPool(1, 2, database_url, leak_seconds=0.05)
+    try:
+        conn = pool.getconn('get_reservations')
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute('SELECT 1 AS one')
+            assert cur.fetchone()['one'] == 1
+        timing = pool.putconn(conn)
+        assert timing['queries'] == 2
+        assert timing['hold'] >= timing['query_seconds'] > 0
+        pool.record_request('get_reservations', timing['queries'])
+
+        leaked = pool.getconn('leaky_endpoint')
+        time.sleep(0.1)
+        stats = pool.stats()
+        assert stats['in_use'] == 1
+        assert stats['leaks'] == 1
+        assert stats['unreturned'][0]['label'] == 'leaky_endpoint'
+        assert any('test_instrumentation_postgres' in frame for frame in stats['unreturned'][0]['stack'])
+        endpoint = stats['endpoints']['get_reservations']
+        assert endpoint['checkouts'] == 1
+        assert endpoint['queries'] == 2
+        assert endpoint['queries_per_request'] == 2
+        pool.putconn(leaked)
+        assert pool.stats()['unreturned'] == []
+    finally:
+        pool.closeall()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+GAS webhook 取り込みモジュールのテスト
+
+ランダムな予約バッチに対して、一括処理（ingest.py）の結果が
+従来の1件ずつの処理（SELECT → UPDATE / INSERT、キャンセルごとのDELETE）と一致することを確認します。
+
+- フェーズ分割のテストは常に実行
+- 一括処理との比較は POSTGRES_URL が設定されていれば、PostgreSQLの一時テーブルで実行
+- 変更のない予約のスキップ（skip_applied）も、続けて送ったバッチの結果が従来の処理と一致することを確認
+- 不正な予約を含むバッチは、その予約だけを除いて反映されることを確認
+- マイグレーション（005・007・008）が未実行のテーブルでも、従来の処理と同じ結果になることを確認
+"""
+import os
+import random
+
+import pytest
+
+import ingest
+from ingest import (
+    normalize_item, plan_phases, apply_reservation_batch, exclude_conflicting,
+    validate_item, apply_reservations_partial
+)
+
+# PostgreSQLを使うテスト（POSTGRES_URL が設定されていなければスキップ）
+requires_postgres = pytest.mark.skipif(not os.environ.get('POSTGRES_URL'), reason='POSTGRES_URL not set')
+
+STORES = ['shibuya', 'ebisu']
+DATES = ['2025-12-01', '2025-12-02']
+CUSTOMERS = ['山田', '佐藤', 'N/A']
+ROOMS = ['個室A', '個室B', '']
+
+
+def legacy_apply(cur, reservations):
+    """従来の gas_webhook の1件ずつの処理（比較用）"""
+    inserted = updated = deleted = 0
+    for res in reservations:
+        store = res.get('store', 'shibuya')
+        if res.get('is_cancellation'):
+            customer_name = res.get('customer_name', 'N/A')
+            room_name = res.get('room_name', '')
+            if room_name:
+                cur.execute("""
+                    DELETE FROM reservations
+                    WHERE date = %s AND start_time = %s AND customer_name = %s AND store = %s AND room_name = %s AND type = 'gmail'
+                """, (res['date'], res['start'], customer_name, store, room_name))
+            else:
+                cur.execute("""
+                    DELETE FROM reservations
+                    WHERE date = %s AND start_time = %s AND customer_name = %s AND store = %s AND type = 'gmail'
+                """, (res['date'], res['start'], customer_name, store))
+            deleted += cur.rowcount
+            continue
+
+        values = (res['date'], res['start'], res['end'], res.get('customer_name', 'N/A'),
+                  res.get('room_name', '個室B'), store, res.get('type', 'gmail'), res.get('source', 'gas_sync'))
+        email_id = res.get('email_id')
+        if email_id:
+            cur.execute("SELECT id FROM reservations WHERE email_id = %s AND store = %s", (email_id, store))
+            if cur.fetchone():
+                cur.execute("""
+                    UPDATE reservations
+                    SET date = %s, start_time = %s, end_time = %s, customer_name = %s, room_name = %s, type = %s
+                    WHERE email_id = %s AND store = %s
+                """, values[:5] + (values[6], email_id, store))
+                updated += 1
+            else:
+                cur.execute("""
+                    INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, values + (email_id,))
+                inserted += 1
+        else:
+            cur.execute("""
+                SELECT id FROM reservations
+                WHERE date = %s AND start_time = %s AND end_time = %s AND store = %s AND type = 'gmail'
+                ORDER BY id LIMIT 1
+            """, (res['date'], res['start'], res['end'], store))
+            existing = cur.fetchone()
+            if existing:
+                cur.execute("""
+                    UPDATE reservations SET customer_name = %s, room_name = %s, type = %s WHERE id = %s
+                """, (values[3], values[4], values[6], existing[0]))
+                updated += 1
+            else:
+                cur.execute("""
+                    INSERT INTO reservations (date, start_time, end_time, customer_name, room_name, store, type, source, email_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NULL)
+                """, values)
+                inserted += 1
+    return inserted, updated, deleted
+
+
+def random_item(rng, email_pool):
+    """
+    ランダムな webhook の予約（予約・email_idなし予約・キャンセル）を生成
+
+    従来の処理では email_id なしの予約に一致する gmail 予約が複数ある場合にどれを更新するかが
+    不定のため、email_id ありは1時間、なしは2時間の予約にして一致候補が1件になるようにする
+    """
+    start_hour = rng.choice([10, 11])
+    item = {
+        'store': rng.choice(STORES),
+        'date': rng.choice(DATES),
+        'start': f'{start_hour}:00',
+        'end': f'{start_hour + 1}:00',
+        'customer_name': rng.choice(CUSTOMERS),
+        'room_name': rng.choice(ROOMS),
+        'type': rng.choice(['gmail', 'gmail', 'charter'])
+    }
+    kind = rng.random()
+    if kind < 0.25:
+        item['is_cancellation'] = True
+    elif kind < 0.75:
+        item['email_id'] = rng.choice(email_pool)
+    else:
+        item['end'] = f'{start_hour + 2}:00'
+    return item
+
+
+def snapshot(cur):
+    """テーブルの内容（IDを除く）"""
+    cur.execute("""
+        SELECT date::text, start_time::text, end_time::text, customer_name, room_name, store, type, source, email_id
+        FROM reservations
+    """)
+    return sorted(cur.fetchall(), key=repr)
+
+
+def test_plan_phases():
+    """種類の異なる処理が同じ枠に続く場合と、同じ予約の重複でフェーズが分かれること"""
+    items = [normalize_item(res) for res in [
+        {'date': '2025-12-01', 'start': '10:00', 'end': '11:00', 'email_id': 'a'},
+        {'date': '2025-12-01', 'start': '12:00', 'end': '13:00', 'email_id': 'b'},
+        {'date': '2025-12-02', 'start': '10:00', 'is_cancellation': True},
+        {'date': '2025-12-01', 'start': '10:00', 'is_cancellation': True},
+        {'date': '2025-12-03', 'start': '10:00', 'end': '11:00'},
+        {'date': '2025-12-03', 'start': '10:00', 'end': '11:00'},
+    ]]
+    phases = plan_phases(items)
+    assert [(len(p['email']), len(p['noemail']), len(p['cancel'])) for p in phases] == [(2, 0, 1), (0, 1, 1), (0, 1, 0)]
+
+
+def test_exclude_conflicting():
+    """反映する予約と同じ枠・同じ email_id の予約はスキップしないこと"""
+    items = [normalize_item(res) for res in [
+        {'date': '2025-12-01', 'start': '10:00', 'end': '11:00', 'email_id': 'a'},
+        {'date': '2025-12-01', 'start': '10:00', 'is_cancellation': True},
+        {'date': '2025-12-01', 'start': '12:00', 'end': '13:00', 'email_id': 'b'},
+        {'date': '2025-12-02', 'start': '12:00', 'end': '13:00', 'email_id': 'b'},
+        {'date': '2025-12-03', 'start': '09:00', 'end': '10:00'},
+    ]]
+    # 0番の予約は1番のキャンセルと同じ枠、2番は3番と同じ email_id
+    assert exclude_conflicting(items, {0, 2, 4}, {}) == {4}
+    # 4番は email_id 'c' の予約の移動元の枠
+    positions = {('shibuya', 'c'): ('shibuya', '2025-12-03', (9, 0))}
+    items.append(normalize_item({'date': '2025-12-04', 'start': '09:00', 'end': '10:00', 'email_id': 'c'}))
+    assert exclude_conflicting(items, {0, 2, 4}, positions) == set()
+
+
+def test_validate_item():
+    """データベースでエラーになる予約を事前に検出すること"""
+    booking = {'date': '2025-12-01', 'start': '10:00', 'end': '11:00', 'email_id': 'mail-0'}
+    assert validate_item(booking) is None
+    assert validate_item(dict(booking, start='9:00', end='24:00')) is None
+    assert validate_item({'date': '2025-12-01', 'start': '10:00', 'is_cancellation': True}) is None
+    assert validate_item(dict(booking, customer_name=None)) is None
+    assert validate_item('2025-12-01') == 'reservation must be an object'
+    assert validate_item({'date': '2025-12-01', 'start': '10:00'}) == "missing 'end'"
+    assert validate_item(dict(booking, date='2025-02-30')) == 'invalid date: 2025-02-30'
+    assert validate_item(dict(booking, end='11:60')) == 'invalid end: 11:60'
+    assert validate_item(dict(booking, start=1000)) == 'invalid start: 1000'
+    assert validate_item(dict(booking, customer_name='x' * 101)) == 'customer_name is too long (max 100)'
+    assert validate_item(dict(booking, email_id=123)) == 'email_id must be a string'
+
+
+def create_version_tables(cur):
+    """
+    変更カウンタと反映済みハッシュの一時テーブル（migrations/005, 008 と同じ）を作成
+
+    一時テーブル reservations への書き込みで店舗のカウンタが進むよう、一時関数のトリガーも作成する
+    """
+    cur.execute("""
+        CREATE TEMP TABLE reservation_versions (
+            store VARCHAR(50) PRIMARY KEY, version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TEMP TABLE webhook_item_hashes (
+            store VARCHAR(50) NOT NULL, item_hash CHAR(32) NOT NULL, version BIGINT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (store, item_hash)
+        )
+    """)
+    cur.execute("""
+        CREATE FUNCTION pg_temp.bump_versions() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO reservation_versions AS v (store, version)
+            SELECT DISTINCT store, 1 FROM changed_rows WHERE store IS NOT NULL
+            ON CONFLICT (store) DO UPDATE SET version = v.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for event, transition in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cur.execute(f"""
+            CREATE TRIGGER versions_{event.lower()} AFTER {event} ON reservations
+            REFERENCING {transition} TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION pg_temp.bump_versions()
+        """)
+
+
+@requires_postgres
+def test_matches_legacy_postgres():
+    """PostgreSQLの一時テーブルで従来の1件ずつの処理と比較（VALUES・COPYの両方、POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # 一時テーブルは同名の本番テーブルより優先される
+        cur.execute("""
+            CREATE TEMP TABLE reservations (
+                id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+                customer_name VARCHAR(100), room_name VARCHAR(50), store VARCHAR(50),
+                type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255)
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+
+        # email_id なしの予約が email_id ありの gmail 予約に一致する場合（更新される）
+        booking = {'date': '2025-12-01', 'start': '10:00', 'end': '11:00', 'email_id': 'mail-0'}
+        cases = [([booking], [dict(booking, email_id=None, customer_name='佐藤'), dict(booking, room_name='個室A')])]
+        # COPY のNULLと空文字列・引用符・改行の区別
+        cases.append(([], [dict(booking, customer_name='', room_name='"A,B"\n'), dict(booking, email_id='x', customer_name=None)]))
+
+        rng = random.Random(20251201)
+        for _ in range(60):
+            email_pool = [f'mail-{i}' for i in range(rng.randrange(1, 8))]
+            existing = [random_item(rng, email_pool) for _ in range(rng.randrange(0, 8))]
+            batch = [random_item(rng, email_pool) for _ in range(rng.randrange(1, 25))]
+            cases.append((existing, batch))
+
+        for existing, batch in cases:
+            results = []
+            # 従来の処理 / VALUES で一括 / COPY で一時テーブルに投入して一括
+            for use_copy in (None, False, True):
+                cur.execute("TRUNCATE reservations")
+                legacy_apply(cur, [res for res in existing if not res.get('is_cancellation')])
+                if use_copy is None:
+                    counts = legacy_apply(cur, batch)
+                else:
+                    result = apply_reservation_batch(cur, batch, use_copy)
+                    counts = (result['inserted'], result['updated'], result['deleted'])
+                results.append((counts, snapshot(cur)))
+            assert results[0] == results[1] == results[2], (existing, batch)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@requires_postgres
+def test_skip_applied_postgres():
+    """変更のない予約をスキップしても、続けて送ったバッチの結果が従来の処理と一致すること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE reservations (
+                id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+                customer_name VARCHAR(100), room_name VARCHAR(50), store VARCHAR(50),
+                type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255)
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+        create_version_tables(cur)
+
+        # 同じバッチの再送は何もしない
+        batch = [
+            {'date': '2025-12-01', 'start': '10:00', 'end': '11:00', 'email_id': 'mail-0'},
+            {'date': '2025-12-01', 'start': '12:00', 'end': '14:00', 'customer_name': '山田'},
+            {'store': 'ebisu', 'date': '2025-12-02', 'start': '10:00', 'is_cancellation': True},
+        ]
+        first = apply_reservation_batch(cur, batch, skip_applied=True)
+        assert (first['inserted'], first['skipped']) == (2, 0)
+        again = apply_reservation_batch(cur, batch, skip_applied=True)
+        assert (again['skipped'], again['applied'], again['phases'], again['touched']) == (3, [], 0, set())
+
+        # 変わった予約だけ反映
+        changed = apply_reservation_batch(cur, [batch[0], dict(batch[1], customer_name='佐藤'), batch[2]], skip_applied=True)
+        assert (changed['updated'], changed['skipped'], changed['applied']) == (1, 2, [1])
+
+        # webhook 以外での変更（削除）があった店舗は再び反映
+        cur.execute("DELETE FROM reservations WHERE email_id = 'mail-0'")
+        restored = apply_reservation_batch(cur, batch, skip_applied=True)
+        assert (restored['inserted'], restored['updated'], restored['skipped']) == (1, 1, 1)
+
+        # ランダムなバッチを続けて送った結果が従来の処理と一致
+        # （email_id なしの gmail 以外の予約は、従来の処理では再送のたびに追加されるため除く）
+        rng = random.Random(20251202)
+        for _ in range(40):
+            email_pool = [f'mail-{i}' for i in range(rng.randrange(1, 6))]
+            pool = [random_item(rng, email_pool) for _ in range(12)]
+            pool = [item for item in pool if item.get('email_id') or item.get('is_cancellation') or item['type'] == 'gmail']
+            batches = [[rng.choice(pool) for _ in range(rng.randrange(1, 10))] for _ in range(6)]
+            results = []
+            for skip_applied in (None, True):
+                cur.execute("TRUNCATE reservations, reservation_versions, webhook_item_hashes")
+                for sent in batches:
+                    if skip_applied is None:
+                        legacy_apply(cur, sent)
+                    else:
+                        apply_reservation_batch(cur, sent, skip_applied=True)
+                results.append(snapshot(cur))
+            assert results[0] == results[1], batches
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@requires_postgres
+def test_partial_postgres():
+    """不正な予約・データベースでエラーになる予約だけを除いて反映すること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # 検証では検出できないエラーの代わりに CHECK 制約を使う
+        cur.execute("""
+            CREATE TEMP TABLE reservations (
+                id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+                customer_name VARCHAR(100) CHECK (customer_name <> 'NG'), room_name VARCHAR(50),
+                store VARCHAR(50), type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255)
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+
+        booking = {'date': '2025-12-01', 'start': '10:00', 'end': '11:00'}
+        batch = [
+            dict(booking, email_id='mail-0'),
+            {'date': '2025-12-01', 'start': '12:00', 'email_id': 'mail-1'},
+            dict(booking, email_id='mail-2', start='12:00', end='13:00'),
+        ]
+        result = apply_reservations_partial(cur, batch)
+        assert result['statuses'] == ['applied', 'error', 'applied']
+        assert (result['inserted'], result['failed'], result['errors']) == (2, 1, {1: "missing 'end'"})
+        assert result['applied'] == [0, 2] and result['phases'] == 1
+
+        # データベースでエラーになった場合は1件ずつ反映して、その予約だけを除く
+        batch = [dict(booking, email_id='mail-3', customer_name='NG'), dict(booking, email_id='mail-0', customer_name='佐藤')]
+        result = apply_reservations_partial(cur, batch)
+        assert result['statuses'] == ['error', 'applied']
+        assert 'violates check constraint' in result['errors'][0]
+        assert result['updated'] == 1
+        assert [row[3] for row in snapshot(cur)] == ['佐藤', 'N/A']
+
+        # 1件ずつ反映した場合も、エラーにならなかった予約はすべて次の再送でスキップされる
+        create_version_tables(cur)
+        batch = [dict(booking, email_id='mail-6', start='14:00', end='15:00'),
+                 dict(booking, email_id='mail-7', customer_name='NG'),
+                 dict(booking, store='ebisu', email_id='mail-8', start='16:00', end='17:00'),
+                 dict(booking, email_id='mail-9', start='18:00', end='19:00')]
+        result = apply_reservations_partial(cur, batch, skip_applied=True)
+        assert result['statuses'] == ['applied', 'error', 'applied', 'applied']
+        before = snapshot(cur)
+        again = apply_reservations_partial(cur, batch, skip_applied=True)
+        assert again['statuses'] == ['skipped', 'error', 'skipped', 'skipped']
+        assert (again['skipped'], again['inserted'], again['updated']) == (3, 0, 0)
+        assert snapshot(cur) == before
+
+        # 1件ずつの反映中のデッドロック・直列化の失敗は予約のエラーにせず、バッチ全体の失敗として投げる
+        cur.execute("""
+            CREATE FUNCTION pg_temp.fail_retry() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.customer_name = 'RETRY' THEN
+                    RAISE EXCEPTION 'could not serialize access' USING ERRCODE = 'serialization_failure';
+                END IF;
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE TRIGGER fail_retry BEFORE INSERT ON reservations
+            FOR EACH ROW EXECUTE FUNCTION pg_temp.fail_retry()
+        """)
+        batch = [dict(booking, email_id='mail-4', customer_name='NG'),
+                 dict(booking, email_id='mail-5', customer_name='RETRY')]
+        try:
+            apply_reservations_partial(cur, batch)
+            assert False, 'expected TransactionRollbackError'
+        except psycopg2.extensions.TransactionRollbackError:
+            pass
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@requires_postgres
+def test_missing_migrations_postgres():
+    """一意インデックス・変更カウンタ・ハッシュのテーブルがなくても従来の処理と一致すること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # 本番の reservation_versions などが見えないよう、空のスキーマだけを検索パスにする
+        cur.execute("CREATE SCHEMA ingest_missing_migrations")
+        cur.execute("SET LOCAL search_path = ingest_missing_migrations")
+        cur.execute("""
+            CREATE TEMP TABLE reservations (
+                id SERIAL PRIMARY KEY, date DATE, start_time TIME, end_time TIME,
+                customer_name VARCHAR(100), room_name VARCHAR(50), store VARCHAR(50),
+                type VARCHAR(20), source VARCHAR(50), email_id VARCHAR(255)
+            )
+        """)
+
+        rng = random.Random(20251203)
+        cases = []
+        for _ in range(30):
+            email_pool = [f'mail-{i}' for i in range(rng.randrange(1, 6))]
+            pool = [random_item(rng, email_pool) for _ in range(12)]
+            pool = [item for item in pool if item.get('email_id') or item.get('is_cancellation') or item['type'] == 'gmail']
+            cases.append([[rng.choice(pool) for _ in range(rng.randrange(1, 10))] for _ in range(4)])
+
+        # 007 のみ未実行 → 005・008 のみ未実行 → すべて未実行 の順にテーブルを作る
+        for unique_index, version_tables in ((False, True), (True, False), (False, False)):
+            cur.execute("SAVEPOINT schema")
+            ingest.schema_ready = False
+            if unique_index:
+                cur.execute("CREATE UNIQUE INDEX ON reservations (store, email_id)")
+            if version_tables:
+                create_version_tables(cur)
+            assert ingest.check_schema(cur) == (unique_index, version_tables)
+
+            for batches in cases:
+                results = []
+                for legacy in (True, False):
+                    cur.execute("TRUNCATE reservations")
+                    counts = []
+                    for sent in batches:
+                        if legacy:
+                            counts.append(legacy_apply(cur, sent))
+                        else:
+                            result = apply_reservations_partial(cur, sent, skip_applied=True)
+                            counts.append((result['inserted'], result['updated'], result['deleted']))
+                    results.append((counts if not version_tables else None, snapshot(cur)))
+                assert results[0] == results[1], (unique_index, version_tables, batches)
+            assert not ingest.schema_ready
+            cur.execute("ROLLBACK TO SAVEPOINT schema")
+    finally:
+        ingest.schema_ready = False
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    test_plan_phases()
+    test_exclude_conflicting()
+    test_validate_item()
+    if os.environ.get('POSTGRES_URL'):
+        test_matches_legacy_postgres()
+        test_skip_applied_postgres()
+        test_partial_postgres()
+        test_missing_migrations_postgres()
+    print("✓ 全テスト合格")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+クエリの登録とプリペアドステートメント（query_registry）のテスト
+
+データベースを使うテストは POSTGRES_URL が設定されている場合のみ実行します。
+"""
+import os
+
+import pytest
+
+import query_registry
+from db_pool import ConnectionPool
+from query_registry import Query, execute_query, register_query
+from test_db_pool import PoolerStandInConnection
+
+
+# PostgreSQLを使うテスト（POSTGRES_URL が設定されていなければスキップ）
+requires_postgres = pytest.mark.skipif(not os.environ.get('POSTGRES_URL'), reason='POSTGRES_URL not set')
+
+
+def test_placeholders():
+    """%s・%(名前)s を $n に置き換え、同じ名前は同じ番号を使うこと"""
+    query = Query('by_range', "SELECT * FROM t WHERE d BETWEEN %s AND %s AND s LIKE 'a%%'")
+    assert query.prepare_sql == "PREPARE by_range AS SELECT * FROM t WHERE d BETWEEN $1 AND $2 AND s LIKE 'a%'"
+    assert query.execute_sql == 'EXECUTE by_range (%s, %s)'
+    assert query.execute_params(('2030-01-01', '2030-01-31')) == ('2030-01-01', '2030-01-31')
+
+    query = Query('by_name', 'SELECT %(a)s, %(b)s, %(a)s', ('int', 'text'))
+    assert query.prepare_sql == 'PREPARE by_name (int, text) AS SELECT $1, $2, $1'
+    assert query.execute_params({'b': 'x', 'a': 1}) == [1, 'x']
+
+    assert Query('no_params', 'SELECT 1').execute_sql == 'EXECUTE no_params'
+    for name, sql, types in [('mixed', 'SELECT %s, %(a)s', None), ('types', 'SELECT %s', ('int', 'int'))]:
+        try:
+            Query(name, sql, types)
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+
+    assert register_query('test_registry_same', 'SELECT 1') is register_query('test_registry_same', 'SELECT 1')
+    try:
+        register_query('test_registry_same', 'SELECT 2')
+        assert False, 'expected ValueError'
+    except ValueError:
+        pass
+
+
+def prepared_names(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT name FROM pg_prepared_statements')
+        return {row[0] for row in cur.fetchall()}
+
+
+@requires_postgres
+def test_prepared_and_fallback_postgres():
+    """プールの接続では1回だけ PREPARE し、プーラー越しでは通常の実行に戻ること（POSTGRES_URLが必要）"""
+    database_url = os.environ.get('POSTGRES_URL')
+
+    query = register_query('test_registry_add', 'SELECT %(a)s::int + %(b)s::int')
+    pool = ConnectionPool(1, 1, database_url, prepare_statements=True)
+    try:
+        conn = pool.getconn()
+        for i in range(3):
+            with conn.cursor() as cur:
+                execute_query(cur, query, {'a': i, 'b': 1})
+                assert cur.fetchone()[0] == i + 1
+            conn.rollback()
+        assert conn.prepared_statements == {'test_registry_add'}
+        assert conn.prepared_statements_verified
+        assert 'test_registry_add' in prepared_names(conn)
+        conn.rollback()
+        pool.putconn(conn)
+    finally:
+        pool.closeall()
+
+    # プーラーの代わりの接続: トランザクションが終わると PREPARE が消える
+    pool = ConnectionPool(0, 1, database_url, prepare_statements=True, connection_factory=PoolerStandInConnection)
+    try:
+        conn = pool.getconn()
+        with conn.cursor() as cur:
+            execute_query(cur, query, {'a': 1, 'b': 1})
+            # 確認できるまではトランザクションの途中の文は通常の実行
+            execute_query(cur, query, {'a': 2, 'b': 2})
+            assert cur.fetchone()[0] == 4
+        conn.commit()
+        with conn.cursor() as cur:
+            execute_query(cur, query, {'a': 3, 'b': 3})
+            assert cur.fetchone()[0] == 6
+        conn.commit()
+        assert query_registry.prepared_statements_disabled
+        assert not conn.prepared_statements_verified
+        pool.putconn(conn)
+    finally:
+        query_registry.prepared_statements_disabled = False
+        pool.closeall()
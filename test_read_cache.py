@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+読み取りキャッシュモジュールのテスト
+"""
+import time
+
+from read_cache import ReadCache
+
+
+def test_invalidate_only_touched_scopes():
+    """書き込みのあった (店舗, 日付) に依存するエントリだけが消えること"""
+    cache = ReadCache()
+    cache.set(('availability', 'shibuya', '2025-12-01', ()), 'a', [('shibuya', '2025-12-01')])
+    cache.set(('availability', 'shibuya', '2025-12-02', ()), 'b', [('shibuya', '2025-12-02')])
+    cache.set(('availability_detailed', None, '2025-12-01', ()), 'c', [(None, '2025-12-01')])
+    cache.set(('reservations', 'ebisu', None, ()), 'd', [('ebisu', None)])
+    cache.set(('reservations', None, None, ()), 'e', [(None, None)])
+
+    assert cache.invalidate('shibuya', '2025-12-01') == 3
+    assert cache.get(('availability', 'shibuya', '2025-12-02', ())) == 'b'
+    assert cache.get(('reservations', 'ebisu', None, ())) == 'd'
+    assert cache.get(('availability', 'shibuya', '2025-12-01', ())) is None
+    assert cache.get(('reservations', None, None, ())) is None
+
+
+def test_lru_eviction_and_ttl():
+    """上限を超えると最も古いエントリが消え、TTLを過ぎたエントリは返さないこと"""
+    cache = ReadCache(max_entries=2, ttl_seconds=60)
+    cache.set('a', 1, [])
+    cache.set('b', 2, [])
+    cache.get('a')
+    cache.set('c', 3, [])
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+    cache = ReadCache(ttl_seconds=0.01)
+    cache.set('a', 1, [])
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_stale_compute_is_not_stored():
+    """計算中に無効化があった場合、その結果はキャッシュしないこと"""
+    cache = ReadCache()
+
+    def compute():
+        cache.invalidate('shibuya', '2025-12-01')
+        return 'stale'
+
+    assert cache.get_or_compute('k', [('shibuya', '2025-12-01')], compute) == 'stale'
+    assert cache.get('k') is None
+    assert cache.get_or_compute('k', [('shibuya', '2025-12-01')], lambda: 'fresh') == 'fresh'
+    assert cache.get('k') == 'fresh'
+
+
+def test_invalidated_at():
+    """最後に無効化した時刻を記録すること（リードレプリカが書き込みに追いついたかの判定用）"""
+    cache = ReadCache()
+    assert cache.invalidated_at is None
+    before = time.monotonic()
+    cache.invalidate('shibuya', '2025-12-01')
+    first = cache.invalidated_at
+    assert first >= before
+    cache.clear()
+    assert cache.invalidated_at >= first
+
+
+if __name__ == '__main__':
+    test_invalidate_only_touched_scopes()
+    test_lru_eviction_and_ttl()
+    test_stale_compute_is_not_stored()
+    test_invalidated_at()
+    print("✓ 全テスト合格")